@@ -1,18 +1,19 @@
 import os
 import numpy
+import inspect
 import shutil
-import scipy
 import glob
 import unittest
 import json
+import yaml
 import pickle
 import matplotlib.pyplot as pyplot
 
-from casatasks import immoments
+from casatasks import immoments, tclean
 from casatasks.private.parallel.parallel_task_helper import ParallelTaskHelper
 
 from casaviewer import imview
-from casatools import ctsys, image
+from casatools import ctsys, image, table
 
 from casatestutils import generate_weblog
 from casatestutils.stakeholder import almastktestutils
@@ -21,25 +22,456 @@ from casatestutils.imagerhelpers import TestHelpers
 th = TestHelpers()
 
 from scripts.baseclass.stk_test_base import stakeholder_baseclass_template
+from scripts.baseclass.stk_trace import Tracer
+from scripts.baseclass.stk_fit import FitPool
+from scripts.baseclass.stk_report import run_stats_tasks
+from scripts.baseclass.stk_cache import StatsCache
+from scripts.baseclass.stk_mmap import TiledImageReader
+from scripts.baseclass.stk_mask import BitMask, count_nonzero_masked, encode_json, decode_json
+from scripts.baseclass.stk_compare import FiducialReport, compare_dicts, compare_beams
+from scripts.baseclass.stk_beam import BeamTable
+from scripts.baseclass.stk_fiducials import FiducialStore
+from scripts.baseclass.stk_columnar import save_columnar, load_columnar
+from scripts.baseclass.stk_clone import clone_products
+from scripts.baseclass.stk_products import ProductCache
+from scripts.baseclass.stk_checkpoint import Checkpoints
+from scripts.baseclass.stk_chunked import chunked_tclean
+from scripts.baseclass.stk_staging import DataStager
+from scripts.baseclass.stk_stats import ImageStatsEngine, RegionCounter, ChannelRegionCounter
 
 _ia = image()
+_tb = table()
 ctsys_resolve = ctsys.resolve
 
 # Location of data
 data_path = ctsys_resolve('stakeholder/alma/')
 
+# Location of the stakeholder configuration file
+config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../config/config.yaml')
+
+# Approximate memory used per pixel of a channel block while streaming an image in
+# image_stats (data, pixel mask and float64 temporaries)
+_block_bytes_per_pixel = 32
+
 # Save the dictionaries of the metrics to files (per test)
 # mostly useful for the maintenance (updating the expected metric parameters based
 # on the current metrics)
 savemetricdict=True
 
+def load_config(path=config_path)->dict:
+    """ Load the stakeholder configuration file.
+
+    Args:
+        path (str, optional): Configuration file. Defaults to config/config.yaml.
+
+    Returns:
+        dict: Configuration, empty if the file can't be read.
+    """
+
+    try:
+        with open(path) as file:
+            return yaml.safe_load(file) or {}
+    except (OSError, yaml.YAMLError) as error:
+        print('Unable to read configuration file: ' + str(error))
+        return {}
+
+## Image statistics of the imaging products, without the unit test machinery so that
+## the report worker processes can compute them too
+class stakeholder_stats_base():
+
+    def setup_stats(self, config:dict, tracer:Tracer, fit_workers=0)->None:
+        """ Set up the image and table tools, the statistics cache and the component fit pool.
+
+        Args:
+            config (dict): Stakeholder configuration, see load_config().
+            tracer (Tracer): Tracer of the timing spans.
+            fit_workers (int, optional): Number of component fit processes. Defaults to 0.
+        """
+
+        self._myia = _ia
+        self._mytb = _tb
+        self.tracer = tracer
+
+        # Channel blocking used to stream images through image_stats()
+        self.stats_config = config.get('image_stats') or {}
+
+        # Statistics of unchanged images are read back from the statistics cache
+        cache_config = config.get('stats_cache') or {}
+        self.stats_cache = None
+        if cache_config.get('enabled', False):
+            self.stats_cache = StatsCache(cache_config.get('dir', '.stkcache/stats'),
+                max_mbytes=cache_config.get('max_mbytes', 1024))
+
+        self.fit_pool = FitPool(workers=fit_workers, tracer=tracer)
+
+    def cube_beam_stats(self, image:'CASAImage')->dict:
+        """ Function to return per-channel beam statistics .
+
+        Args:
+            image (CASAImage): Image to analyze.
+
+        Returns:
+            dict: Beam statistics dictionaries.
+        """
+        with self.tracer.span('cube_beam_stats', image=os.path.basename(image)):
+            return self.cached_stats('cube_beam_stats', self._cube_beam_stats, image)
+
+    def cached_stats(self, function:str, compute, image:str, suffixes=None, settings=None, **args):
+        """ Return compute(image, **args), read from the statistics cache when enabled.
+
+        Args:
+            function (str): Name of the statistics, part of the cache key.
+            compute (callable): Function computing the statistics.
+            image (str): Image to analyze.
+            suffixes (list, optional): Suffixes of files written next to image by compute,
+                saved and restored with the statistics. Defaults to None.
+            settings (dict, optional): Configuration values changing the statistics, part of
+                the cache key. Defaults to None.
+            **args: Arguments of compute, part of the cache key.
+        """
+
+        if self.stats_cache == None:
+            return compute(image, **args)
+
+        key = self.stats_cache.key(function, image, settings=settings, **args)
+        stats = self.stats_cache.lookup(key, image)
+        if stats != None:
+            print('Statistics of ' + image + ' read from the statistics cache')
+            return stats
+
+        stats = compute(image, **args)
+        self.stats_cache.store(key, stats, image, suffixes=suffixes)
+
+        return stats
+
+    def _cube_beam_stats(self, image:'CASAImage')->dict:
+        return self.cube_beam_table(image).to_dicts()
+
+    def cube_beam_table(self, image:'CASAImage')->BeamTable:
+        """ Return the per-channel restoring beams of image.
+
+        Args:
+            image (CASAImage): Image to analyze.
+
+        Returns:
+            BeamTable: Beams as a numpy structured array (major, minor, pa) with their units.
+        """
+
+        self._myia.open(image)
+        try:
+            restoringbeam = self._myia.restoringbeam()
+        finally:
+            self._myia.close()
+
+        return BeamTable.from_restoringbeam(restoringbeam)
+
+    def image_stats(self, image, fit_region=None, field_regions=None, masks=None):
+        """ function that takes an image file and returns a statistics
+            dictionary
+        """
+        # The regions of .mask images are counted as set by image_stats.mask_regions
+        region_config = self.stats_config.get('mask_regions') or {}
+        settings = {'mask_regions':[region_config.get('mode', 'cube'), region_config.get('connectivity', 1)]}
+
+        with self.tracer.span('image_stats', image=os.path.basename(image)):
+            return self.cached_stats('image_stats', self._image_stats, image, suffixes=['.profile.png'],
+                settings=settings, fit_region=fit_region, field_regions=field_regions, masks=masks)
+
+    def _image_stats(self, image, fit_region=None, field_regions=None, masks=None):
+        self._myia.open(image)
+        imagename=os.path.basename(image)
+        stats_dict = {}
+        tracer = self.tracer
+
+        # stats returned for all images
+        im_size = self._myia.boundingbox()['imageShape'].tolist()
+
+        # Arrays are returned in the layout of the transposed data chunk with the degenerate
+        # axes dropped, [chan, y, x] for cubes; blocks keep the channel axis.
+        chunk_shape = [n for n in reversed(im_size) if n != 1]
+        block_axes = [i for i in range(4) if im_size[i] != 1 or i == 3]
+        block_shape = [im_size[i] for i in reversed(block_axes)]
+
+        engine = ImageStatsEngine(im_size, thresholds=[0.2, 0.5] if 'pb' in imagename else None)
+
+        # Masks are kept as per-channel bitsets, arrays given as masks are packed
+        def bitmask(array):
+            if isinstance(array, BitMask):
+                return array
+            return BitMask.from_array(numpy.reshape(array, block_shape), shape=chunk_shape)
+
+        if image.endswith('.mask'):
+            # 'cube' labels the regions of the whole mask cube, 'channel' each channel plane
+            region_config = self.stats_config.get('mask_regions') or {}
+            if region_config.get('mode', 'cube') == 'channel':
+                regions = ChannelRegionCounter(connectivity=region_config.get('connectivity', 1),
+                    workers=region_config.get('workers', 1))
+            else:
+                regions = RegionCounter()
+            mask = BitMask(block_shape[0], block_shape[1:], shape=chunk_shape)
+        if 'pb' in imagename and 'mosaic' in imagename:
+            pb_mask_02 = BitMask(block_shape[0], block_shape[1:], shape=chunk_shape)
+            pb_mask_05 = BitMask(block_shape[0], block_shape[1:], shape=chunk_shape)
+        if 'model' in imagename or image.endswith('.alpha'):
+            masks = [bitmask(masks)]
+            mask_non0 = 0
+        if 'weight' in imagename:
+            masks = [bitmask(masks[0]), bitmask(masks[1])]
+            wt_counts = []
+
+        # Pixels are read from the memory-mapped image table when enabled and supported
+        # (the pixel mask still comes from the image tool)
+        reader = self.image_reader(image)
+
+        # Single pass over the pixels, streamed in blocks of channels
+        # (the labelling threads of the channel region counter are stopped in any case)
+        try:
+            for c0, c1 in self._channel_blocks(im_size):
+                with tracer.span('getchunk', chans=[c0, c1]):
+                    blc = [0, 0, 0, c0]
+                    trc = [im_size[0]-1, im_size[1]-1, im_size[2]-1, c1-1]
+                    data = self._myia.getchunk(blc=blc, trc=trc) if reader == None else reader.getchunk(blc, trc)
+                    pixmask = self._myia.getchunk(blc=blc, trc=trc, getmask=True)
+
+                with tracer.span('statistics', chans=[c0, c1]):
+                    engine.update(data, pixmask, c0)
+
+                    # Transpose to make channel selection easier
+                    chunk = numpy.transpose(data.reshape([data.shape[i] for i in block_axes]))
+
+                    if image.endswith('.mask'):
+                        regions.update(chunk)
+                        mask.set(c0, chunk == 0)
+
+                    if 'pb' in imagename and 'mosaic' in imagename:
+                        pb_mask_02.set(c0, chunk>0.2)
+                        pb_mask_05.set(c0, chunk>0.5)
+
+                    if 'model' in imagename or image.endswith('.alpha'):
+                        mask_non0 += int(count_nonzero_masked(chunk, masks, c0).sum())
+
+                    if 'weight' in imagename:
+                        wt_counts.append(count_nonzero_masked(chunk, masks, c0))
+
+                del data, pixmask, chunk
+        finally:
+            if image.endswith('.mask') and isinstance(regions, ChannelRegionCounter):
+                regions.close()
+
+        statistics = engine.result()
+
+        stats_dict['npts'] = im_size[0]*im_size[1]*im_size[3]
+        stats_dict['npts_unmasked'] = float(statistics['npts'])
+        stats_dict['npts_real'] = statistics['npts_real']
+        stats_dict['freq_bin'] = self._myia.summary()['incr'][3]
+
+        # ia.statistics() reported the frequencies of the blc/trc formatted as '%e'
+        stats_dict['start'] = float('%e' % \
+            self._myia.toworld([0, 0, 0, 0])['numeric'][3])
+        stats_dict['end'] = float('%e' % \
+            self._myia.toworld([n - 1 for n in im_size])['numeric'][3])
+        stats_dict['start_delta'] = stats_dict['start']
+        stats_dict['end_delta'] = stats_dict['end']
+        stats_dict['nchan'] = im_size[3]
+
+
+        # stats returned for all images except .mask
+        if not image.endswith('.mask'):
+            stats_dict['max_val'] = statistics['max']
+            stats_dict['max_val_pos'] = statistics['maxpos']
+            max_loc = [stats_dict['max_val_pos'][0], \
+                stats_dict['max_val_pos'][1]]
+            stats_dict['min_val'] = statistics['min']
+            stats_dict['min_val_pos'] = statistics['minpos']
+            stats_dict['im_rms'] = statistics['rms']
+
+        # stats returned if a region file is given
+        if fit_region != None:
+            if '_cube' in imagename:
+                if '.pb' in imagename:
+                    fit_region = fit_region + ', range=[%schan,%schan]'\
+                        % (int(im_size[3]/2), int(im_size[3]/2))
+                if '.psf' in imagename:
+
+                    # using chan 1 as first because ia.fitcomponents fits
+                    # every channel if chan=0
+                    fit_regions = [(fit_region + ', range=[%schan,%schan]' \
+                                   % (1, 1)), \
+                                  (fit_region + ', range=[%schan,%schan]' \
+                                   % (int(im_size[3]/2), int(im_size[3]/2))), \
+                                  (fit_region + ', range=[%schan,%schan]' \
+                                   % ((im_size[3]-1), (im_size[3]-1)))]
+                    psf_fits = [self.fit_pool.submit(self._myia, image, region) for region in fit_regions]
+                if '.model' in imagename:
+                    fit_region = fit_region
+                if '.model' not in imagename and '.pb' not in imagename and '.psf' not in imagename:
+
+                    # WARN: If max value channel is 0, tool fits all channels
+                    fit_region = fit_region + ', range=[%schan,%schan]' \
+                        % (stats_dict['max_val_pos'][3], \
+                        stats_dict['max_val_pos'][3])
+            fit = None
+            if ('image' in imagename and 'mosaic_cube_eph' not in imagename) or 'pb' in imagename or ('psf' in imagename and 'cube' not in imagename):
+                fit = self.fit_pool.submit(self._myia, image, fit_region)
+
+            with tracer.span('statistics', region=fit_region):
+                if '.psf' in imagename and '_cube' in imagename:
+                    stats_dict['regn_sum'] = self._myia.statistics( \
+                        region=fit_regions[1])['sum'][0]
+                else:
+                    stats_dict['regn_sum'] = self._myia.statistics( \
+                        region=fit_region)['sum'][0]
+
+        # stats returned for .image(.tt0)
+        if 'image' in imagename:
+            commonbeam = self._myia.commonbeam()
+            stats_dict['com_bmin'] = commonbeam['minor']['value']
+            stats_dict['com_bmaj'] = commonbeam['major']['value']
+            stats_dict['com_pa'] = commonbeam['pa']['value']
+            if 'cube' in imagename:
+                stats_dict['rms_per_chan'] = statistics['rms_per_chan']
+                stats_dict['profile'] = self.cube_profile_fit( \
+                    image, max_loc, stats_dict['nchan'])
+            if 'mosaic' in imagename:
+                stats_dict['rms_per_field'] = []
+                for region in field_regions:
+                    with tracer.span('statistics', region=region):
+                        stats_dict['rms_per_field'].append( \
+                            self._myia.statistics(region=region)['rms'][0])
+
+        # stats returned if not .pb(.tt0), .sumwt(.tt0), or .mask
+        # if 'pb' not in image and 'sumwt' not in image and not image.endswith('.mask'):
+        stats_dict['im_sum'] = statistics['sum']
+
+        if image.endswith('.mask'):
+            stats_dict['mask_pix'] = statistics['nonzero']
+            stats_dict['mask_regns'] = regions.count()
+            if isinstance(regions, ChannelRegionCounter):
+                stats_dict['mask_regns_per_chan'] = regions.counts
+                stats_dict['mask_regn_areas'] = regions.areas
+            stats_dict['mask'] = mask
+
+        if 'pb' in imagename:
+            if 'cube' in image:
+                # count_nonzero(chan*pb_mask) also counted the NaN and -inf pixels (+inf
+                # ones are already in the threshold counts)
+                nonfinite = im_size[0]*im_size[1]*im_size[2] - numpy.array(statistics['finite_per_chan']) \
+                    - numpy.array(statistics['posinf_per_chan'])
+                stats_dict['npts_0.2'] = (nonfinite + statistics['counts'][0.2]).tolist()
+                stats_dict['npts_0.5'] = (nonfinite + statistics['counts'][0.5]).tolist()
+            else:
+                stats_dict['npts_0.2'] = sum(statistics['counts'][0.2])
+                stats_dict['npts_0.5'] = sum(statistics['counts'][0.5])
+            if 'mosaic' in imagename:
+                stats_dict['pb_mask_0.2'] = pb_mask_02
+                stats_dict['pb_mask_0.5'] = pb_mask_05
+
+        if 'model' in imagename or image.endswith('.alpha'):
+            stats_dict['mask_non0'] = mask_non0
+
+        if 'weight' in imagename:
+            wt_counts = numpy.concatenate(wt_counts, axis=1)
+            if 'cube' in imagename:
+                stats_dict['npts_0.2'] = wt_counts[0].tolist()
+                stats_dict['npts_0.5'] = wt_counts[1].tolist()
+            else:
+                stats_dict['npts_0.2'] = int(wt_counts[0].sum())
+                stats_dict['npts_0.5'] = int(wt_counts[1].sum())
+
+        # The fits ran in the fit pool alongside the statistics above
+        if fit_region != None:
+            if '.psf' in imagename and '_cube' in imagename:
+                for i, future in enumerate(psf_fits):
+                    self.set_fit_values(stats_dict, future.result(), suffix='_'+str(i))
+            if fit != None:
+                self.set_fit_values(stats_dict, fit.result())
+
+        self._myia.close()
+
+        return stats_dict
+
+    def set_fit_values(self, stats_dict:dict, values:dict, suffix='')->None:
+        """ Store the values of a component fit in the statistics dictionary.
+
+        Args:
+            stats_dict (dict): Statistics dictionary of image_stats().
+            values (dict): Fit values from stk_fit.component_values(), None if the fit failed.
+            suffix (str, optional): Key suffix, '_<i>' for the PSF cube channels. Defaults to ''.
+        """
+
+        if values == None:
+            values = {'fit':[1.0, 1.0, 1.0], 'fit_loc_chan':1.0, 'fit_loc_freq':1.0, 'fit_pix':[1.0, 1.0]}
+
+        for key in ['fit', 'fit_loc_chan', 'fit_loc_freq', 'fit_pix']:
+            stats_dict[key+suffix] = values[key]
+
+    def image_reader(self, image:str)->TiledImageReader:
+        """ Return a memory-mapped reader of the pixels of image if the image_stats
+            mmap_reader option is set and the storage layout of the image is supported,
+            None to read the pixels with the image tool.
+        """
+
+        if not self.stats_config.get('mmap_reader', False):
+            return None
+
+        return TiledImageReader.open(image, self._mytb)
+
+    def _channel_blocks(self, im_size:list):
+        """ Generator of the (first, last+1) channel ranges used to stream an image, sized
+            to stay below the image_stats max_block_mbytes memory ceiling unless chan_block
+            is set in the configuration.
+
+        Args:
+            im_size (list): Image shape [nx, ny, nstokes, nchan].
+        """
+
+        nchan = self.stats_config.get('chan_block')
+        if not nchan:
+            plane_bytes = im_size[0]*im_size[1]*im_size[2]*_block_bytes_per_pixel
+            nchan = max(1, int(self.stats_config.get('max_block_mbytes', 512)*2**20) // plane_bytes)
+
+        for c0 in range(0, im_size[3], nchan):
+            yield c0, min(c0 + nchan, im_size[3])
+
+    def cube_profile_fit(self, image, max_loc, nchan):
+        """ function that will retrieve a profile for cubes at the max position
+            and create a png showing the profile plot; must be called with
+            image already opened
+        """
+        
+        pyplot.clf()
+        
+        box = str(max_loc[0])+','+str(max_loc[1])+','+str(max_loc[0])+','+str(max_loc[1])
+        with self.tracer.span('fitprofile', box=box):
+            profile = self._myia.fitprofile(box=box)['gs']['amp'][0][0][0][0][0]
+        
+        with self.tracer.span('getchunk', blc=max_loc):
+            reader = self.image_reader(image)
+            if reader != None:
+                X = reader.getchunk(blc=max_loc, trc=max_loc)[0][0][0]
+            else:
+                X = self._myia.getchunk(blc=max_loc, trc=max_loc, axes=[0,1])[0][0][0]
+        
+        with self.tracer.span('plot_profile'):
+            self._plot_profile(image, X, nchan)
+
+        return profile
+
+    def _plot_profile(self, image, X, nchan):
+        pyplot.title('Frequency Profile at Max Value Position')
+        pyplot.xlabel('Channel Number')
+        pyplot.xlim(0,(nchan+1))
+        pyplot.ylabel('Amplitude (Jy/Beam)')
+        pyplot.plot(X)
+        pyplot.savefig(image+'.profile.png')
+        pyplot.clf()
+
 ## Base Test class with Utility functions
-class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
+class test_stakeholder_base(unittest.TestCase, stakeholder_stats_base, stakeholder_baseclass_template):
 
     def setUp(self):
         """ Setup function for unit testing. """
 
-        self._myia = _ia
         self._test_dict = None
         
         # sets epsilon as a percentage (1%)
@@ -62,16 +494,87 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             self.data_path = data_path  
         
         
-        self.expdict_jsonfile = self.data_path+'test_stk_alma_pipeline_imaging_exp_dicts.json'
-        self.refversion='6.3.0.22'
+        self.config = load_config()
+        fiducials = self.config.get('fiducials') or {}
+
+        self.expdict_jsonfile = self.data_path+fiducials.get('expdict_jsonfile', 'test_stk_alma_pipeline_imaging_exp_dicts.json')
+        self.refversion=fiducials.get('refversion', '6.3.0.22')
+
+        # Fiducials are read from per-test shards of the JSON file when a store is configured
+        self.fiducial_store = None
+        if fiducials.get('store_dir'):
+            self.fiducial_store = FiducialStore(fiducials['store_dir'])
+
+        # Timing spans of the test stages, saved as a Chrome trace in tearDown()
+        self.tracing = self.config.get('tracing') or {}
+        tracer = Tracer(enabled=self.tracing.get('enabled', False))
+
+        # Products of the iter0 tclean runs are shared by the tests with the same parameters
+        product_config = self.config.get('product_cache') or {}
+        self.product_cache = None
+        if product_config.get('enabled', False):
+            self.product_cache = ProductCache(product_config.get('dir', '.stkcache/products'),
+                max_gbytes=product_config.get('max_gbytes', 20), workers=product_config.get('workers', 8))
+
+        # Measurement sets are read from copies in a local scratch directory
+        staging_config = self.config.get('staging') or {}
+        self.stager = None
+        if staging_config.get('enabled', False):
+            self.stager = DataStager(staging_config.get('scratch_dir', '/tmp/stk_scratch'),
+                max_gbytes=staging_config.get('max_gbytes', 100))
+
+        # Without MPI, cubes can be imaged in channel chunks by local tclean processes
+        self.local_cube = self.config.get('local_cube') or {}
+
+        # Stages completed by a previous run are skipped with stakeholder_test.py --resume
+        self.checkpoint_config = self.config.get('checkpoints') or {}
+        self._checkpoints = None
+
+        # Component fits of image_stats() run side by side in worker processes, except
+        # under MPI where the test process shouldn't start processes of its own
+        stats_config = self.config.get('image_stats') or {}
+        fit_workers = 0 if self.parallel else stats_config.get('fit_workers', 0)
+        self.setup_stats(self.config, tracer, fit_workers=fit_workers)
 
     def tearDown(self):
         """ Teardown function for unit testing. """
 
+        test_name = getattr(self, 'test_name', self._testMethodName)
+
         if (hasattr(self, 'test_dict')):
-            generate_weblog("tclean_ALMA_pipeline", self._test_dict)
+            with self.tracer.span('generate_weblog'):
+                generate_weblog("tclean_ALMA_pipeline", self._test_dict)
+
+            # Keep the weblog dictionary so that stakeholder_test.py can merge the
+            # results of several runs (shards) into a single weblog. The runner names
+            # the test after its script (STK_TEST_ID).
+            if self._test_dict != None:
+                test_id = os.environ.get('STK_TEST_ID', test_name)
+                with open(test_id+'.test_dict.pickle', 'wb') as outf:
+                    pickle.dump(self._test_dict, outf)
+
+        self.fit_pool.shutdown()
+        if self.stager != None:
+            self.stager.close()
+        self.tracer.save(os.path.join(self.tracing.get('dir', '.'), test_name+'.trace.json'))
         print("Closing ia tool")
         self._myia.done()
+        self._mytb.done()
+
+    @property
+    def checkpoints(self)->Checkpoints:
+        """ Checkpoint manifest of the stages of the test, <test_name>.checkpoints.json. """
+
+        if self._checkpoints == None:
+            test_name = getattr(self, 'test_name', self._testMethodName)
+            # stakeholder_test.py --resume/--no-resume override the configuration
+            if 'STK_RESUME' in os.environ:
+                resume = os.environ['STK_RESUME'] == '1'
+            else:
+                resume = self.checkpoint_config.get('resume', False)
+            self._checkpoints = Checkpoints(test_name + '.checkpoints.json', resume=resume)
+
+        return self._checkpoints
 
     def get_exec_env(self):
         """ Attempt to determine whether we're running in a Jupyter notebook ('ipynb'/'ipynb_colab') or some other environment.
@@ -151,18 +654,27 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             testname (str): Nmae of unit test.
         """
         
-        self._exp_dicts = almastktestutils.read_testcase_expdicts(self.expdict_jsonfile, testname, self.refversion)
+        if self.fiducial_store != None:
+            self._exp_dicts = self.fiducial_store.load(self.expdict_jsonfile, testname, self.refversion)
+        else:
+            self._exp_dicts = almastktestutils.read_testcase_expdicts(self.expdict_jsonfile, testname, self.refversion)
 
     # Separate functions here, for special-case tests that need their own MS.
+
     def prepData(self, msname=None):
         """ Prepare the data for the unit test.
 
+        With staging enabled, self.msfile is a copy of msname in the local scratch directory.
+
         Args:
             msname (str, optional): Measurement file. Defaults to None.
         """
 
         if msname != None:
             self.msfile = msname
+            if self.stager != None:
+                with self.tracer.span('stage data', msname=msname):
+                    self.msfile = self.stager.stage(msname, hold=True)
 
     def delData(self, msname=None):
         """ Clean up generated data for a given test.
@@ -190,39 +702,73 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             shutil.rmtree(self.maskname)
         shutil.copytree(refdatapath+self.maskname, self.maskname, symlinks=True)
 
-    def check_dict_vals_beam(self, exp_dict:dict, act_dict:dict, suffix:str, epsilon=0.01):
+    def check_dict_vals_beam(self, exp_dict:dict, act_dict:dict, suffix:str, epsilon=0.01)->'CheckResult':
         """ Compares expected dictionary with actual dictionary. Useful for comparing the restoring beam.
 
         Args:
             exp_dict (dict): Expected values, as key:value pairs.
                 Keys must match between exp_dict and act_dict.
-                Values are compared between exp_dict and act_dict. A summary
-                line is returned with the first mismatched value, or the last
-                successfully matched value.
+                Values of all the channels are compared at once, the result lists
+                every out-of-tolerance channel and the largest deviation.
 
-            act_dict (dict): [description]
-            suffix (str): Actual values to compare to exp_dict (and just the values).
+            act_dict (dict): Actual values.
+            suffix (str): Name of the check.
             epsilon (float, optional): Allowed variance from fiducial values. Defaults to 0.01.
 
         Returns:
-            [type]: Report detailing results of fiducial checks.
+            CheckResult: Result of the fiducial check, see stk_compare.
         """
-        
 
-        report = ''
-        eps = epsilon
-        passed = True
-        chans = 0
-        for key in exp_dict:
-            result = th.check_val(act_dict[key], exp_dict[key],
-                valname=suffix+' chan'+str(chans), epsilon=eps)[1]
-            chans += 1
-            if 'Fail' in result:
-                passed = False
-                break
-        report += th.check_val(passed, True, valname=suffix+' chan'+str(chans), exact=True)[1]
-
-        return report
+        return compare_beams(exp_dict, act_dict, suffix, epsilon=epsilon)
+
+    def run_tclean(self, **params):
+        """ Run tclean(**params), as channel chunks imaged side by side when local_cube is
+            enabled and the test doesn't run under MPI (see stk_chunked.chunked_tclean).
+
+        Args:
+            **params: tclean parameters.
+
+        Returns:
+            dict: Return value of tclean, None when the cube was imaged in chunks.
+        """
+
+        if self.local_cube.get('enabled', False) and self.parallel == False:
+            workers = self.local_cube.get('workers', 4)
+            if chunked_tclean(params, self.local_cube.get('nchunks') or workers, workers):
+                return None
+
+        return tclean(**params)
+
+    def cached_tclean(self, **params):
+        """ Run tclean(**params), or clone its products from the product cache when enabled.
+
+        Meant for the iter0 (niter=0) runs, whose products only depend on the parameters
+        and the measurement sets. The products of a run are stored in the cache for the
+        next tests with the same parameters.
+
+        Args:
+            **params: tclean parameters.
+
+        Returns:
+            dict: Return value of tclean, None when the products were read from the cache.
+        """
+
+        if self.product_cache == None:
+            return self.run_tclean(**params)
+
+        # chunked products also depend on the chunking code and the number of chunks
+        code = ''
+        if self.local_cube.get('enabled', False) and self.parallel == False:
+            code = inspect.getsource(inspect.getmodule(chunked_tclean)) + json.dumps(self.local_cube, sort_keys=True)
+        key = self.product_cache.key(params, code=code)
+        if self.product_cache.lookup(key, params['imagename']):
+            print('Products of ' + params['imagename'] + ' read from the product cache')
+            return None
+
+        result = self.run_tclean(**params)
+        self.product_cache.store(key, params['imagename'], params)
+
+        return result
 
     def copy_products(self, old_pname:str, new_pname:str, ignore=None):
         """ Function to copy iter0 images to iter1 images (taken from pipeline).
@@ -231,8 +777,24 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             old_pname (str): Old filename
             new_pname (str): New filename.
             ignore (bool, optional): [description]. Defaults to None.
+
+        With copy_products.mode 'clone' in the configuration the files are reflinked where
+        the filesystem supports it and copied otherwise; 'hardlink' also hardlinks the pixel
+        data of the products the restart only reads, see stk_clone.
         """
         
+        copy_config = self.config.get('copy_products') or {}
+        mode = copy_config.get('mode', 'copy')
+        with self.tracer.span('copy_products', old_pname=old_pname, new_pname=new_pname) as span:
+            if mode in ('clone', 'hardlink'):
+                counts = clone_products(old_pname, new_pname, ignore, workers=copy_config.get('workers', 8),
+                    hardlinks=mode == 'hardlink')
+                if self.tracer.enabled:
+                    span.args.update(counts)
+            else:
+                self._copy_products(old_pname, new_pname, ignore)
+
+    def _copy_products(self, old_pname:str, new_pname:str, ignore=None):
         imlist = glob.glob('%s.*' % old_pname)
         imlist = [xx for xx in imlist if ignore is None or ignore not in xx]
         for image_name in imlist:
@@ -240,36 +802,15 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             if image_name == old_pname + '.workdirectory':
                 mkcmd = 'mkdir '+ newname
                 os.system(mkcmd)
-                self.copy_products(os.path.join(image_name, old_pname), \
+                self._copy_products(os.path.join(image_name, old_pname), \
                     os.path.join(newname, new_pname))
             else:
                 shutil.copytree(image_name, newname, symlinks=True)
 
-    def cube_beam_stats(self, image:'CASAImage')->dict:
-        """ Function to return per-channel beam statistics .
-
-        Args:
-            image (CASAImage): Image to analyze.
-
-        Returns:
-            dict: Beam statistics dictionaries.
-        """
-        self._myia.open(image)
-
-        bmin_dict = {}; bmaj_dict = {}; pa_dict = {}
-        beam_dict = self._myia.restoringbeam()['beams']
-        for item in beam_dict.keys():
-            bmin_dict[item] = beam_dict[item]['*0']['minor']['value']
-            bmaj_dict[item] = beam_dict[item]['*0']['major']['value']
-            pa_dict[item] = beam_dict[item]['*0']['positionangle']['value']
-
-        self._myia.close()
-
-        return bmin_dict, bmaj_dict, pa_dict
-
-    def save_dict_to_file(self, topkey:str, indict:str, outfilename:str, appendversion=True, outformat='JSON')->None:
-        """ Function that will save input Python dictionaries to a JSON file (default)
-            or pickle file. topkey will be added as a top key for output (nested) dictionary
+    def save_dict_to_file(self, topkey:str, indict:str, outfilename:str, appendversion=True, outformat='JSON', compress=True)->None:
+        """ Function that will save input Python dictionaries to a JSON file (default),
+            pickle file or columnar file (npz: a JSON header of the scalar values with the
+            per-channel arrays and masks as .npy members). topkey will be added as a top key for output (nested) dictionary
             and indict is stored under the key.
             
             Create a separate file with outfilename if appendversion=True casa version (based on
@@ -280,7 +821,9 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             indict (dict): [description]
             outfilename (str): [description]
             appendversion (bool, optional): [description]. Defaults to True.
-            outformat (str, optional): [description]. Defaults to 'JSON'.
+            outformat (str, optional): 'JSON', 'pickle' or 'npz'. Defaults to 'JSON'.
+            compress (bool, optional): Deflate the npz members; uncompressed members are
+                memory-mapped by load_dict_from_file(). Defaults to True.
         """
         
         try:
@@ -304,11 +847,54 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             with open(outfilename+casaversion+'.pickle', 'wb') as outf:
                 pickle.dump(nestedDict, outf)
         elif outformat== 'JSON':
+            # boolean arrays (masks) are saved bit-packed and run-length encoded
             with open(outfilename+casaversion+'.json', 'w') as outf:
-                json.dump(nestedDict, outf)
+                json.dump(nestedDict, outf, default=encode_json)
+        elif outformat == 'npz':
+            # scalars in a JSON header, per-channel arrays and masks as .npy members
+            save_columnar(nestedDict, outfilename+casaversion+'.npz', compress=compress)
         else:
             print("no saving with format:", outformat)
 
+    def load_dict_from_file(self, filename:str)->dict:
+        """ Load a dictionary saved by save_dict_to_file(), decoding the packed masks of a
+            JSON file back into boolean arrays. Arrays of uncompressed columnar files are
+            memory-mapped.
+
+        Args:
+            filename (str): JSON (.json), pickle or columnar (.npz) file.
+
+        Returns:
+            dict: Saved dictionary.
+        """
+
+        if filename.endswith('.pickle'):
+            with open(filename, 'rb') as inf:
+                return pickle.load(inf)
+
+        if filename.endswith('.npz'):
+            return load_columnar(filename)
+
+        with open(filename) as inf:
+            return json.load(inf, object_hook=decode_json)
+
+    def check_dict_vals(self, exp_dict:dict, act_dict:dict, suffix:str, epsilon=0.01)->list:
+        """ Compares expected dictionary with actual dictionary in a single vectorised pass
+            (see stk_compare.compare_dicts()); per-channel values are compared as arrays and
+            masks packed by save_dict_to_file() are compared in their packed form.
+
+        Args:
+            exp_dict (dict): Expected values, as key:[flag, value] pairs, see compare_dicts().
+            act_dict (dict): Actual values.
+            suffix (str): Name of the image, prefix of the check names.
+            epsilon (float, optional): Allowed variance from fiducial values. Defaults to 0.01.
+
+        Returns:
+            list: CheckResult records of the fiducial checks, to add to a FiducialReport.
+        """
+
+        return compare_dicts(exp_dict, act_dict, suffix, epsilon=epsilon)
+
     def modify_dict(self, output=None, testname=None, parallel=None)->None:
         """ Modified test_dict constructed by casatestutils add_to_dict to include only
             the task commands executed and also add self.parallel value to the dictionary.
@@ -348,177 +934,22 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
         
         return string[string.startswith(prefix) and len(prefix):]
 
-    def image_stats(self, image, fit_region=None, field_regions=None, masks=None):
-        """ function that takes an image file and returns a statistics
-            dictionary
-        """
-        self._myia.open(image)
-        imagename=os.path.basename(image)
-        stats_dict = {}
-
-        statistics = self._myia.statistics()
-        
-        # Return data chunk; transpose to make channel selection easier
-        chunk = numpy.transpose(self._myia.getchunk(dropdeg=True))
-
-        # stats returned for all images
-        im_size = self._myia.boundingbox()['imageShape'].tolist()
-        stats_dict['npts'] = im_size[0]*im_size[1]*im_size[3]
-        stats_dict['npts_unmasked'] = statistics['npts'][0]
-        stats_dict['npts_real'] = numpy.count_nonzero(~numpy.isnan(chunk))
-        stats_dict['freq_bin'] = self._myia.summary()['incr'][3]
-        stats_dict['start'] = float( \
-            statistics['blcf'].split(', ')[3].split('Hz')[0])
-        stats_dict['end'] = float( \
-            statistics['trcf'].split(', ')[3].split('Hz')[0])
-        stats_dict['start_delta'] = stats_dict['start']
-        stats_dict['end_delta'] = stats_dict['end']
-        stats_dict['nchan'] = im_size[3]
-
-
-        # stats returned for all images except .mask
-        if not image.endswith('.mask'):
-            stats_dict['max_val'] = statistics['max'][0]
-            stats_dict['max_val_pos'] = statistics['maxpos'].tolist()
-            max_loc = [stats_dict['max_val_pos'][0], \
-                stats_dict['max_val_pos'][1]]
-            stats_dict['min_val'] = statistics['min'][0]
-            stats_dict['min_val_pos'] = statistics['minpos'].tolist()
-            stats_dict['im_rms'] = statistics['rms'][0]
-
-        # stats returned if a region file is given
-        if fit_region != None:
-            if '_cube' in imagename:
-                if '.pb' in imagename:
-                    fit_region = fit_region + ', range=[%schan,%schan]'\
-                        % (int(im_size[3]/2), int(im_size[3]/2))
-                if '.psf' in imagename:
-
-                    # using chan 1 as first because ia.fitcomponents fits
-                    # every channel if chan=0
-                    fit_regions = [(fit_region + ', range=[%schan,%schan]' \
-                                   % (1, 1)), \
-                                  (fit_region + ', range=[%schan,%schan]' \
-                                   % (int(im_size[3]/2), int(im_size[3]/2))), \
-                                  (fit_region + ', range=[%schan,%schan]' \
-                                   % ((im_size[3]-1), (im_size[3]-1)))]
-                    i = 0
-                    for region in fit_regions:
-                        try:
-                            fit_dict = self._myia.fitcomponents( \
-                                region=region)['results']['component0']
-                            stats_dict['fit_'+str(i)] = [ \
-                                fit_dict['peak']['value'], \
-                                fit_dict['shape']['majoraxis']['value'], \
-                                fit_dict['shape']['minoraxis']['value']]
-                            stats_dict['fit_loc_chan_'+str(i)] = fit_dict['spectrum']['channel']
-                            stats_dict['fit_loc_freq_'+str(i)] = \
-                                fit_dict['spectrum']['frequency']['m0']['value']
-                            stats_dict['fit_pix_'+str(i)] = \
-                                fit_dict['pixelcoords'].tolist()
-                        except KeyError:
-                            stats_dict['fit_'+str(i)] = [1.0, 1.0, 1.0]
-                            stats_dict['fit_loc_chan_'+str(i)] = 1.0
-                            stats_dict['fit_loc_freq_'+str(i)] = 1.0
-                            stats_dict['fit_pix_'+str(i)] = [1.0, 1.0]
-                        i += 1
-                if '.model' in imagename:
-                    fit_region = fit_region
-                if '.model' not in imagename and '.pb' not in imagename and '.psf' not in imagename:
-
-                    # WARN: If max value channel is 0, tool fits all channels
-                    fit_region = fit_region + ', range=[%schan,%schan]' \
-                        % (stats_dict['max_val_pos'][3], \
-                        stats_dict['max_val_pos'][3])
-            if '.psf' in imagename and '_cube' in imagename:
-                stats_dict['regn_sum'] = self._myia.statistics( \
-                    region=fit_regions[1])['sum'][0]
-            else:
-                stats_dict['regn_sum'] = self._myia.statistics( \
-                    region=fit_region)['sum'][0]
-            if ('image' in imagename and 'mosaic_cube_eph' not in imagename) or 'pb' in imagename or ('psf' in imagename and 'cube' not in imagename):
-                try:
-                    fit_dict = self._myia.fitcomponents( \
-                        region=fit_region)['results']['component0']
-                    stats_dict['fit'] = [fit_dict['peak']['value'], \
-                        fit_dict['shape']['majoraxis']['value'], \
-                        fit_dict['shape']['minoraxis']['value']]
-                    stats_dict['fit_loc_chan'] = fit_dict['spectrum']['channel']
-                    stats_dict['fit_loc_freq'] = fit_dict['spectrum']['frequency']['m0']['value']
-                    stats_dict['fit_pix'] = fit_dict['pixelcoords'].tolist()
-                except KeyError:
-                    stats_dict['fit'] = [1.0, 1.0, 1.0]
-                    stats_dict['fit_loc_chan'] = 1.0
-                    stats_dict['fit_loc_freq'] = 1.0
-                    stats_dict['fit_pix'] = [1.0, 1.0]
-
-        # stats returned for .image(.tt0)
-        if 'image' in imagename:
-            commonbeam = self._myia.commonbeam()
-            stats_dict['com_bmin'] = commonbeam['minor']['value']
-            stats_dict['com_bmaj'] = commonbeam['major']['value']
-            stats_dict['com_pa'] = commonbeam['pa']['value']
-            if 'cube' in imagename:
-                stats_dict['rms_per_chan'] = \
-                    self._myia.statistics(axes=[0,1])['rms'].tolist()
-                stats_dict['profile'] = self.cube_profile_fit( \
-                    image, max_loc, stats_dict['nchan'])
-            if 'mosaic' in imagename:
-                stats_dict['rms_per_field'] = []
-                for region in field_regions:
-                    stats_dict['rms_per_field'].append( \
-                        self._myia.statistics(region=region)['rms'][0])
-
-        # stats returned if not .pb(.tt0), .sumwt(.tt0), or .mask
-        # if 'pb' not in image and 'sumwt' not in image and not image.endswith('.mask'):
-        stats_dict['im_sum'] = statistics['sum'][0]
-
-        if image.endswith('.mask'):
-            stats_dict['mask_pix'] = numpy.count_nonzero(chunk)
-            stats_dict['mask_regns'] = scipy.ndimage.label(chunk)[1]
-            stats_dict['mask'] = ~numpy.array(chunk, dtype=bool)
+    def products_stats(self, tasks:dict)->dict:
+        """ Compute the image_stats() of several imaging products side by side.
 
-        if 'pb' in imagename:
-            pb_mask_02 = chunk>0.2
-            pb_mask_05 = chunk>0.5
-            if 'cube' in image:
-                pb_02_list = []
-                pb_05_list = []
-                i = 0
-                for chan in chunk:
-                    pb_02_list.append(numpy.count_nonzero(chan*pb_mask_02[i]))
-                    pb_05_list.append(numpy.count_nonzero(chan*pb_mask_05[i]))
-                    i += 1
-                stats_dict['npts_0.2'] = pb_02_list
-                stats_dict['npts_0.5'] = pb_05_list
-            else:
-                stats_dict['npts_0.2'] = numpy.count_nonzero(pb_mask_02)
-                stats_dict['npts_0.5'] = numpy.count_nonzero(pb_mask_05)
-            if 'mosaic' in imagename:
-                stats_dict['pb_mask_0.2'] = pb_mask_02
-                stats_dict['pb_mask_0.5'] = pb_mask_05
-
-        if 'model' in imagename or image.endswith('.alpha'):
-            stats_dict['mask_non0'] = numpy.count_nonzero(chunk*masks)
-
-        if 'weight' in imagename:
-            if 'cube' in imagename:
-                wt_02_list = []
-                wt_05_list = []
-                i = 0
-                for chan in chunk:
-                    wt_02_list.append(numpy.count_nonzero(chan*masks[0][i]))
-                    wt_05_list.append(numpy.count_nonzero(chan*masks[1][i]))
-                    i += 1
-                stats_dict['npts_0.2'] = wt_02_list
-                stats_dict['npts_0.5'] = wt_05_list
-            else:
-                stats_dict['npts_0.2'] = numpy.count_nonzero(chunk*masks[0])
-                stats_dict['npts_0.5'] = numpy.count_nonzero(chunk*masks[1])
+        Args:
+            tasks (dict): Product name -> image_stats() arguments, masks given as
+                (product name, key or list of keys) of the statistics of another product,
+                see stk_report.run_stats_tasks().
 
-        self._myia.close()
+        Returns:
+            dict: Product name -> statistics dictionary.
+        """
 
-        return stats_dict
+        # Like the component fits, the products are computed in the test process under MPI
+        workers = 0 if self.parallel else self.stats_config.get('report_workers', 0)
+        with self.tracer.span('products_stats', workers=workers):
+            return run_stats_tasks(self, tasks, workers=workers)
 
     def image_list(self, image, mode):
         """ function used to return expected imaging output files """
@@ -554,32 +985,17 @@ class test_stakeholder_base(unittest.TestCase, stakeholder_baseclass_template):
             out = {'file': image+'.moment8.png'})
         subprocess.call('mogrify -trim '+image+'.moment8.png', shell=True)
 
-    def cube_profile_fit(self, image, max_loc, nchan):
-        """ function that will retrieve a profile for cubes at the max position
-            and create a png showing the profile plot; must be called with
-            image already opened
-        """
-        
-        pyplot.clf()
-        
-        box = str(max_loc[0])+','+str(max_loc[1])+','+str(max_loc[0])+','+str(max_loc[1])
-        profile = self._myia.fitprofile(box=box)['gs']['amp'][0][0][0][0][0]
-        
-        X = self._myia.getchunk(blc=max_loc, trc=max_loc, axes=[0,1])[0][0][0]
-        
-        pyplot.title('Frequency Profile at Max Value Position')
-        pyplot.xlabel('Channel Number')
-        pyplot.xlim(0,(nchan+1))
-        pyplot.ylabel('Amplitude (Jy/Beam)')
-        pyplot.plot(X)
-        pyplot.savefig(image+'.profile.png')
-        pyplot.clf()
+    def filter_report(self, report, showonlyfail=True):
+        """ function to filter the test report, the input report is expected to be a FiducialReport
+            or a string with the newline code """
 
-        return profile
+        if isinstance(report, FiducialReport):
+            results = report.failures() if showonlyfail else \
+                [result for result in report.results if result.passed]
+            nfail = report.nfail if showonlyfail else len(results)
+            msg = str(nfail)+' individual test failure(s) '
+            return '\n' + ''.join(result.render() for result in results) + msg
 
-    def filter_report(self, report, showonlyfail=True):
-        """ function to filter the test report, the input report is expected to be a string with the newline code """
-        
         ret = ''
         if showonlyfail:
             filter='Fail'
@@ -0,0 +1,96 @@
+##########################################################################
+##########################################################################
+# stk_beam.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import numpy
+
+# Per-channel restoring beam: major and minor axes, position angle
+beam_dtype = numpy.dtype([('major', numpy.float64), ('minor', numpy.float64), ('pa', numpy.float64)])
+
+class BeamTable():
+    """ Per-channel restoring beams of a cube as a numpy structured array.
+
+        table = BeamTable.from_restoringbeam(ia.restoringbeam())
+        table.beams['major']            # numpy array, one value per channel
+        table.units['major']            # 'arcsec'
+        bmin_dict, bmaj_dict, pa_dict = table.to_dicts()
+    """
+
+    def __init__(self, beams:numpy.ndarray, units=None):
+        """
+        Args:
+            beams (numpy.ndarray): Structured array of beam_dtype, one element per channel.
+            units (dict, optional): Units of the major, minor and pa fields. Defaults to None.
+        """
+
+        self.beams = beams
+        self.units = units or {}
+
+    def __len__(self):
+        return len(self.beams)
+
+    @classmethod
+    def from_restoringbeam(cls, restoringbeam:dict):
+        """ Build the table from ia.restoringbeam() (per-plane beams, first Stokes plane).
+
+        Args:
+            restoringbeam (dict): Result of ia.restoringbeam(), with a 'beams' record
+                {'*<chan>': {'*<stokes>': beam}} for cubes, or a single beam.
+        """
+
+        if 'beams' in restoringbeam:
+            beams = restoringbeam['beams']
+            planes = [beams[key]['*0'] for key in sorted(beams, key=lambda key: int(key[1:]))]
+        else:
+            planes = [restoringbeam]
+
+        fields = {'major':'major', 'minor':'minor', 'pa':'positionangle'}
+        table = numpy.empty(len(planes), dtype=beam_dtype)
+        units = {}
+        for field, name in fields.items():
+            table[field] = numpy.fromiter((plane[name]['value'] for plane in planes), dtype=numpy.float64, count=len(planes))
+            plane_units = set(plane[name]['unit'] for plane in planes)
+            if len(plane_units) > 1:
+                raise ValueError('Channels have beams in different units: ' + str(sorted(plane_units)))
+            units[field] = plane_units.pop() if len(plane_units) > 0 else ''
+
+        return cls(table, units)
+
+    @classmethod
+    def from_dicts(cls, bmin_dict:dict, bmaj_dict:dict, pa_dict:dict, units=None):
+        """ Build the table from the per-channel dictionaries of cube_beam_stats(). """
+
+        keys = sorted(bmaj_dict, key=lambda key: int(key[1:]))
+        table = numpy.empty(len(keys), dtype=beam_dtype)
+        for field, values in [('major', bmaj_dict), ('minor', bmin_dict), ('pa', pa_dict)]:
+            table[field] = numpy.fromiter((values[key] for key in keys), dtype=numpy.float64, count=len(keys))
+
+        return cls(table, units)
+
+    def to_dicts(self)->tuple:
+        """ Return the per-channel dictionaries {'*<chan>': value} of minor, major and pa,
+            as returned by cube_beam_stats().
+        """
+
+        keys = ['*' + str(chan) for chan in range(len(self.beams))]
+
+        return tuple(dict(zip(keys, self.beams[field].tolist())) for field in ['minor', 'major', 'pa'])
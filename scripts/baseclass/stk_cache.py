@@ -0,0 +1,198 @@
+##########################################################################
+##########################################################################
+# stk_cache.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import glob
+import pickle
+import hashlib
+import tempfile
+import numpy
+
+from scripts.baseclass.stk_mask import BitMask
+
+# Bumped when the layout of the cached statistics changes
+_cache_version = 1
+
+def _update_digest(sha, value)->None:
+    """ Add an argument value (None, str, number, numpy array, BitMask or list of them) to a
+        digest. """
+
+    if isinstance(value, BitMask):
+        # The default repr of a BitMask holds its address, digest its content
+        sha.update(str(('BitMask', value.nchan, value.plane_shape, value.shape)).encode())
+        sha.update(numpy.ascontiguousarray(value.bits).tobytes())
+    elif isinstance(value, numpy.ndarray):
+        sha.update(str((value.shape, value.dtype.str)).encode())
+        data = numpy.packbits(value) if value.dtype == bool else numpy.ascontiguousarray(value)
+        sha.update(data.tobytes())
+    elif isinstance(value, (list, tuple)):
+        sha.update(('%s[%d]' % (type(value).__name__, len(value))).encode())
+        for item in value:
+            _update_digest(sha, item)
+    else:
+        sha.update(repr(value).encode())
+
+def table_fingerprint(path:str)->str:
+    """ Return a digest of the relative names, sizes and modification times of the files
+        of a CASA table (image, measurement set, ...) or of a file, except the table locks.
+    """
+
+    sha = hashlib.sha256()
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        sha.update(str((stat.st_size, stat.st_mtime_ns)).encode())
+        return sha.hexdigest()
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            # Table locks are rewritten whenever the table is opened, even read-only
+            if name.endswith('.lock'):
+                continue
+            filename = os.path.join(root, name)
+            stat = os.stat(filename)
+            sha.update(str((os.path.relpath(filename, path), stat.st_size, stat.st_mtime_ns)).encode())
+
+    return sha.hexdigest()
+
+class StatsCache():
+    """ On-disk cache of the statistics dictionaries of image_stats() and cube_beam_stats().
+
+    The key of an entry combines the name of the image, a fingerprint of its table (the
+    relative names, sizes and modification times of the files of the image directory but
+    the table locks),
+    the arguments of the call, including mask arrays, and the code computing the statistics.
+    Re-running the report of a test on unchanged images then reads the statistics back
+    instead of recomputing them from the image tables.
+
+    Entries are pickle files in cache_dir. A lookup refreshes the modification time of the
+    entry, and entries are evicted least recently used first once they take more than
+    max_mbytes.
+    """
+
+    def __init__(self, cache_dir:str, max_mbytes=1024, sources=None):
+        """
+        Args:
+            cache_dir (str): Directory of the cache entries.
+            max_mbytes (int, optional): Size limit of the cache. Defaults to 1024.
+            sources (list, optional): Files of the code computing the statistics, changing
+                any of them invalidates the entries. Defaults to the baseclass modules.
+        """
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mbytes*1024*1024
+
+        if sources == None:
+            sources = sorted(glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), '*.py')))
+
+        sha = hashlib.sha256(str(_cache_version).encode())
+        for source in sources:
+            with open(source, 'rb') as file:
+                sha.update(file.read())
+        self._code_digest = sha.hexdigest()
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fingerprint(self, image:str)->str:
+        """ Return a digest of the relative names, sizes and modification times of the files
+            of an image (a CASA image is a directory of table files), except table.lock.
+        """
+
+        return table_fingerprint(image)
+
+    def key(self, function:str, image:str, **args)->str:
+        """ Compute the key of the statistics of function(image, **args). """
+
+        sha = hashlib.sha256()
+        sha.update(self._code_digest.encode())
+        sha.update(function.encode())
+        sha.update(os.path.basename(os.path.normpath(image)).encode())
+        sha.update(self.fingerprint(image).encode())
+        for name in sorted(args):
+            sha.update(name.encode())
+            _update_digest(sha, args[name])
+
+        return sha.hexdigest()
+
+    def _entry(self, key:str)->str:
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def lookup(self, key:str, image:str):
+        """ Return the cached statistics of key, or None.
+
+            Files saved with the statistics (see store()) are written back next to image.
+        """
+
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as file:
+                cached = pickle.load(file)
+            os.utime(entry)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        for suffix, data in cached['files'].items():
+            with open(image + suffix, 'wb') as file:
+                file.write(data)
+
+        return cached['value']
+
+    def store(self, key:str, value, image:str, suffixes=None)->None:
+        """ Save the statistics of key, with the files image+suffix that were written while
+            computing them (e.g. the profile plot of a cube), then evict old entries.
+        """
+
+        files = {}
+        for suffix in suffixes or []:
+            if os.path.isfile(image + suffix):
+                with open(image + suffix, 'rb') as file:
+                    files[suffix] = file.read()
+
+        # Entries can be written concurrently by the report workers, replace them atomically
+        fd, tmpname = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump({'value':value, 'files':files}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, self._entry(key))
+
+        self.evict()
+
+    def evict(self)->None:
+        """ Remove the least recently used entries until the cache fits in max_mbytes. """
+
+        entries = []
+        for entry in glob.glob(os.path.join(self.cache_dir, '*.pickle')):
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,157 @@
+##########################################################################
+##########################################################################
+# stk_checkpoint.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import glob
+import json
+import time
+import hashlib
+import tempfile
+
+from scripts.baseclass.stk_cache import table_fingerprint
+
+# Bumped when the layout of the manifest changes
+_manifest_version = 1
+
+# Products written by tclean for an imagename
+_tclean_products = ('psf', 'residual', 'image', 'image.pbcor', 'model', 'mask', 'pb', 'sumwt',
+    'weight', 'alpha', 'alpha.error', 'beta', 'workdirectory', 'chunks')
+
+def tclean_products(pname:str)->list:
+    """ Return glob patterns of the tclean products of imagename pname (also the .ttN
+        Taylor terms of mtmfs), leaving out the files derived from them (.moment8, ...). """
+
+    patterns = []
+    for product in _tclean_products:
+        patterns += [pname + '.' + product, pname + '.' + product + '.tt[0-9]*']
+    return patterns
+
+def _expand(patterns:list)->list:
+    """ Return the sorted files and directories matching glob patterns. """
+
+    paths = set()
+    for pattern in patterns:
+        paths.update(glob.glob(pattern))
+    return sorted(paths)
+
+def _fingerprints(paths:list)->dict:
+    return {path:table_fingerprint(path) for path in paths if os.path.exists(path)}
+
+class Checkpoints():
+    """ Checkpoint manifest of the stages of a test (tclean iter0, copy_products, ...).
+
+    When a stage completes, the fingerprints (see stk_cache.table_fingerprint) of its
+    inputs and outputs and a digest of its code are recorded in the manifest file.
+    With resume, a stage is skipped when it completed in a previous run with the same
+    code, its inputs produced outside the test (the measurement sets) are unchanged and
+    its outputs are still as the last completed stage left them. Since each stage builds
+    on the previous ones, once a stage runs all the stages after it run as well.
+
+    Usage:
+        if self.checkpoints.skip('tclean iter0', tclean_products(name), inputs=[msfile]) is False:
+            tclean(...)
+            self.checkpoints.done('tclean iter0')
+    """
+
+    def __init__(self, manifest_file:str, resume=False):
+        """
+        Args:
+            manifest_file (str): Manifest file of the test.
+            resume (bool, optional): Skip the stages completed by a previous run. Defaults to False.
+        """
+
+        self.manifest_file = manifest_file
+        self.resume = resume
+        self._running = False
+        self._pending = {}
+
+        self.manifest = {'version':_manifest_version, 'stages':{}, 'files':{}}
+        try:
+            with open(manifest_file) as file:
+                manifest = json.load(file)
+            if manifest.get('version') == _manifest_version:
+                self.manifest = manifest
+        except (OSError, ValueError):
+            pass
+
+    def _valid(self, name:str, code:str)->bool:
+        stage = self.manifest['stages'].get(name)
+        if stage == None or stage['code'] != code:
+            return False
+
+        files = self.manifest['files']
+        for path, fingerprint in stage['inputs'].items():
+            # Inputs written by the stages of the test are checked as their outputs
+            if path in files:
+                continue
+            if os.path.exists(path) is False or table_fingerprint(path) != fingerprint:
+                return False
+
+        for path in stage['outputs']:
+            if os.path.exists(path) is False or files.get(path) != table_fingerprint(path):
+                return False
+
+        return len(stage['outputs']) > 0
+
+    def skip(self, name:str, outputs:list, inputs=None, code=None)->bool:
+        """ Return whether stage name can be skipped, otherwise record its inputs before it runs.
+
+        Args:
+            name (str): Name of the stage.
+            outputs (list): Glob patterns of the files and directories the stage writes.
+            inputs (list, optional): Glob patterns of the files and directories the stage reads. Defaults to None.
+            code (str, optional): Code of the stage (e.g. inspect.getsource() of the method
+                running it); a change runs the stage again. Defaults to None.
+
+        Returns:
+            bool: True if the stage doesn't need to run.
+        """
+
+        code = hashlib.sha256(str(code).encode()).hexdigest()
+
+        if self.resume and self._running is False and self._valid(name, code):
+            print('Skipping stage ' + name + ', its outputs are up to date (checkpoint)')
+            return True
+
+        self._running = True
+        self._pending[name] = {'code':code, 'outputs_patterns':list(outputs),
+            'inputs':_fingerprints(_expand(inputs or []))}
+
+        return False
+
+    def done(self, name:str)->None:
+        """ Record the completion of stage name in the manifest. """
+
+        pending = self._pending.pop(name)
+        outputs = _fingerprints(_expand(pending['outputs_patterns']))
+
+        self.manifest['stages'][name] = {'code':pending['code'], 'inputs':pending['inputs'],
+            'outputs':sorted(outputs), 'time':time.time()}
+        self.manifest['files'].update(outputs)
+
+        # Replace the manifest atomically, an interrupted run leaves the previous one
+        dirname = os.path.dirname(os.path.abspath(self.manifest_file))
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'w') as outf:
+            json.dump(self.manifest, outf, indent=2)
+        os.replace(tmpname, self.manifest_file)
@@ -0,0 +1,194 @@
+##########################################################################
+##########################################################################
+# stk_chunked.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import glob
+import shutil
+import multiprocessing
+import concurrent.futures
+
+from casatools import image, quanta
+
+_qa = quanta()
+
+# Directory of the channel chunks of an imagename, copied along with the products
+# by copy_products() so that the restart finds the products of each chunk
+_chunks_suffix = '.chunks'
+
+def _run_chunk(params:dict):
+    """ Run tclean on one channel chunk in a worker process. """
+
+    # Imported here, each worker process loads its own imager
+    from casatasks import tclean
+
+    return tclean(**params)
+
+def _frequency(value):
+    """ Return a frequency parameter ('220.25GHz') in Hz, or None for channel indices,
+        velocities or defaults, which aren't split. """
+
+    if isinstance(value, str) is False or value.strip() == '':
+        return None
+
+    quantity = _qa.quantity(value)
+    if _qa.compare(quantity, _qa.quantity('1Hz')) is False:
+        return None
+
+    return _qa.convert(quantity, 'Hz')['value']
+
+def channel_chunks(nchan:int, start:str, width:str, nchunks:int)->list:
+    """ Split a cube of nchan channels of width from start into consecutive channel ranges.
+
+    Args:
+        nchan (int): Number of channels.
+        start (str): Frequency of the first channel, e.g. '220.2526743594GHz'.
+        width (str): Channel width, e.g. '0.2441741MHz'.
+        nchunks (int): Number of ranges.
+
+    Returns:
+        list: (nchan, start) of the ranges, start in Hz as a string, or None if the cube
+            isn't defined by frequencies.
+    """
+
+    start_hz, width_hz = _frequency(start), _frequency(width)
+    if start_hz == None or width_hz == None or nchan < 2:
+        return None
+
+    nchunks = max(1, min(nchunks, nchan))
+    chunks = []
+    chan0 = 0
+    for i in range(nchunks):
+        # Spread the remainder over the first chunks
+        chunk_nchan = nchan//nchunks + (1 if i < nchan % nchunks else 0)
+        chunks.append((chunk_nchan, '{:.6f}Hz'.format(start_hz + chan0*width_hz)))
+        chan0 += chunk_nchan
+
+    return chunks
+
+def _concat_products(chunk_names:list, imagename:str)->None:
+    """ Concatenate the products of the chunks along the spectral axis into imagename.*. """
+
+    ia = image()
+    prefix = os.path.basename(chunk_names[0]) + '.'
+    for product_name in sorted(glob.glob(chunk_names[0] + '.*')):
+        product = os.path.basename(product_name)[len(prefix):]
+        infiles = [name + '.' + product for name in chunk_names]
+        if all(os.path.isdir(infile) for infile in infiles) is False:
+            continue
+
+        outfile = imagename + '.' + product
+        if os.path.exists(outfile):
+            shutil.rmtree(outfile)
+
+        concat = ia.imageconcat(outfile=outfile, infiles=infiles, axis=-1, relax=True,
+            tempclose=False, overwrite=True)
+        concat.done()
+
+    ia.done()
+
+def chunkable(params:dict)->bool:
+    """ Whether the cube of tclean(**params) can be imaged as independent channel chunks.
+
+        The weights of a chunk must not depend on the other channels: briggsbwtaper scales
+        them with the fractional bandwidth of the whole cube, and without
+        perchanweightdensity the weight density is gridded over all the channels. Also
+        used by stakeholder_test.py to reserve the cores of the chunks.
+
+    Args:
+        params (dict): tclean parameters.
+
+    Returns:
+        bool: False if the cube must be imaged whole.
+    """
+
+    if params.get('specmode', 'mfs') != 'cube' or params.get('parallel', False):
+        return False
+
+    nchan = params.get('nchan', -1)
+    if isinstance(nchan, int) is False or nchan < 2:
+        return False
+
+    weighting = params.get('weighting', 'natural')
+    if weighting == 'briggsbwtaper' or (weighting not in ('natural', 'radial') and not params.get('perchanweightdensity', True)):
+        return False
+
+    return True
+
+def chunked_tclean(params:dict, nchunks:int, workers:int):
+    """ Run a cube tclean as side by side tclean runs over consecutive channel ranges.
+
+    The channel ranges are imaged as <imagename>.chunks/c<i> by workers processes and their
+    products are concatenated along the spectral axis into the <imagename>.* products.
+    A restart (restart=True, calcpsf=False, calcres=False) continues from the products of
+    the chunks, as copied by copy_products() from the previous run. When the products are
+    restored, the chunks are imaged without restoration, which then runs on the
+    concatenated products so that a common restoring beam is over all channels. The
+    per-channel beams of the .psf are those fitted by each chunk, as in a serial run.
+
+    Args:
+        params (dict): tclean parameters of a cube (specmode='cube', frequency start and width).
+        nchunks (int): Number of channel ranges.
+        workers (int): Number of tclean processes.
+
+    Returns:
+        bool: True if the cube was imaged in chunks, False if it can't be split, e.g. with
+            weights depending on the whole cube (the caller then runs tclean itself).
+    """
+
+    if chunkable(params) is False:
+        return False
+
+    chunks = channel_chunks(params.get('nchan', -1), params.get('start', ''), params.get('width', ''), nchunks)
+    if chunks == None or len(chunks) < 2:
+        return False
+
+    imagename = params['imagename']
+    chunk_dir = imagename + _chunks_suffix
+    chunk_names = [os.path.join(chunk_dir, 'c{}'.format(i)) for i in range(len(chunks))]
+
+    restart = params.get('restart', False) and not params.get('calcpsf', True) and not params.get('calcres', True)
+    if restart and all(os.path.isdir(name + '.psf') for name in chunk_names) is False:
+        print('No channel chunks to restart from in ' + chunk_dir)
+        return False
+
+    os.makedirs(chunk_dir, exist_ok=True)
+
+    restore = params.get('restoration', True)
+    chunk_params = []
+    for name, (chunk_nchan, chunk_start) in zip(chunk_names, chunks):
+        chunk_params.append(dict(params, imagename=name, nchan=chunk_nchan, start=chunk_start,
+            restoration=False, pbcor=False))
+
+    print('Imaging {} in {} channel chunks'.format(imagename, len(chunks)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, min(workers, len(chunks))),
+        mp_context=multiprocessing.get_context('spawn')) as executor:
+        list(executor.map(_run_chunk, chunk_params))
+
+    _concat_products(chunk_names, imagename)
+
+    if restore:
+        # Restoration only, with the common beam of all the channels
+        from casatasks import tclean
+        tclean(**dict(params, niter=0, restart=True, calcpsf=False, calcres=False))
+
+    return True
@@ -0,0 +1,173 @@
+##########################################################################
+##########################################################################
+# stk_clone.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import glob
+import fcntl
+import shutil
+import concurrent.futures
+
+# ioctl(dest, FICLONE, src) shares the extents of src with dest (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+# Products the restart tclean (calcpsf=False, calcres=False) reads but doesn't rewrite
+readonly_products = ('psf', 'sumwt', 'pb', 'weight')
+
+def _is_bulk_file(filename:str)->bool:
+    """ Whether a file of an image table holds pixel data (table.f0, table.f0_TSM0, ...),
+        as opposed to the table description, keywords and lock files, which CASA may
+        rewrite when it merely opens an image. """
+
+    return os.path.basename(filename).startswith('table.f')
+
+def reflink(src:str, dst:str)->bool:
+    """ Clone src to dst sharing its data blocks (copy-on-write).
+
+    Args:
+        src (str): Source file.
+        dst (str): Destination file, created.
+
+    Returns:
+        bool: True if the file was cloned, False if the filesystem doesn't support it.
+    """
+
+    try:
+        with open(src, 'rb') as inf, open(dst, 'wb') as outf:
+            fcntl.ioctl(outf.fileno(), _FICLONE, inf.fileno())
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+    shutil.copystat(src, dst)
+    return True
+
+def clone_file(src:str, dst:str, readonly=False)->str:
+    """ Copy src to dst as cheaply as the filesystem allows.
+
+    Files are reflinked where supported. Otherwise bulk pixel files of a read only product
+    are hardlinked, and everything else is copied.
+
+    Args:
+        src (str): Source file.
+        dst (str): Destination file.
+        readonly (bool, optional): Whether neither src nor dst is ever written to, so that
+            they may share the file. Defaults to False.
+
+    Returns:
+        str: How the file was copied, 'reflink', 'hardlink' or 'copy'.
+    """
+
+    if reflink(src, dst):
+        return 'reflink'
+
+    if readonly and _is_bulk_file(src):
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def _is_readonly(image_name:str, old_pname:str)->bool:
+    """ Whether an image named <old_pname>.<product> (psf, n1.pb, psf.tt0, ...) is one of
+        the readonly_products. """
+
+    product = os.path.basename(image_name)[len(os.path.basename(old_pname)) + 1:]
+    return any(part in readonly_products for part in product.split('.'))
+
+def _clone_jobs(old_pname:str, new_pname:str, ignore=None)->list:
+    """ Create the directories of the copies of the <old_pname>.* products and return the
+        (src, dst, readonly) files to copy. """
+
+    jobs = []
+    imlist = glob.glob('%s.*' % old_pname)
+    imlist = [xx for xx in imlist if ignore is None or ignore not in xx]
+    for image_name in imlist:
+        newname = image_name.replace(old_pname, new_pname)
+        if image_name == old_pname + '.workdirectory':
+            os.makedirs(newname, exist_ok=True)
+            jobs += _clone_jobs(os.path.join(image_name, os.path.basename(old_pname)), \
+                os.path.join(newname, os.path.basename(new_pname)))
+            continue
+
+        readonly = _is_readonly(image_name, old_pname)
+        if os.path.isdir(image_name) is False:
+            jobs.append((image_name, newname, readonly))
+            continue
+
+        for dirpath, dirnames, filenames in os.walk(image_name):
+            outdir = os.path.join(newname, os.path.relpath(dirpath, image_name))
+            os.makedirs(outdir, exist_ok=True)
+            for filename in filenames:
+                src = os.path.join(dirpath, filename)
+                dst = os.path.join(outdir, filename)
+                if os.path.islink(src):
+                    os.symlink(os.readlink(src), dst)
+                else:
+                    # Subtables (logtable, ...) get history rows appended, even to read images
+                    jobs.append((src, dst, readonly and dirpath == image_name))
+            # Symbolic links to directories are kept as links, as copytree(symlinks=True)
+            for dirname in list(dirnames):
+                if os.path.islink(os.path.join(dirpath, dirname)):
+                    os.symlink(os.readlink(os.path.join(dirpath, dirname)), os.path.join(outdir, dirname))
+                    dirnames.remove(dirname)
+
+    return jobs
+
+def clone_products(old_pname:str, new_pname:str, ignore=None, workers=8, hardlinks=False)->dict:
+    """ Copy the <old_pname>.* imaging products (and those of <old_pname>.workdirectory)
+        to <new_pname>.* with clone_file().
+
+        Files are reflinked, or copied where the filesystem doesn't support it. A hardlinked
+        pixel file is shared by both products: rewriting it in place (e.g. a later tclean
+        run on <old_pname> with calcpsf=True) changes the other product too, so hardlinks
+        are only made when asked for.
+
+    Args:
+        old_pname (str): Old filename.
+        new_pname (str): New filename.
+        ignore (str, optional): Skip the products whose name contains it. Defaults to None.
+        workers (int, optional): Number of threads copying files. Defaults to 8.
+        hardlinks (bool, optional): Hardlink the pixel files of the readonly_products
+            that can't be reflinked. Defaults to False.
+
+    Returns:
+        dict: Number of files copied each way ('reflink', 'hardlink', 'copy').
+    """
+
+    jobs = [(src, dst, readonly and hardlinks) for src, dst, readonly in _clone_jobs(old_pname, new_pname, ignore)]
+
+    counts = {'reflink':0, 'hardlink':0, 'copy':0}
+    if workers > 1 and len(jobs) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda job: clone_file(*job), jobs))
+    else:
+        results = [clone_file(*job) for job in jobs]
+
+    for how in results:
+        counts[how] += 1
+
+    return counts
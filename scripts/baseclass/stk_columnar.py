@@ -0,0 +1,207 @@
+##########################################################################
+##########################################################################
+# stk_columnar.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import json
+import numbers
+import zipfile
+import numpy
+
+from scripts.baseclass.stk_mask import BitMask, encode_json
+
+# Name of the JSON header member
+_header_name = 'header.json'
+
+# Numeric lists at least this long are stored as arrays
+_min_array_length = 16
+
+def _is_chan_dict(value)->bool:
+    """ True for per-channel dictionaries {'*0': number, '*1': number, ...} (beam dicts). """
+
+    return isinstance(value, dict) and len(value) >= _min_array_length \
+        and all(key == '*' + str(i) for i, key in enumerate(value)) \
+        and all(isinstance(v, numbers.Number) for v in value.values())
+
+def _is_numeric_list(value)->bool:
+    return isinstance(value, list) and len(value) >= _min_array_length \
+        and all(isinstance(v, numbers.Number) and not isinstance(v, bool) for v in value)
+
+class ColumnarWriter():
+    """ Streaming writer of the columnar metric format.
+
+    The file is a zip archive (like .npz): every array is written as a .npy member as soon
+    as it is added, and the remaining (scalar) values make up a JSON header member written
+    when the writer is closed, in which arrays are referenced by member name:
+
+        with ColumnarWriter('test_cur_stats.npz') as writer:
+            writer.add_dict(nested_dict)
+
+    Members are deflated when compress is set; stored (uncompressed) members can be memory
+    mapped by load_columnar(). The archive is written to <filename>.tmp and renamed to
+    filename once complete, so a failed write never leaves a truncated file behind.
+    """
+
+    def __init__(self, filename:str, compress=True):
+        self.filename = filename
+        self.header = {}
+        self._tmpname = filename + '.tmp'
+        self._zip = zipfile.ZipFile(self._tmpname, 'w',
+            compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED, allowZip64=True)
+        self._narrays = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type != None:
+            self.abort()
+        else:
+            self.close()
+        return False
+
+    def _write_array(self, array:numpy.ndarray)->str:
+        name = 'a%d.npy' % self._narrays
+        self._narrays += 1
+        with self._zip.open(name, 'w', force_zip64=True) as member:
+            numpy.lib.format.write_array(member, numpy.ascontiguousarray(array), allow_pickle=False)
+
+        return name
+
+    def encode(self, value):
+        """ Write the arrays of value and return its header entry. """
+
+        if isinstance(value, BitMask) or (isinstance(value, numpy.ndarray) and value.dtype == bool):
+            mask = value.to_array() if isinstance(value, BitMask) else value
+            return {'__array__':self._write_array(numpy.packbits(mask.ravel())), 'kind':'mask', 'shape':list(mask.shape)}
+        if isinstance(value, numpy.ndarray):
+            return {'__array__':self._write_array(value), 'kind':'ndarray'}
+        if _is_numeric_list(value):
+            return {'__array__':self._write_array(numpy.asarray(value)), 'kind':'list'}
+        if _is_chan_dict(value):
+            return {'__array__':self._write_array(numpy.fromiter(value.values(), dtype=numpy.float64, count=len(value))),
+                'kind':'chan_dict'}
+        if isinstance(value, dict):
+            return {key:self.encode(item) for key, item in value.items()}
+        if isinstance(value, numpy.generic):
+            return value.item()
+
+        return value
+
+    def add(self, key:str, value)->None:
+        """ Add a top level entry, writing its arrays right away. """
+
+        self.header[key] = self.encode(value)
+
+    def add_dict(self, indict:dict)->None:
+        """ Add all the entries of a dictionary. """
+
+        for key, value in indict.items():
+            self.add(key, value)
+
+    def close(self)->None:
+        """ Write the header, close the archive and move it to filename. """
+
+        if self._zip == None:
+            return
+
+        try:
+            self._zip.writestr(_header_name, json.dumps(self.header, default=encode_json))
+            self._zip.close()
+            self._zip = None
+            os.replace(self._tmpname, self.filename)
+        except BaseException:
+            self.abort()
+            raise
+
+    def abort(self)->None:
+        """ Close the archive and remove it, leaving filename untouched. """
+
+        if self._zip != None:
+            try:
+                self._zip.close()
+            except (OSError, ValueError):
+                pass
+            self._zip = None
+
+        try:
+            os.remove(self._tmpname)
+        except OSError:
+            pass
+
+def save_columnar(indict:dict, filename:str, compress=True)->None:
+    """ Save a nested metric dictionary in the columnar format (see ColumnarWriter). """
+
+    with ColumnarWriter(filename, compress=compress) as writer:
+        writer.add_dict(indict)
+
+def _member_array(archive:zipfile.ZipFile, filename:str, name:str, mmap:bool)->numpy.ndarray:
+    info = archive.getinfo(name)
+    if mmap and info.compress_type == zipfile.ZIP_STORED:
+        # Offset of the member data: local file header (30 bytes), name and extra field
+        with open(filename, 'rb') as file:
+            file.seek(info.header_offset)
+            local = file.read(30)
+            data_offset = info.header_offset + 30 + int.from_bytes(local[26:28], 'little') \
+                + int.from_bytes(local[28:30], 'little')
+            file.seek(data_offset)
+            version = numpy.lib.format.read_magic(file)
+            read_header = numpy.lib.format.read_array_header_1_0 if version == (1, 0) \
+                else numpy.lib.format.read_array_header_2_0
+            shape, fortran_order, dtype = read_header(file)
+            offset = file.tell()
+        return numpy.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+            order='F' if fortran_order else 'C')
+
+    with archive.open(name) as member:
+        return numpy.lib.format.read_array(member, allow_pickle=False)
+
+def load_columnar(filename:str, mmap=True)->dict:
+    """ Load a file written by save_columnar().
+
+    Args:
+        filename (str): Columnar (.npz) file.
+        mmap (bool, optional): Memory-map the arrays of uncompressed files. Defaults to True.
+
+    Returns:
+        dict: Nested dictionary; per-channel lists are returned as numpy arrays, beam
+            dictionaries as dictionaries and masks as boolean arrays.
+    """
+
+    with zipfile.ZipFile(filename) as archive:
+        header = json.loads(archive.read(_header_name))
+
+        def decode(value):
+            if not isinstance(value, dict):
+                return value
+            if '__array__' not in value:
+                return {key:decode(item) for key, item in value.items()}
+
+            array = _member_array(archive, filename, value['__array__'], mmap)
+            if value['kind'] == 'mask':
+                npix = int(numpy.prod(value['shape']))
+                return numpy.unpackbits(array, count=npix).astype(bool).reshape(value['shape'])
+            if value['kind'] == 'chan_dict':
+                return {'*' + str(i):v for i, v in enumerate(array.tolist())}
+            return array
+
+        return decode(header)
@@ -0,0 +1,256 @@
+##########################################################################
+##########################################################################
+# stk_compare.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import numpy
+
+from scripts.baseclass.stk_mask import is_packed_mask, mask_difference
+from scripts.baseclass.stk_beam import BeamTable
+
+class CheckResult():
+    """ Result of the comparison of a value, or of an array of values, with its fiducial.
+
+    Attributes:
+        name (str): Name of the check, e.g. '.image rms_per_chan'.
+        passed (bool): True if the value (all the elements of the array) is within tolerance.
+        value: Actual value (for arrays, the first failing element or the last element).
+        expected: Fiducial value (same element as value).
+        failures (list): Indices of the out-of-tolerance elements of an array check.
+        max_deviation (float): Largest relative deviation of a numeric check, None otherwise.
+        tag (str): Check type shown in the report ('check_val', 'check_ims', ...).
+        text (str): Report text of checks done by other tools (th.checkall), else None.
+    """
+
+    __slots__ = ('name', 'passed', 'value', 'expected', 'failures', 'max_deviation', 'tag', 'text')
+
+    def __init__(self, name:str, passed:bool, value=None, expected=None, failures=None, max_deviation=None, tag='check_val', text=None):
+        self.name = name
+        self.passed = bool(passed)
+        self.value = value
+        self.expected = expected
+        self.failures = failures or []
+        self.max_deviation = max_deviation
+        self.tag = tag
+        self.text = text
+
+    def render(self)->str:
+        """ Return the report line(s) of the check. """
+
+        if self.text != None:
+            return self.text
+
+        line = '[ %s ] %s : %s ( %s : should be %s)' % (self.tag, self.name, str(self.value),
+            'Pass' if self.passed else 'Fail', str(self.expected))
+        if len(self.failures) > 0:
+            shown = ', '.join(str(index) for index in self.failures[:10])
+            line += ' %d out of tolerance at [%s%s]' % (len(self.failures), shown, ', ...' if len(self.failures) > 10 else '')
+        if self.max_deviation != None and not self.passed:
+            line += ' max deviation %g' % self.max_deviation
+
+        return line + '\n'
+
+def _deviation(actual:numpy.ndarray, expected:numpy.ndarray)->numpy.ndarray:
+    """ Relative deviations |actual - expected|/|expected| (absolute where expected is 0). """
+
+    scale = numpy.abs(expected)
+    scale = numpy.where(scale == 0, 1.0, scale)
+
+    return numpy.abs(actual - expected)/scale
+
+def compare_values(name:str, actual, expected, exact=False, epsilon=0.05)->CheckResult:
+    """ Compare a value, or a sequence of values, with its fiducial.
+
+        Numbers are compared as numpy arrays in a single vectorised pass: within epsilon
+        relative deviation (|actual - expected| <= epsilon*|expected|, absolute when
+        expected is 0), or equal if exact. As in th.check_val(), NaN or infinite actual
+        values always fail. Sequences of a different length than the fiducial fail.
+        Other values must be equal.
+
+    Args:
+        name (str): Name of the check.
+        actual: Actual value, scalar or sequence.
+        expected: Fiducial value, scalar or sequence.
+        exact (bool, optional): Require equality. Defaults to False.
+        epsilon (float, optional): Allowed relative deviation. Defaults to 0.05.
+
+    Returns:
+        CheckResult: Result of the check.
+    """
+
+    if is_packed_mask(expected) or is_packed_mask(actual):
+        # number of pixels differing from the fiducial mask, None if the shapes differ
+        ndiff = mask_difference(expected, actual)
+        return CheckResult(name, ndiff == 0, ndiff, 0)
+
+    try:
+        act = numpy.asarray(actual, dtype=numpy.float64)
+        exp = numpy.asarray(expected, dtype=numpy.float64)
+        numeric = not isinstance(expected, (str, bool)) and not isinstance(actual, (str, bool))
+    except (TypeError, ValueError):
+        numeric = False
+
+    if numeric and act.shape != exp.shape:
+        return CheckResult(name, False, actual, expected)
+
+    if not numeric:
+        passed = bool(numpy.all(numpy.asarray(actual == expected)))
+        return CheckResult(name, passed, actual, expected)
+
+    with numpy.errstate(invalid='ignore'):
+        if exact:
+            ok = act == exp
+            deviation = None
+        else:
+            dev = _deviation(act, exp)
+            ok = dev <= epsilon
+            deviation = float(numpy.nanmax(dev)) if dev.size > 0 and not numpy.all(numpy.isnan(dev)) else None
+        ok = ok & numpy.isfinite(act)
+
+    if act.ndim == 0:
+        return CheckResult(name, bool(ok), actual, expected, max_deviation=deviation)
+
+    ok = ok.ravel()
+    failures = numpy.flatnonzero(~ok).tolist()
+    index = failures[0] if len(failures) > 0 else ok.size - 1
+    value = act.ravel()[index].item() if ok.size > 0 else []
+    fiducial = exp.ravel()[index].item() if ok.size > 0 else []
+
+    return CheckResult(name, len(failures) == 0, value, fiducial, failures, deviation)
+
+def compare_dicts(exp_dict:dict, act_dict:dict, suffix:str, epsilon=0.01)->list:
+    """ Compare a dictionary of statistics with its fiducial dictionary.
+
+        The fiducial flags follow th.check_dict_vals(): a bool flag selects an exact
+        comparison (True) or one within epsilon (False), any other flag is the allowed
+        relative deviation of that key, e.g. [1e-10, 244174.08]. Scalar fiducials of 0
+        are always compared exactly.
+
+    Args:
+        exp_dict (dict): Fiducial values, as key:[flag, value] pairs.
+        act_dict (dict): Actual values.
+        suffix (str): Name of the image, prefix of the check names.
+        epsilon (float, optional): Allowed relative deviation of the keys with a bool flag.
+            Defaults to 0.01.
+
+    Returns:
+        list: CheckResult of every key of exp_dict.
+    """
+
+    results = []
+    for key, value in exp_dict.items():
+        flag, expected = value
+        if isinstance(flag, (bool, numpy.bool_)):
+            exact, tolerance = bool(flag), epsilon
+        else:
+            exact, tolerance = False, flag
+        if isinstance(expected, (int, float)) and expected == 0.0:
+            exact = True
+        if key not in act_dict:
+            results.append(CheckResult(suffix+' '+key, False, 'missing', expected))
+            continue
+        results.append(compare_values(suffix+' '+key, act_dict[key], expected, exact=exact, epsilon=tolerance))
+
+    return results
+
+def compare_beams(exp_dict:dict, act_dict:dict, suffix:str, epsilon=0.01)->CheckResult:
+    """ Compare per-channel beam values ({'*0': value, ...}) with their fiducials, all
+        channels at once.
+
+    Returns:
+        CheckResult: Single result listing every out-of-tolerance channel.
+    """
+
+    keys = list(exp_dict.keys())
+    actual = numpy.fromiter((act_dict.get(key, numpy.nan) for key in keys), dtype=numpy.float64, count=len(keys))
+    expected = numpy.fromiter((exp_dict[key] for key in keys), dtype=numpy.float64, count=len(keys))
+
+    return compare_values(suffix, actual, expected, epsilon=epsilon)
+
+def compare_beam_tables(expected:BeamTable, actual:BeamTable, suffix:str, epsilon=0.01)->list:
+    """ Compare the major, minor axes and position angles of two beam tables, each field
+        over all the channels in one vectorised comparison.
+
+    Returns:
+        list: CheckResult of bmaj, bmin and pa.
+    """
+
+    if len(expected) != len(actual):
+        return [CheckResult(suffix+' nchan', False, len(actual), len(expected))]
+
+    results = []
+    for field, name in [('major', 'bmaj'), ('minor', 'bmin'), ('pa', 'pa')]:
+        if expected.units.get(field, '') != actual.units.get(field, ''):
+            results.append(CheckResult(suffix+' '+name+' unit', False, actual.units.get(field), expected.units.get(field)))
+            continue
+        results.append(compare_values(suffix+' '+name, actual.beams[field], expected.beams[field], epsilon=epsilon))
+
+    return results
+
+class FiducialReport():
+    """ Structured report of the fiducial checks of a test.
+
+    Collects CheckResult records (and the text of th.checkall() checks), keeps the number of
+    failures as they are added, and renders the report text only when asked:
+
+        report = FiducialReport()
+        report.add_text(th.checkall(imgexist=...))
+        report.add(compare_dicts(exp_im_stats, im_stats_dict, '.image'))
+        report.nfail, report.render(), report.render(showonlyfail=True)
+    """
+
+    def __init__(self):
+        self.results = []
+        self.nfail = 0
+
+    def add(self, results)->None:
+        """ Add a CheckResult or a list of them. """
+
+        if isinstance(results, CheckResult):
+            results = [results]
+
+        for result in results:
+            self.results.append(result)
+            if not result.passed:
+                self.nfail += 1
+
+    def add_text(self, text:str)->None:
+        """ Add the report text of checks done by other tools, one check per line. """
+
+        for line in text.splitlines():
+            if line.strip() == '':
+                continue
+            tag = line[line.find('[ ') + 2:line.find(' ]')] if line.startswith('[ ') else ''
+            self.add(CheckResult(line, '( Fail' not in line, tag=tag, text=line + '\n'))
+
+    def failures(self)->list:
+        """ Return the failed checks. """
+
+        return [result for result in self.results if not result.passed]
+
+    def render(self, showonlyfail=False)->str:
+        """ Return the report text, of the failed checks only if showonlyfail. """
+
+        results = self.failures() if showonlyfail else self.results
+        return ''.join(result.render() for result in results)
+
+    def __str__(self):
+        return self.render()
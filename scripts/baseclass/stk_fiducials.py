@@ -0,0 +1,125 @@
+##########################################################################
+##########################################################################
+# stk_fiducials.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import copy
+import json
+import tempfile
+
+# Fiducials loaded by this process, shared by the FiducialStore instances of all the tests
+_loaded = {}
+
+class FiducialStore():
+    """ Store of the fiducial metric dictionaries (exp_dicts) split per test and reference
+        version.
+
+    The fiducials of a test are kept in their own shard, <store_dir>/<refversion>/<test>.json,
+    so loading them reads one small file instead of parsing the whole fiducial JSON file.
+    A shard records the size and modification time of the JSON file it was extracted from
+    and is extracted again when that file changes. Shards of several reference versions live
+    side by side, and loaded dictionaries are kept in memory for the rest of the process.
+
+        store = FiducialStore('.stkcache/fiducials')
+        exp_dicts = store.load(expdict_jsonfile, 'test_standard_cube_briggsbwtaper', '6.3.0.22')
+    """
+
+    def __init__(self, store_dir:str, reader=None):
+        """
+        Args:
+            store_dir (str): Directory of the shards.
+            reader (callable, optional): reader(jsonfile, testname, refversion) returning the
+                fiducials of a test from the JSON file. Defaults to
+                almastktestutils.read_testcase_expdicts.
+        """
+
+        self.store_dir = store_dir
+        self.reader = reader
+
+    def _read(self, jsonfile:str, testname:str, refversion:str)->dict:
+        if self.reader == None:
+            from casatestutils.stakeholder import almastktestutils
+            self.reader = almastktestutils.read_testcase_expdicts
+
+        return self.reader(jsonfile, testname, refversion)
+
+    def shard(self, testname:str, refversion:str)->str:
+        """ Return the shard file of a test and reference version. """
+
+        return os.path.join(self.store_dir, str(refversion), testname + '.json')
+
+    def load(self, jsonfile:str, testname:str, refversion:str)->dict:
+        """ Return the fiducials of a test, from memory, its shard or the JSON file.
+
+        Args:
+            jsonfile (str): Fiducial JSON file of all the tests.
+            testname (str): Name of the test.
+            refversion (str): Reference CASA version of the fiducials.
+
+        Returns:
+            dict: Fiducial dictionaries of the test (a copy, callers may modify it).
+        """
+
+        stat = os.stat(jsonfile)
+        source = {'file':os.path.realpath(jsonfile), 'size':stat.st_size, 'mtime':stat.st_mtime_ns}
+
+        key = (os.path.realpath(self.store_dir), testname, str(refversion))
+        loaded = _loaded.get(key)
+        if loaded == None or loaded['source'] != source:
+            loaded = self._load_shard(testname, refversion, source)
+            if loaded == None:
+                loaded = {'source':source, 'exp_dicts':self._read(jsonfile, testname, refversion)}
+                self._save_shard(testname, refversion, loaded)
+            _loaded[key] = loaded
+
+        return copy.deepcopy(loaded['exp_dicts'])
+
+    def _load_shard(self, testname:str, refversion:str, source:dict)->dict:
+        try:
+            with open(self.shard(testname, refversion)) as shardfile:
+                loaded = json.load(shardfile)
+        except (OSError, ValueError):
+            return None
+
+        return loaded if loaded.get('source') == source else None
+
+    def _save_shard(self, testname:str, refversion:str, loaded:dict)->None:
+        shardname = self.shard(testname, refversion)
+        try:
+            os.makedirs(os.path.dirname(shardname), exist_ok=True)
+
+            # Tests started side by side may write the same shard, replace it atomically
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(shardname), suffix='.tmp')
+        except OSError as error:
+            print('Unable to save fiducial shard ' + shardname + ': ' + str(error))
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as shardfile:
+                json.dump(loaded, shardfile)
+            os.replace(tmpname, shardname)
+        except (OSError, TypeError, ValueError) as error:
+            print('Unable to save fiducial shard ' + shardname + ': ' + str(error))
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass
@@ -0,0 +1,146 @@
+##########################################################################
+##########################################################################
+# stk_fit.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import time
+import multiprocessing
+import concurrent.futures
+
+# Image tool of a fit worker process, created by _init_worker()
+_worker_ia = None
+
+def _init_worker()->None:
+    global _worker_ia
+
+    from casatools import image
+    _worker_ia = image()
+
+def component_values(fit:dict)->dict:
+    """ Extract the values image_stats() keeps from an ia.fitcomponents() result.
+
+    Args:
+        fit (dict): Result of ia.fitcomponents().
+
+    Returns:
+        dict: fit ([peak, major, minor]), fit_loc_chan, fit_loc_freq and fit_pix of the
+            first component, or None if the fit returned no component.
+    """
+
+    try:
+        component = fit['results']['component0']
+        return {
+            'fit':[component['peak']['value'],
+                component['shape']['majoraxis']['value'],
+                component['shape']['minoraxis']['value']],
+            'fit_loc_chan':component['spectrum']['channel'],
+            'fit_loc_freq':component['spectrum']['frequency']['m0']['value'],
+            'fit_pix':component['pixelcoords'].tolist()}
+    except KeyError:
+        return None
+
+def _fit_component(image:str, region:str)->tuple:
+    """ Fit a component in a worker process, with the image tool of the worker. """
+
+    start = time.perf_counter()
+    _worker_ia.open(image)
+    try:
+        values = component_values(_worker_ia.fitcomponents(region=region))
+    finally:
+        _worker_ia.close()
+
+    return values, os.getpid(), start, time.perf_counter()
+
+class FitPool():
+    """ Runs ia.fitcomponents() fits side by side in a pool of worker processes.
+
+    Each worker opens the images with its own image tool, so fits of different regions
+    of an image, or of different images, don't wait on each other nor on the image tool
+    of the test. With workers=0 the fits run immediately, one after another, with the
+    image tool given to submit().
+
+        pool = FitPool(workers=3)
+        future = pool.submit(ia, 'img.psf', region)
+        ...
+        values = future.result()
+    """
+
+    def __init__(self, workers=0, tracer=None):
+        """
+        Args:
+            workers (int, optional): Number of worker processes, 0 to fit serially. Defaults to 0.
+            tracer (Tracer, optional): Records the fits of the workers as trace spans. Defaults to None.
+        """
+
+        self.workers = workers
+        self.tracer = tracer
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor == None:
+            # casatools doesn't support being forked with open tools, start fresh workers
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+        return self._executor
+
+    def submit(self, ia, image:str, region:str)->concurrent.futures.Future:
+        """ Start a fit of a component of image in region.
+
+        Args:
+            ia (casatools.image): Image tool with image open, used when fitting serially.
+            image (str): Image name.
+            region (str): Region (CRTF) of the fit.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the component_values() of the fit.
+        """
+
+        if self.workers <= 0:
+            start = time.perf_counter()
+            future = concurrent.futures.Future()
+            future.set_result(component_values(ia.fitcomponents(region=region)))
+            if self.tracer != None:
+                self.tracer.add_event('fitcomponents', start, time.perf_counter(), {'image':image, 'region':region})
+            return future
+
+        future = self._get_executor().submit(_fit_component, image, region)
+        result = concurrent.futures.Future()
+
+        def done(fit_future):
+            try:
+                values, pid, start, end = fit_future.result()
+            except BaseException as error:
+                result.set_exception(error)
+                return
+            if self.tracer != None:
+                self.tracer.add_event('fitcomponents', start, end, {'image':image, 'region':region}, pid=pid)
+            result.set_result(values)
+
+        future.add_done_callback(done)
+        return result
+
+    def shutdown(self)->None:
+        """ Stop the worker processes. """
+
+        if self._executor != None:
+            self._executor.shutdown()
+            self._executor = None
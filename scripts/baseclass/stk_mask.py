@@ -0,0 +1,236 @@
+##########################################################################
+##########################################################################
+# stk_mask.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import base64
+import numpy
+
+# Value of the 'encoding' key identifying a packed mask
+packed_mask_encoding = 'packbits+rle'
+
+# Number of set bits of every byte value
+_popcount = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.int64)
+
+def popcount(bits:numpy.ndarray, axis=None)->numpy.ndarray:
+    """ Count the set bits of an array of bytes (along axis). """
+
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(bits).sum(axis=axis, dtype=numpy.int64)
+
+    return _popcount[bits].sum(axis=axis, dtype=numpy.int64)
+
+class BitMask():
+    """ Boolean mask cube stored as one packed bitset (numpy.packbits) per channel.
+
+    Takes an eighth of the memory of a boolean array, and the per-channel counts of the
+    stakeholder checks are bitwise operations and popcounts on the packed bytes:
+
+        mask = BitMask(nchan, [ny, nx])
+        mask.set(c0, block == 0)               # block of channels [nc, ny, nx]
+        (mask_a & mask_b).count()              # per-channel number of set pixels
+
+    The pixels of a channel are packed in C order of the channel plane. shape is the
+    logical shape of the mask (e.g. with the degenerate channel axis of a continuum image
+    dropped), used by to_array() and numpy.asarray().
+    """
+
+    def __init__(self, nchan:int, plane_shape:list, shape=None):
+        """
+        Args:
+            nchan (int): Number of channels.
+            plane_shape (list): Shape of a channel plane.
+            shape (list, optional): Shape of the mask as an array. Defaults to [nchan] + plane_shape.
+        """
+
+        self.nchan = int(nchan)
+        self.plane_shape = [int(n) for n in plane_shape]
+        self.npix = int(numpy.prod(self.plane_shape))
+        self.shape = list(shape) if shape != None else [self.nchan] + self.plane_shape
+        self.bits = numpy.zeros((self.nchan, (self.npix + 7) // 8), dtype=numpy.uint8)
+
+    @classmethod
+    def from_array(cls, mask:numpy.ndarray, shape=None):
+        """ Pack a boolean array, channel axis first. """
+
+        mask = numpy.asarray(mask, dtype=bool)
+        bitmask = cls(mask.shape[0], mask.shape[1:], shape)
+        bitmask.set(0, mask)
+
+        return bitmask
+
+    def set(self, chan0:int, block:numpy.ndarray)->None:
+        """ Set the channels chan0 to chan0+len(block) from a boolean block [nc, ...]. """
+
+        nchan = block.shape[0]
+        self.bits[chan0:chan0 + nchan] = numpy.packbits(block.reshape(nchan, -1), axis=1)
+
+    def _combine(self, other, bits:numpy.ndarray):
+        if self.bits.shape != other.bits.shape:
+            raise ValueError('Masks of different shapes %s and %s' % (self.shape, other.shape))
+        combined = BitMask(0, self.plane_shape, self.shape)
+        combined.nchan = self.nchan
+        combined.bits = bits
+
+        return combined
+
+    def __and__(self, other):
+        return self._combine(other, numpy.bitwise_and(self.bits, other.bits))
+
+    def __or__(self, other):
+        return self._combine(other, numpy.bitwise_or(self.bits, other.bits))
+
+    def count(self)->numpy.ndarray:
+        """ Return the number of set pixels of each channel. """
+
+        return popcount(self.bits, axis=1)
+
+    def to_array(self)->numpy.ndarray:
+        """ Return the mask as a boolean array of the mask shape. """
+
+        return numpy.unpackbits(self.bits, axis=1, count=self.npix).astype(bool).reshape(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        return array if dtype == None else array.astype(dtype)
+
+def count_nonzero_masked(block:numpy.ndarray, masks:list, chan0=0)->numpy.ndarray:
+    """ Count, per channel, numpy.count_nonzero(block*mask) for each BitMask, as popcounts.
+
+        block*mask is non-zero where the mask is set and the pixel is non-zero, and also
+        where the pixel is not finite (nan*False is nan), so both are counted.
+
+    Args:
+        block (numpy.ndarray): Block of pixel values, channel axis first [nc, ...].
+        masks (list): BitMask of the whole image.
+        chan0 (int, optional): Index of the first channel of the block. Defaults to 0.
+
+    Returns:
+        numpy.ndarray: Counts, shape [len(masks), nc].
+    """
+
+    nchan = block.shape[0]
+    nonzero = numpy.packbits((block != 0).reshape(nchan, -1), axis=1)
+
+    # A finite sum means every pixel is finite; only otherwise are the non-finite bits needed
+    nonfinite = None
+    if not numpy.isfinite(numpy.sum(block, dtype=numpy.float64)):
+        nonfinite = numpy.packbits(numpy.logical_not(numpy.isfinite(block)).reshape(nchan, -1), axis=1)
+
+    counts = numpy.empty((len(masks), nchan), dtype=numpy.int64)
+    for i, mask in enumerate(masks):
+        bits = mask.bits[chan0:chan0 + nchan]
+        counts[i] = popcount(numpy.bitwise_and(nonzero, bits), axis=1)
+        if nonfinite is not None:
+            # the padding bits of nonfinite are 0, so inverting the mask bits is safe
+            counts[i] += popcount(numpy.bitwise_and(nonfinite, numpy.invert(bits)), axis=1)
+
+    return counts
+
+def pack_mask(mask:numpy.ndarray)->dict:
+    """ Encode a boolean mask as a JSON serialisable dictionary.
+
+        The mask is flattened (C order), packed 8 pixels per byte with numpy.packbits and
+        the bytes are run-length encoded, which keeps the mostly constant masks of the
+        stakeholder images to a few kB.
+
+    Args:
+        mask (numpy.ndarray or BitMask): Boolean mask.
+
+    Returns:
+        dict: encoding, shape, values (base64 bytes of the runs) and counts (base64 uint32
+            lengths of the runs).
+    """
+
+    mask = numpy.asarray(mask, dtype=bool)
+    packed = numpy.packbits(mask.ravel())
+    starts = numpy.concatenate([[0], numpy.flatnonzero(packed[1:] != packed[:-1]) + 1]) if packed.size > 0 \
+        else numpy.zeros(0, dtype=numpy.int64)
+    counts = numpy.diff(numpy.concatenate([starts, [packed.size]]))
+
+    return {
+        'encoding':packed_mask_encoding,
+        'shape':list(mask.shape),
+        'values':base64.b64encode(packed[starts].tobytes()).decode('ascii'),
+        'counts':base64.b64encode(counts.astype('<u4').tobytes()).decode('ascii')}
+
+def is_packed_mask(value)->bool:
+    """ Return True if value is a mask encoded by pack_mask(). """
+
+    return isinstance(value, dict) and value.get('encoding') == packed_mask_encoding
+
+def packed_bytes(packed:dict)->numpy.ndarray:
+    """ Return the numpy.packbits bytes of a mask encoded by pack_mask(). """
+
+    values = numpy.frombuffer(base64.b64decode(packed['values']), dtype=numpy.uint8)
+    counts = numpy.frombuffer(base64.b64decode(packed['counts']), dtype='<u4')
+
+    return numpy.repeat(values, counts)
+
+def unpack_mask(packed:dict)->numpy.ndarray:
+    """ Decode a mask encoded by pack_mask() into a boolean array. """
+
+    shape = packed['shape']
+    npix = int(numpy.prod(shape))
+
+    return numpy.unpackbits(packed_bytes(packed), count=npix).astype(bool).reshape(shape)
+
+def mask_difference(mask_a, mask_b)->int:
+    """ Count the pixels that differ between two masks, without unpacking packed masks.
+
+    Args:
+        mask_a (dict, numpy.ndarray or BitMask): Mask, packed by pack_mask() or boolean array.
+        mask_b (dict, numpy.ndarray or BitMask): Mask, packed by pack_mask() or boolean array.
+
+    Returns:
+        int: Number of differing pixels, or None if the shapes of the masks differ.
+    """
+
+    masks = [mask if is_packed_mask(mask) else pack_mask(mask) for mask in [mask_a, mask_b]]
+    if list(masks[0]['shape']) != list(masks[1]['shape']):
+        return None
+
+    # Both masks are padded with the same zero bits, so they don't add to the count
+    difference = numpy.bitwise_xor(packed_bytes(masks[0]), packed_bytes(masks[1]))
+
+    return int(_popcount[difference].sum())
+
+def encode_json(value):
+    """ json.dump() default hook: masks are packed, other numpy values converted to lists
+        and Python scalars.
+    """
+
+    if isinstance(value, BitMask):
+        return pack_mask(value.to_array())
+    if isinstance(value, numpy.ndarray):
+        return pack_mask(value) if value.dtype == bool else value.tolist()
+    if isinstance(value, numpy.generic):
+        return value.item()
+
+    raise TypeError('Object of type %s is not JSON serializable' % type(value).__name__)
+
+def decode_json(value:dict):
+    """ json.load() object_hook: packed masks are decoded into boolean arrays. """
+
+    if is_packed_mask(value):
+        return unpack_mask(value)
+
+    return value
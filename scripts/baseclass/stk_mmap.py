@@ -0,0 +1,141 @@
+##########################################################################
+##########################################################################
+# stk_mmap.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import numpy
+
+# Storage managers whose data file holds the tiles of a hypercube one after another
+_tiled_storage_managers = ['TiledCellStMan', 'TiledShapeStMan', 'TiledColumnStMan']
+
+class TiledImageReader():
+    """ Read-only, memory-mapped access to the pixels of a CASA image.
+
+    The pixels of a CASA image are the 'map' column of the image table, stored by a tiled
+    storage manager in table.f<seqnr>_TSM0: the tiles of the hypercube, each in Fortran
+    order, follow each other in Fortran order of the tile indices. The file is mapped and
+    viewed as an array of tiles, so reading a block of channels costs page-cache reads, and
+    no copy at all when the tiles span whole channel planes (tile shape [nx, ny, nstokes, k]).
+
+    The layout comes from the data manager info of the table (tb.getdminfo()). Only a single
+    float hypercube in a plain TSM file is supported; open() returns None otherwise (e.g.
+    MultiFile storage, several hypercubes, complex images) and the image tool should be used.
+    """
+
+    def __init__(self, filename:str, shape:list, tileshape:list, endian='little'):
+        """
+        Args:
+            filename (str): Tiled storage manager data file.
+            shape (list): Image shape [nx, ny, nstokes, nchan].
+            tileshape (list): Tile shape, same number of axes.
+            endian (str, optional): Byte order of the table, 'big' or 'little'. Defaults to 'little'.
+        """
+
+        self.filename = filename
+        self.shape = [int(n) for n in shape]
+        self.tileshape = [int(n) for n in tileshape]
+        self.ntiles = [-(-n // t) for n, t in zip(self.shape, self.tileshape)]
+
+        dtype = numpy.dtype('>f4' if endian == 'big' else '<f4')
+        data = numpy.memmap(filename, dtype=dtype, mode='r',
+            shape=int(numpy.prod(self.ntiles))*int(numpy.prod(self.tileshape)))
+
+        # [tile index (Fortran order), pixel in tile (Fortran order)] as a C ordered array
+        # of axes [n_last, ..., n_0, t_last, ..., t_0]
+        self._tiles = data.reshape(list(reversed(self.ntiles)) + list(reversed(self.tileshape)))
+
+    @classmethod
+    def open(cls, image:str, tb):
+        """ Return a reader of image, or None if its storage layout isn't supported.
+
+        Args:
+            image (str): CASA image (table directory).
+            tb (casatools.table): Table tool, used to read the data manager info.
+        """
+
+        if os.path.isdir(image) is False:
+            return None
+
+        try:
+            tb.open(image)
+            try:
+                datatype = tb.coldatatype('map')
+                dminfo = tb.getdminfo()
+                endian = tb.endianformat()
+            finally:
+                tb.close()
+        except Exception as error:
+            print('Memory-mapped reader not available for ' + image + ': ' + str(error))
+            return None
+
+        if datatype != 'float':
+            return None
+
+        for dm in dminfo.values():
+            if 'map' not in list(dm.get('COLUMNS', [])):
+                continue
+            if dm.get('TYPE') not in _tiled_storage_managers:
+                return None
+            hypercubes = list(dm['SPEC'].get('HYPERCUBES', {}).values())
+            if len(hypercubes) != 1:
+                return None
+
+            # TiledCellStMan adds the row axis to the cell shape, with one row it's degenerate
+            cubeshape = [int(n) for n in hypercubes[0]['CubeShape']]
+            tileshape = [int(n) for n in hypercubes[0]['TileShape']]
+            if len(cubeshape) < 4 or any(n != 1 for n in cubeshape[4:] + tileshape[4:]):
+                return None
+
+            filename = os.path.join(image, 'table.f%d_TSM0' % dm.get('SEQNR', 0))
+            nbytes = 4*int(numpy.prod([-(-n // t) for n, t in zip(cubeshape[:4], tileshape[:4])]))*int(numpy.prod(tileshape[:4]))
+            if os.path.isfile(filename) is False or os.path.getsize(filename) < nbytes:
+                return None
+
+            return cls(filename, cubeshape[:4], tileshape[:4], endian)
+
+        return None
+
+    def getchunk(self, blc:list, trc:list)->numpy.ndarray:
+        """ Return the pixels from blc to trc (inclusive), as ia.getchunk(blc, trc).
+
+            The result is a read-only view of the mapped file when the selected tiles hold
+            exactly the selected pixels, otherwise the tiles are copied into a new array.
+        """
+
+        ndim = len(self.shape)
+        blc = [int(n) for n in blc] + [0]*(ndim - len(blc))
+        trc = [int(n) for n in trc] + [n - 1 for n in self.shape[len(trc):]]
+
+        # Tiles overlapping the selection (tile axes are reversed in self._tiles)
+        tile_blc = [b // t for b, t in zip(blc, self.tileshape)]
+        tile_trc = [e // t + 1 for e, t in zip(trc, self.tileshape)]
+        tiles = self._tiles[tuple(slice(tile_blc[i], tile_trc[i]) for i in reversed(range(ndim))) + (Ellipsis,)]
+
+        # [n_last, ..., n_0, t_last, ..., t_0] -> [t_0, n_0, t_1, n_1, ...] -> pixels (Fortran
+        # order), reshape copies unless all but the last selected tiled axis hold a single tile
+        order = []
+        for i in range(ndim):
+            order += [2*ndim - 1 - i, ndim - 1 - i]
+        pixels = tiles.transpose(order).reshape([(tile_trc[i] - tile_blc[i])*self.tileshape[i] for i in range(ndim)], order='F')
+
+        offset = [b - tb*t for b, tb, t in zip(blc, tile_blc, self.tileshape)]
+        return pixels[tuple(slice(offset[i], offset[i] + trc[i] - blc[i] + 1) for i in range(ndim))]
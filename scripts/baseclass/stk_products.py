@@ -0,0 +1,190 @@
+##########################################################################
+##########################################################################
+# stk_products.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import tempfile
+
+from scripts.baseclass.stk_cache import table_fingerprint
+from scripts.baseclass.stk_clone import clone_products
+
+# Bumped when the layout of the cached products changes
+_cache_version = 2
+
+# tclean parameters that don't change the products
+_ignored_params = ('imagename', 'verbose')
+
+# Name of the products inside a cache entry (<entry>/products.psf, ...)
+_entry_pname = 'products'
+
+def _casa_version()->str:
+    """ Return the version of casatools, which makes the products, '' if unknown. """
+
+    try:
+        import casatools as __casatools
+        casaversion = __casatools.version_string()
+        del __casatools
+    except:
+        casaversion = ''
+
+    return casaversion
+
+def _normalise(value):
+    """ Return a canonical form of a tclean parameter value, so that e.g. spw='0', spw=['0']
+        and spw=[' 0'] hash the same. """
+
+    if isinstance(value, (list, tuple)):
+        if len(value) == 1:
+            return _normalise(value[0])
+        return [_normalise(item) for item in value]
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, bool) or value == None:
+        return value
+    if isinstance(value, (int, float)):
+        return float(value)
+    return str(value)
+
+def dir_bytes(path:str)->int:
+    """ Return the size of the files under path. """
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            if os.path.islink(filename) is False:
+                total += os.stat(filename).st_size
+    return total
+
+class ProductCache():
+    """ On-disk cache of the imaging products of tclean runs, shared by the tests.
+
+    The key of an entry is a digest of the cache version, the casatools version, the
+    normalised tclean parameters (but imagename), the code making the products and the
+    fingerprint of the measurement sets (see stk_cache.table_fingerprint), so tests whose
+    iter0 tclean runs on the same data with the same parameters share one entry. The
+    products are reflinked or copied (stk_clone.clone_products) into and out of the cache,
+    never hardlinked: a test rewriting its products must not change the cached ones.
+
+    An entry is a directory <key> in cache_dir with the products and a params.json file
+    describing it. A lookup refreshes the modification time of the entry, and entries are
+    evicted least recently used first once they take more than max_gbytes.
+    """
+
+    def __init__(self, cache_dir:str, max_gbytes=20, workers=8):
+        """
+        Args:
+            cache_dir (str): Directory of the cache entries.
+            max_gbytes (float, optional): Size limit of the cache. Defaults to 20.
+            workers (int, optional): Number of threads cloning the products. Defaults to 8.
+        """
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_gbytes*1024**3
+        self.workers = workers
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, params:dict, code='')->str:
+        """ Compute the key of the products of tclean(**params).
+
+        Args:
+            params (dict): tclean parameters.
+            code (str, optional): Source of the code running tclean, when the products
+                depend on more than the parameters (e.g. channel chunking). Defaults to ''.
+        """
+
+        vis = params.get('vis', [])
+        vis = [vis] if isinstance(vis, str) else list(vis)
+
+        sha = hashlib.sha256(str(_cache_version).encode())
+        sha.update(_casa_version().encode())
+        sha.update(hashlib.sha256(code.encode()).digest())
+        for name in sorted(params):
+            if name in _ignored_params or name == 'vis':
+                continue
+            sha.update(json.dumps([name, _normalise(params[name])]).encode())
+        for msfile in vis:
+            sha.update(os.path.basename(os.path.normpath(msfile)).encode())
+            sha.update(table_fingerprint(msfile).encode())
+
+        return sha.hexdigest()
+
+    def _entry(self, key:str)->str:
+        return os.path.join(self.cache_dir, key)
+
+    def lookup(self, key:str, imagename:str)->bool:
+        """ Clone the cached products of key to imagename.*.
+
+        Returns:
+            bool: True if the products were found, False otherwise.
+        """
+
+        entry = self._entry(key)
+        if os.path.isfile(os.path.join(entry, 'params.json')) is False:
+            return False
+
+        os.utime(entry)
+        clone_products(os.path.join(entry, _entry_pname), imagename, workers=self.workers, hardlinks=False)
+
+        return True
+
+    def store(self, key:str, imagename:str, params=None)->None:
+        """ Clone the imagename.* products into the entry of key, then evict old entries. """
+
+        # Entries can be written concurrently by tests running side by side, build the
+        # entry in a temporary directory and move it in place
+        tmpdir = tempfile.mkdtemp(dir=self.cache_dir, suffix='.tmp')
+        clone_products(imagename, os.path.join(tmpdir, _entry_pname), workers=self.workers, hardlinks=False)
+        with open(os.path.join(tmpdir, 'params.json'), 'w') as outf:
+            json.dump({'imagename':imagename, 'params':params}, outf, indent=2, default=str)
+
+        try:
+            os.rename(tmpdir, self._entry(key))
+        except OSError:
+            # Another test stored the same products first
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self)->None:
+        """ Remove the least recently used entries until the cache fits in max_gbytes. """
+
+        entries = []
+        for entry in glob.glob(os.path.join(self.cache_dir, '*')):
+            if entry.endswith('.tmp') or os.path.isdir(entry) is False:
+                continue
+            try:
+                entries.append((os.stat(entry).st_mtime_ns, dir_bytes(entry), entry))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
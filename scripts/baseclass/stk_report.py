@@ -0,0 +1,146 @@
+##########################################################################
+##########################################################################
+# stk_report.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import time
+import multiprocessing
+import concurrent.futures
+
+# Image statistics instance of a report worker process, created by _init_worker()
+_worker = None
+
+def _init_worker()->None:
+    global _worker
+
+    # Imported here, the base class module imports this one
+    from scripts.baseclass.stakeholder_base_class import stakeholder_stats_base, load_config
+    from scripts.baseclass.stk_trace import Tracer
+
+    # The products are already computed side by side, fit them in the worker itself
+    _worker = stakeholder_stats_base()
+    _worker.setup_stats(load_config(), Tracer(), fit_workers=0)
+
+def _image_stats(kwargs:dict)->tuple:
+    """ Compute image_stats() in a worker process, with the image tool of the worker
+        (and the statistics cache, if enabled).
+    """
+
+    start = time.perf_counter()
+    stats_dict = _worker.image_stats(**kwargs)
+
+    return stats_dict, os.getpid(), start, time.perf_counter()
+
+def task_dependencies(task:dict)->list:
+    """ Names of the tasks whose results a task needs for its masks. """
+
+    if task.get('masks') == None:
+        return []
+
+    return [task['masks'][0]]
+
+def task_masks(task:dict, results:dict):
+    """ Resolve the masks of a task, given as (task name, key or list of keys), from the
+        statistics dictionaries of the completed tasks.
+    """
+
+    if task.get('masks') == None:
+        return None
+
+    name, keys = task['masks']
+    if isinstance(keys, str):
+        return results[name][keys]
+
+    return [results[name][key] for key in keys]
+
+def run_stats_tasks(stats, tasks:dict, workers=0)->dict:
+    """ Compute image_stats() of several imaging products, side by side when possible.
+
+    Each task gives the image_stats() arguments of a product:
+
+        {'image':{'image':img+'.image', 'fit_region':..., 'field_regions':[...]},
+         'mask':{'image':img+'.mask'},
+         'model':{'image':img+'.model', 'fit_region':..., 'masks':('mask', 'mask')},
+         'weight':{'image':img+'.weight', 'masks':('pb', ['pb_mask_0.2', 'pb_mask_0.5'])}}
+
+    masks refers to arrays of the result of another task, which then runs first. Tasks
+    without dependencies start right away in a pool of worker processes, each opening the
+    images with its own image tool; the others start as soon as the tasks they depend on
+    are done. With workers=0 the tasks run one after another in the calling process.
+
+    Args:
+        stats (test_stakeholder_base): Test computing the statistics (its image_stats()
+            is used when workers=0, its tracer records the worker tasks).
+        tasks (dict): Task name -> image_stats() arguments.
+        workers (int, optional): Number of worker processes. Defaults to 0.
+
+    Returns:
+        dict: Task name -> statistics dictionary.
+    """
+
+    for name, task in tasks.items():
+        for dependency in task_dependencies(task):
+            if dependency not in tasks:
+                raise ValueError('Task ' + name + ' depends on unknown task ' + dependency)
+
+    results = {}
+    pending = dict(tasks)
+
+    def ready():
+        return [name for name, task in pending.items()
+            if all(dependency in results for dependency in task_dependencies(task))]
+
+    def arguments(name):
+        kwargs = {key:value for key, value in pending.pop(name).items() if key != 'masks'}
+        kwargs['masks'] = task_masks(tasks[name], results)
+        return kwargs
+
+    if workers <= 0 or len(tasks) < 2:
+        while pending:
+            names = ready()
+            if len(names) == 0:
+                raise ValueError('Circular mask dependencies between tasks ' + str(list(pending)))
+            name = names[0]
+            results[name] = stats.image_stats(**arguments(name))
+        return results
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+        mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+    running = {}
+    try:
+        while pending or running:
+            for name in ready():
+                running[executor.submit(_image_stats, arguments(name))] = name
+            if len(running) == 0:
+                raise ValueError('Circular mask dependencies between tasks ' + str(list(pending)))
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                stats_dict, pid, start, end = future.result()
+                stats.tracer.add_event('image_stats', start, end,
+                    {'image':os.path.basename(tasks[name]['image'])}, pid=pid)
+                results[name] = stats_dict
+    finally:
+        executor.shutdown()
+
+    return results
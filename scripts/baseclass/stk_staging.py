@@ -0,0 +1,230 @@
+##########################################################################
+##########################################################################
+# stk_staging.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+
+import os
+import json
+import glob
+import fcntl
+import shutil
+import weakref
+import concurrent.futures
+
+from scripts.baseclass.stk_cache import table_fingerprint
+from scripts.baseclass.stk_products import dir_bytes
+
+# DataStager instances of the process, whose locks are closed in forked children
+_stagers = weakref.WeakSet()
+
+def _after_fork_in_child()->None:
+    # Tests forked by the runner mustn't keep the locks of its prefetches alive: a flock
+    # is only released once every descriptor of the lock file is closed
+    for stager in list(_stagers):
+        stager._close_locks()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+class DataStager():
+    """ Copies of the measurement sets of the tests in a local scratch directory.
+
+    stage() copies a measurement set (e.g. from the network share of the stakeholder data)
+    to <scratch_dir>/<name> and returns the path of the copy. The copy is reused as long as
+    the fingerprints of the source (see stk_cache.table_fingerprint) and of the copy itself
+    are unchanged. It is checked under a shared lock on <scratch_dir>/<name>.lock and made
+    under an exclusive one, so the test runner can prefetch() the measurement sets of the
+    next test in a background thread while the test processes stage their own. A test
+    holds a shared lock on its copies until release(), so tests reading the same copy run
+    side by side.
+
+    The staged copies are evicted least recently used first, but for the ones in use,
+    once they take more than max_gbytes.
+    """
+
+    def __init__(self, scratch_dir:str, max_gbytes=100):
+        """
+        Args:
+            scratch_dir (str): Local directory of the copies.
+            max_gbytes (float, optional): Size limit of the copies. Defaults to 100.
+        """
+
+        self.scratch_dir = scratch_dir
+        self.max_bytes = max_gbytes*1024**3
+        self._held = []
+        self._locks = set()
+        self._executor = None
+        _stagers.add(self)
+
+        os.makedirs(scratch_dir, exist_ok=True)
+
+    def _close_locks(self)->None:
+        for lock in list(self._locks):
+            lock.close()
+        self._locks = set()
+        self._held = []
+        # The prefetch thread isn't running in a forked child
+        self._executor = None
+
+    def _paths(self, msname:str)->tuple:
+        staged = os.path.join(self.scratch_dir, os.path.basename(os.path.normpath(msname)))
+        return staged, staged + '.lock', staged + '.stage.json'
+
+    def _is_valid(self, staged:str, manifest_file:str, fingerprint:str)->bool:
+        """ Whether staged is a copy of the source with fingerprint, unchanged since it was
+            made (e.g. not partly removed or written by a test). """
+
+        try:
+            with open(manifest_file) as file:
+                manifest = json.load(file)
+            return isinstance(manifest, dict) and manifest.get('fingerprint') == fingerprint \
+                and os.path.exists(staged) and manifest.get('copy_fingerprint') == table_fingerprint(staged)
+        except (OSError, ValueError):
+            return False
+
+    def stage(self, msname:str, hold=False)->str:
+        """ Copy a measurement set to the scratch directory, unless an up to date copy is there.
+
+        Args:
+            msname (str): Measurement set.
+            hold (bool, optional): Keep a shared lock on the copy, preventing its eviction,
+                until release(). Defaults to False.
+
+        Returns:
+            str: Path of the staged copy, or msname if it couldn't be staged.
+        """
+
+        if os.path.exists(msname) is False:
+            return msname
+
+        staged, lockfile, manifest_file = self._paths(msname)
+        lock = open(lockfile, 'a')
+        self._locks.add(lock)
+        try:
+            fingerprint = table_fingerprint(msname)
+
+            # A valid copy is usually there, held by the other tests reading it: check it
+            # under a shared lock, and only lock it exclusively to make a new copy
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            valid = self._is_valid(staged, manifest_file, fingerprint)
+            if valid is False:
+                # Another process may make the copy between the two locks, check it again
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                valid = self._is_valid(staged, manifest_file, fingerprint)
+
+            if valid:
+                os.utime(manifest_file)
+            else:
+                print('Staging ' + msname + ' to ' + self.scratch_dir)
+                size = dir_bytes(msname)
+                self.evict(size, keep=staged)
+
+                if os.path.exists(manifest_file):
+                    os.remove(manifest_file)
+                shutil.rmtree(staged, ignore_errors=True)
+                shutil.rmtree(staged + '.tmp', ignore_errors=True)
+                shutil.copytree(msname, staged + '.tmp', symlinks=True)
+                os.rename(staged + '.tmp', staged)
+
+                with open(manifest_file, 'w') as outf:
+                    json.dump({'source':os.path.abspath(msname), 'fingerprint':fingerprint,
+                        'copy_fingerprint':table_fingerprint(staged), 'bytes':size}, outf)
+
+        except (OSError, ValueError, KeyError) as error:
+            print('Unable to stage ' + msname + ': ' + str(error))
+            shutil.rmtree(staged + '.tmp', ignore_errors=True)
+            self._locks.discard(lock)
+            lock.close()
+            return msname
+
+        if hold:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            self._held.append(lock)
+        else:
+            self._locks.discard(lock)
+            lock.close()
+
+        return staged
+
+    def prefetch(self, msnames:list)->list:
+        """ Stage measurement sets in a background thread.
+
+        Returns:
+            list: concurrent.futures.Future of the stage() of each measurement set.
+        """
+
+        if self._executor == None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        return [self._executor.submit(self.stage, msname) for msname in msnames]
+
+    def evict(self, need_bytes=0, keep=None)->None:
+        """ Remove the least recently used copies not in use until need_bytes more fit in
+            max_gbytes.
+
+        Args:
+            need_bytes (int, optional): Size of a copy about to be made. Defaults to 0.
+            keep (str, optional): Copy that mustn't be removed. Defaults to None.
+        """
+
+        entries = []
+        for manifest_file in glob.glob(os.path.join(self.scratch_dir, '*.stage.json')):
+            staged = manifest_file[:-len('.stage.json')]
+            try:
+                with open(manifest_file) as file:
+                    size = json.load(file)['bytes']
+                entries.append((os.stat(manifest_file).st_mtime_ns, size, staged))
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, staged in sorted(entries):
+            if total + need_bytes <= self.max_bytes:
+                break
+            if staged == keep:
+                continue
+
+            # Copies staged or used by another process are locked
+            with open(staged + '.lock', 'a') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                print('Evicting staged ' + staged)
+                os.remove(staged + '.stage.json')
+                shutil.rmtree(staged, ignore_errors=True)
+            total -= size
+
+    def release(self)->None:
+        """ Release the copies held by stage(hold=True). """
+
+        for lock in self._held:
+            self._locks.discard(lock)
+            lock.close()
+        self._held = []
+
+    def close(self)->None:
+        """ Wait for the prefetches and release the held copies. """
+
+        if self._executor != None:
+            self._executor.shutdown()
+            self._executor = None
+        self.release()
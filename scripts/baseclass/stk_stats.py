@@ -0,0 +1,295 @@
+##########################################################################
+##########################################################################
+# stk_stats.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+import math
+import numpy
+import scipy.ndimage
+import concurrent.futures
+
+def _count_per_channel(flags:numpy.ndarray, axis:int)->numpy.ndarray:
+    """ Count the set flags of each channel (plane along axis) of a boolean block. """
+
+    planes = numpy.moveaxis(flags, axis, 0)
+    if planes[0].flags.c_contiguous or planes[0].flags.f_contiguous:
+        # count_nonzero on a contiguous boolean plane is the fastest reduction numpy offers
+        return numpy.array([numpy.count_nonzero(plane) for plane in planes], dtype=numpy.int64)
+
+    return planes.reshape(planes.shape[0], -1).sum(axis=1, dtype=numpy.int64)
+
+class ThresholdCounter():
+    """ Batched per-channel pixel counts without per-channel or per-pixel float temporaries.
+
+    Comparisons are written into boolean scratch buffers that are reused from one block to
+    the next, so counting any number of thresholds over a block of channels costs one
+    vectorised comparison and one boolean reduction each.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def _buffer(self, shape:tuple, index=0)->numpy.ndarray:
+        key = (shape, index)
+        if key not in self._buffers:
+            # Blocks all share the same shape except possibly the last one
+            self._buffers = {k:v for k, v in self._buffers.items() if k[0] == shape}
+            self._buffers[key] = numpy.empty(shape, dtype=bool)
+        return self._buffers[key]
+
+    def count_above(self, block:numpy.ndarray, thresholds:list, axis:int)->numpy.ndarray:
+        """ Count, per channel, the pixels above each threshold.
+
+        Args:
+            block (numpy.ndarray): Block of pixel values.
+            thresholds (list): Threshold values.
+            axis (int): Channel axis of block.
+
+        Returns:
+            numpy.ndarray: Counts, shape [len(thresholds), nchan_block].
+        """
+
+        above = self._buffer(block.shape)
+        counts = numpy.empty((len(thresholds), block.shape[axis]), dtype=numpy.int64)
+        for i, threshold in enumerate(thresholds):
+            numpy.greater(block, threshold, out=above)
+            counts[i] = _count_per_channel(above, axis)
+
+        return counts
+
+class ImageStatsEngine():
+    """ Single pass image statistics.
+
+    Accumulates, from blocks of channels of a CASA image ([x, y, stokes, chan] as returned
+    by ia.getchunk()), everything image_stats() previously obtained from separate passes
+    over the image:
+
+        - npts, sum, rms, min/max and their positions over the unmasked, finite pixels
+          (as ia.statistics()),
+        - the per-channel rms (as ia.statistics(axes=[0,1])),
+        - the number of non-NaN (npts_real, ±inf included), finite and non-zero pixels,
+        - per-channel counts of pixels above a set of thresholds.
+
+    Sums are accumulated per channel in float64 (numpy pairwise summation) and combined
+    with math.fsum(), so the result does not depend on the block size. Ties for the
+    min/max positions are resolved as ia.statistics() does, in favour of the first pixel
+    in Fortran (x fastest, channel slowest) order.
+    """
+
+    def __init__(self, shape:list, thresholds=None):
+        """
+        Args:
+            shape (list): Image shape [nx, ny, nstokes, nchan].
+            thresholds (list, optional): Values for the per-channel threshold counts. Defaults to None.
+        """
+
+        self.shape = [int(n) for n in shape]
+        self.thresholds = list(thresholds or [])
+
+        nchan = self.shape[3]
+        self.chan_npts = numpy.zeros(nchan, dtype=numpy.int64)
+        self.chan_sum = numpy.zeros(nchan, dtype=numpy.float64)
+        self.chan_sumsq = numpy.zeros(nchan, dtype=numpy.float64)
+        self.chan_finite = numpy.zeros(nchan, dtype=numpy.int64)
+        self.chan_notnan = numpy.zeros(nchan, dtype=numpy.int64)
+        self.chan_counts = numpy.zeros((len(self.thresholds), nchan), dtype=numpy.int64)
+        self.chan_posinf = numpy.zeros(nchan, dtype=numpy.int64)
+        self.nonzero = 0
+        self._counter = ThresholdCounter()
+
+        self.min = math.inf
+        self.max = -math.inf
+        self.minpos = None
+        self.maxpos = None
+
+    def update(self, block:numpy.ndarray, mask:numpy.ndarray, chan0=0)->None:
+        """ Add a block of consecutive channels.
+
+        Args:
+            block (numpy.ndarray): Pixel values, shape [nx, ny, nstokes, nchan_block].
+            mask (numpy.ndarray): Pixel mask (True for good pixels), same shape or None.
+            chan0 (int, optional): Index of the first channel of the block. Defaults to 0.
+        """
+
+        nchan = block.shape[3]
+        chans = slice(chan0, chan0 + nchan)
+        axes = (0, 1, 2)
+
+        finite = numpy.isfinite(block)
+        good = finite if mask is None else numpy.logical_and(finite, mask)
+
+        self.chan_finite[chans] += finite.sum(axis=axes)
+        self.chan_notnan[chans] += numpy.count_nonzero(~numpy.isnan(block), axis=axes)
+        self.chan_npts[chans] += good.sum(axis=axes)
+        self.nonzero += numpy.count_nonzero(block)
+
+        values = numpy.where(good, block, 0.0).astype(numpy.float64, copy=False)
+        self.chan_sum[chans] += values.sum(axis=axes)
+        self.chan_sumsq[chans] += numpy.einsum('ijkl,ijkl->l', values, values)
+
+        if len(self.thresholds) > 0:
+            self.chan_counts[:, chans] += self._counter.count_above(block, self.thresholds, axis=3)
+            self.chan_posinf[chans] += numpy.isposinf(block).sum(axis=axes)
+
+        if good.any():
+            self._update_extremum(numpy.where(good, block, numpy.inf), chan0, 'min')
+            self._update_extremum(numpy.where(good, block, -numpy.inf), chan0, 'max')
+
+    def _update_extremum(self, values:numpy.ndarray, chan0:int, which:str)->None:
+        flat = values.ravel(order='F')
+        index = int(flat.argmin()) if which == 'min' else int(flat.argmax())
+        value = float(flat[index])
+
+        current = getattr(self, which)
+        if (which == 'min' and value < current) or (which == 'max' and value > current):
+            pos = list(numpy.unravel_index(index, values.shape, order='F'))
+            pos[3] += chan0
+            setattr(self, which, value)
+            setattr(self, which + 'pos', [int(p) for p in pos])
+
+    def result(self)->dict:
+        """ Return the accumulated statistics.
+
+        Returns:
+            dict: npts, npts_real, sum, rms, min, minpos, max, maxpos, nonzero,
+                rms_per_chan (list), npts_per_chan (list), finite_per_chan (list),
+                counts (threshold -> per-channel list) and posinf_per_chan (list, the
+                +inf pixels, included in counts).
+        """
+
+        npts = int(self.chan_npts.sum())
+        chan_npts = numpy.maximum(self.chan_npts, 1)
+
+        return {
+            'npts':npts,
+            'npts_real':int(self.chan_notnan.sum()),
+            'sum':math.fsum(self.chan_sum),
+            'rms':math.sqrt(math.fsum(self.chan_sumsq)/npts) if npts > 0 else 0.0,
+            'min':self.min,
+            'minpos':self.minpos,
+            'max':self.max,
+            'maxpos':self.maxpos,
+            'nonzero':int(self.nonzero),
+            'rms_per_chan':numpy.sqrt(self.chan_sumsq/chan_npts).tolist(),
+            'npts_per_chan':self.chan_npts.tolist(),
+            'finite_per_chan':self.chan_finite.tolist(),
+            'posinf_per_chan':self.chan_posinf.tolist(),
+            'counts':{threshold:self.chan_counts[i].tolist() for i, threshold in enumerate(self.thresholds)}}
+
+class RegionCounter():
+    """ Counts the connected regions of a mask cube fed in blocks of consecutive channels.
+
+    Each block is labelled with scipy.ndimage.label() (default, face connectivity) and the
+    regions touching across a block boundary, i.e. the same pixel in the last channel of a
+    block and the first channel of the next one, are merged with a union-find. The count
+    is the same as labelling the whole cube at once, but only one block of labels is held
+    in memory.
+    """
+
+    def __init__(self):
+        self.nlabels = 0
+        self.nmerged = 0
+        self._parent = {}
+        self._last = None
+
+    def _find(self, label:int)->int:
+        root = label
+        while self._parent.get(root, root) != root:
+            root = self._parent[root]
+        while label != root:
+            self._parent[label], label = root, self._parent.get(label, label)
+        return root
+
+    def update(self, block:numpy.ndarray)->None:
+        """ Add a block of channels, channel axis first ([chan, ..., y, x]). """
+
+        labels, nlabels = scipy.ndimage.label(block)
+        labels[labels > 0] += self.nlabels
+
+        if self._last is not None:
+            touching = numpy.logical_and(self._last > 0, labels[0] > 0)
+            for a, b in set(zip(self._last[touching].tolist(), labels[0][touching].tolist())):
+                root_a, root_b = self._find(a), self._find(b)
+                if root_a != root_b:
+                    self._parent[root_b] = root_a
+                    self.nmerged += 1
+
+        self._last = labels[-1].copy()
+        self.nlabels += nlabels
+
+    def count(self)->int:
+        """ Return the number of connected regions. """
+
+        return self.nlabels - self.nmerged
+
+class ChannelRegionCounter():
+    """ Counts the connected regions of each channel of a mask cube fed in blocks of
+        consecutive channels.
+
+    Unlike RegionCounter, regions aren't connected across channels: every channel plane is
+    labelled on its own with scipy.ndimage.label(), with face (connectivity=1) or face and
+    corner (connectivity=2, up to the number of plane axes) neighbours. The planes of a
+    block are labelled by a pool of threads and only the label arrays of the planes being
+    labelled are held in memory. The per-channel region counts and the pixel areas of the
+    regions of each channel are kept.
+    """
+
+    def __init__(self, connectivity=1, workers=1):
+        """
+        Args:
+            connectivity (int, optional): Neighbourhood of scipy.ndimage.generate_binary_structure(). Defaults to 1.
+            workers (int, optional): Number of threads labelling planes. Defaults to 1.
+        """
+
+        self.connectivity = connectivity
+        self.counts = []
+        self.areas = []
+        self._structure = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def _label(self, plane:numpy.ndarray)->tuple:
+        labels, nlabels = scipy.ndimage.label(plane, structure=self._structure)
+        areas = numpy.bincount(labels.ravel(), minlength=nlabels + 1)[1:]
+
+        return nlabels, areas.tolist()
+
+    def update(self, block:numpy.ndarray)->None:
+        """ Add a block of channels, channel axis first ([chan, ..., y, x]). """
+
+        if self._structure is None:
+            self._structure = scipy.ndimage.generate_binary_structure(block.ndim - 1, self.connectivity)
+
+        planes = [block[i] for i in range(block.shape[0])]
+        results = map(self._label, planes) if self._executor == None else self._executor.map(self._label, planes)
+        for nlabels, areas in results:
+            self.counts.append(int(nlabels))
+            self.areas.append(areas)
+
+    def count(self)->int:
+        """ Return the total number of regions over all channels. """
+
+        return sum(self.counts)
+
+    def close(self)->None:
+        """ Stop the labelling threads. """
+
+        if self._executor != None:
+            self._executor.shutdown()
+            self._executor = None
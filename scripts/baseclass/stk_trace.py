@@ -0,0 +1,109 @@
+##########################################################################
+##########################################################################
+# stk_trace.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+
+import os
+import json
+import time
+import threading
+
+class _NullSpan():
+    """ Span returned while tracing is disabled; entering and leaving it does nothing. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = _NullSpan()
+
+class _Span():
+    """ Timed span recorded as a Chrome trace complete ('X') event. """
+
+    __slots__ = ('tracer', 'name', 'args', 'start')
+
+    def __init__(self, tracer, name:str, args:dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.tracer.add_event(self.name, self.start, end, self.args)
+        return False
+
+class Tracer():
+    """ Collects timing spans of a stakeholder test and writes them as a Chrome trace
+        (chrome://tracing, https://ui.perfetto.dev) JSON file.
+
+        Usage:
+            with self.tracer.span('tclean iter0'):
+                tclean(...)
+
+        When the tracer is disabled span() returns a shared no-op context manager.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = []
+        self._origin = time.perf_counter()
+
+    def span(self, name:str, **args):
+        """ Return a context manager timing the enclosed code as span name.
+
+        Args:
+            name (str): Name of the span.
+            **args: Extra values shown with the span in the trace viewer.
+        """
+
+        if not self.enabled:
+            return _null_span
+
+        return _Span(self, name, args)
+
+    def add_event(self, name:str, start:float, end:float, args=None, pid=None, tid=None)->None:
+        """ Record a complete event from time.perf_counter() start and end values. """
+
+        if not self.enabled:
+            return
+
+        self.events.append({
+            'name':name,
+            'ph':'X',
+            'ts':(start - self._origin)*1e6,
+            'dur':(end - start)*1e6,
+            'pid':os.getpid() if pid == None else pid,
+            'tid':threading.get_ident() if tid == None else tid,
+            'args':args or {}})
+
+    def save(self, outfilename:str)->None:
+        """ Write the recorded spans to a Chrome trace JSON file. """
+
+        if not self.enabled:
+            return
+
+        with open(outfilename, 'w') as outf:
+            json.dump({'traceEvents':self.events, 'displayTimeUnit':'ms'}, outf, default=str)
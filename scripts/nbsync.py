@@ -174,18 +174,19 @@ def indent_lines(lines, indent, indent_whitespace_lines):
 			lines[i] = indent + line
 	return lines
 
-def find_files():
+def find_files(file_stem=None):
 	currdir = Path(os.getcwd())
 	basedir = Path(currdir).parent.absolute()
 
-	# find the only recognized unittest .py file
-	ut_name = str(Path(basedir, 'stakeholder/scripts', 'test_standard_cube_briggsbwtaper.py'))
+	# find the unittest .py file, test_standard_cube_briggsbwtaper.py by default
+	ut_stem = file_stem if (file_stem != None) else 'test_standard_cube_briggsbwtaper'
+	ut_name = str(Path(basedir, 'stakeholder/scripts', ut_stem + '.py'))
 	if not os.path.exists(ut_name):
 		raise RuntimeError(f"Can't find unittest file {ut_name}")
 	ut_files = [ut_name]
 
 	# find jupyter notebook .ipynb files
-	nb_names = list(currdir.glob("*.ipynb"))
+	nb_names = list(currdir.glob("*.ipynb" if (file_stem == None) else file_stem + ".ipynb"))
 	if len(nb_names) == 0:
 		raise RuntimeError(f"Can't find any Jupyter notebook files at {currdir}")
 	nb_files = [str(Path(currdir, nb_name)) for nb_name in nb_names]
@@ -296,7 +297,7 @@ def update_sections_in_file(file_name, sections_to_update, mode='tonb'):
 			section_lines = [line+'\n' for line in section_lines] # .ipynb json needs extra '\n' characters
 			section_lines[-1] = section_lines[-1].rstrip() #        ...except for the last line
 			parsed['cells'][section.cell_idx]['source'] = update_section(section, parsed['cells'][section.cell_idx]['source'], section_lines)
-		outstr = json.dumps(parsed, indent=2)
+		outstr = json.dumps(parsed, indent=1, ensure_ascii=False) + '\n' # as written by Jupyter
 		with open(file_name, 'w') as fout:
 			fout.write(outstr)
 	else:
@@ -321,7 +322,7 @@ if __name__ == "__main__":
 	args = parser.parse_args()
 	
 	# catalog all sections
-	ut_files, nb_files = find_files()
+	ut_files, nb_files = find_files(args.file_stem)
 	ut_sections = get_ut_sections(ut_files)
 	nb_sections = get_nb_sections(nb_files)
 	if (args.verbose >= 2):
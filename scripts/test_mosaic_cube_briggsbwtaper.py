@@ -60,7 +60,7 @@
 
     * NOTE for updating the tests and fiducial values in json file *
     When the json file is updated and its 'casa_version'
-    could also be updated then self.refversion in the setUp() needs to be updated to
+    could also be updated then fiducials: refversion in config/config.yaml needs to be updated to
     match with the 'casa_version' as defined in the json file otherwise 
     almastkteestutils.read_testcase_expdicts() print an error message.
 
@@ -82,11 +82,10 @@
 ##########################################################################
 
 import os
+import inspect
 import unittest
 import shutil
 import matplotlib.pyplot as pyplot
-import copy
-import casatasks
 
 from casatestutils.imagerhelpers import TestHelpers
 
@@ -113,6 +112,8 @@ sys.path.append(__stakeholder_path)
 # ======================================
 
 from scripts.baseclass.stakeholder_base_class import test_stakeholder_base
+from scripts.baseclass.stk_compare import FiducialReport
+from scripts.baseclass.stk_checkpoint import tclean_products
 
 _ia = image()
 ctsys_resolve = ctsys.resolve
@@ -165,60 +166,74 @@ class Test_standard(test_stakeholder_base):
         file_name = self.file_name
         parallel = self.parallel
 
-        # %% test_mosaic_cube_briggsbwtaper_tclean_1 start @
-
-        # iter0 routine
-        casatasks.tclean(vis=msfile, field='SMIDGE_NWCloud', spw=['0'], \
-            antenna=['0,1,2,3,4,5,6,7,8'], scan=['8,12,16'], \
-            intent='OBSERVE_TARGET#ON_SOURCE', datacolumn='data', \
-            imagename=file_name+'0', imsize=[108, 108], cell=['1.1arcsec'], \
-            phasecenter='ICRS 00:45:54.3836 -073.15.29.413', stokes='I', \
-            specmode='cube', nchan=508, start='220.2526743594GHz', \
-            width='0.2441741MHz', outframe='LSRK', \
-            perchanweightdensity=True, gridder='mosaic', \
-            mosweight=True, usepointing=False, pblimit=0.2, \
-            deconvolver='hogbom', restoration=False, restoringbeam='common', \
-            pbcor=False, weighting='briggsbwtaper', robust=0.5, npixels=0, niter=0, \
-            threshold='0.0mJy', interactive=0, usemask='auto-multithresh', \
-            sidelobethreshold=1.25, noisethreshold=5.0, \
-            lownoisethreshold=2.0, negativethreshold=0.0, minbeamfrac=0.1, \
-            growiterations=75, dogrowprune=True, minpercentchange=1.0, \
-            fastnoise=False, savemodel='none', parallel=parallel,
-            verbose=True)
-
-        # %% test_mosaic_cube_briggsbwtaper_tclean_1 end @
+        # a change of the imaging code runs the imaging stages again with --resume
+        clean_code = inspect.getsource(self.standard_cube_clean)
+
+        if self.checkpoints.skip('tclean iter0', tclean_products(file_name+'0'), inputs=[msfile], code=clean_code) is False:
+            with self.tracer.span('tclean iter0'):
+                # iter0 products may come from the product cache, see cached_tclean()
+                run_tclean = self.cached_tclean
+                # %% test_mosaic_cube_briggsbwtaper_tclean_1 start @
+
+                # iter0 routine
+                run_tclean(vis=msfile, field='SMIDGE_NWCloud', spw=['0'], \
+                    antenna=['0,1,2,3,4,5,6,7,8'], scan=['8,12,16'], \
+                    intent='OBSERVE_TARGET#ON_SOURCE', datacolumn='data', \
+                    imagename=file_name+'0', imsize=[108, 108], cell=['1.1arcsec'], \
+                    phasecenter='ICRS 00:45:54.3836 -073.15.29.413', stokes='I', \
+                    specmode='cube', nchan=508, start='220.2526743594GHz', \
+                    width='0.2441741MHz', outframe='LSRK', \
+                    perchanweightdensity=True, gridder='mosaic', \
+                    mosweight=True, usepointing=False, pblimit=0.2, \
+                    deconvolver='hogbom', restoration=False, restoringbeam='common', \
+                    pbcor=False, weighting='briggsbwtaper', robust=0.5, npixels=0, niter=0, \
+                    threshold='0.0mJy', interactive=0, usemask='auto-multithresh', \
+                    sidelobethreshold=1.25, noisethreshold=5.0, \
+                    lownoisethreshold=2.0, negativethreshold=0.0, minbeamfrac=0.1, \
+                    growiterations=75, dogrowprune=True, minpercentchange=1.0, \
+                    fastnoise=False, savemodel='none', parallel=parallel,
+                    verbose=True)
+
+                # %% test_mosaic_cube_briggsbwtaper_tclean_1 end @
+            self.checkpoints.done('tclean iter0')
 
         # move files to iter1
-        print('Copying iter0 files to iter1')
-        self.copy_products(self.file_name+'0', self.file_name+'1')
+        if self.checkpoints.skip('copy_products', tclean_products(file_name+'1'), inputs=tclean_products(file_name+'0'), code=clean_code) is False:
+            print('Copying iter0 files to iter1')
+            self.copy_products(self.file_name+'0', self.file_name+'1')
+            self.checkpoints.done('copy_products')
 
         print("STARTING: iter1 routine")
 
-        # %% test_mosaic_cube_briggsbwtaper_tclean_2 start @
-
-        # iter1 (restart)
-        casatasks.tclean(vis=msfile, field='SMIDGE_NWCloud', spw=['0'], \
-            antenna=['0,1,2,3,4,5,6,7,8'],scan=['8,12,16'], \
-            intent='OBSERVE_TARGET#ON_SOURCE', datacolumn='data', \
-            imagename=file_name+'1', imsize=[108, 108], \
-            cell=['1.1arcsec'], phasecenter='ICRS 00:45:54.3836'
-            ' -073.15.29.413', stokes='I', specmode='cube', nchan=508, \
-            start='220.2526743594GHz', width='0.2441741MHz', \
-            outframe='LSRK', perchanweightdensity=True, \
-            gridder='mosaic', mosweight=True, \
-            usepointing=False, pblimit=0.2, deconvolver='hogbom', \
-            restoration=True, restoringbeam='common', \
-            pbcor=True, weighting='briggsbwtaper', robust=0.5,\
-            npixels=0, niter=20000, threshold='0.354Jy', nsigma=0.0, \
-            interactive=0, usemask='auto-multithresh', \
-            sidelobethreshold=1.25, noisethreshold=5.0, \
-            lownoisethreshold=2.0, negativethreshold=0.0, \
-            minbeamfrac=0.1, growiterations=75, dogrowprune=True, \
-            minpercentchange=1.0, fastnoise=False, restart=True, \
-            savemodel='none', calcres=False, calcpsf=False, \
-            parallel=parallel, verbose=True)
-
-        # %% test_mosaic_cube_briggsbwtaper_tclean_2 end @
+        if self.checkpoints.skip('tclean iter1', tclean_products(file_name+'1'), inputs=[msfile], code=clean_code) is False:
+            with self.tracer.span('tclean iter1'):
+                run_tclean = self.run_tclean
+                # %% test_mosaic_cube_briggsbwtaper_tclean_2 start @
+
+                # iter1 (restart)
+                run_tclean(vis=msfile, field='SMIDGE_NWCloud', spw=['0'], \
+                    antenna=['0,1,2,3,4,5,6,7,8'],scan=['8,12,16'], \
+                    intent='OBSERVE_TARGET#ON_SOURCE', datacolumn='data', \
+                    imagename=file_name+'1', imsize=[108, 108], \
+                    cell=['1.1arcsec'], phasecenter='ICRS 00:45:54.3836'
+                    ' -073.15.29.413', stokes='I', specmode='cube', nchan=508, \
+                    start='220.2526743594GHz', width='0.2441741MHz', \
+                    outframe='LSRK', perchanweightdensity=True, \
+                    gridder='mosaic', mosweight=True, \
+                    usepointing=False, pblimit=0.2, deconvolver='hogbom', \
+                    restoration=True, restoringbeam='common', \
+                    pbcor=True, weighting='briggsbwtaper', robust=0.5,\
+                    npixels=0, niter=20000, threshold='0.354Jy', nsigma=0.0, \
+                    interactive=0, usemask='auto-multithresh', \
+                    sidelobethreshold=1.25, noisethreshold=5.0, \
+                    lownoisethreshold=2.0, negativethreshold=0.0, \
+                    minbeamfrac=0.1, growiterations=75, dogrowprune=True, \
+                    minpercentchange=1.0, fastnoise=False, restart=True, \
+                    savemodel='none', calcres=False, calcpsf=False, \
+                    parallel=parallel, verbose=True)
+
+                # %% test_mosaic_cube_briggsbwtaper_tclean_2 end @
+            self.checkpoints.done('tclean iter1')
 
 
     def standard_cube_report(self):
@@ -226,18 +241,34 @@ class Test_standard(test_stakeholder_base):
         bmin_dict, bmaj_dict, pa_dict = \
             self.cube_beam_stats(image=self.img+'.psf')
 
+        # statistics of the imaging products, computed side by side (.model needs the
+        # .mask statistics and .weight the .pb masks)
+        stats = self.products_stats({
+            'image':dict(image=self.img+'.image', fit_region = \
+                'ellipse[[11.48661818deg, -73.26292371deg], [8.2211arcsec, 7.4698arcsec], 90.00000000deg]', field_regions = \
+                ['circle[[00:45:54.383559, -73.15.29.41306], 22.45arcsec]',
+                 'circle[[00:45:49.435664, -73.15.35.13742], 22.45arcsec]',
+                 'circle[[00:45:53.057440, -73.15.50.79016], 22.45arcsec]',
+                 'circle[[00:45:50.762696, -73.15.13.76177], 22.45arcsec]',
+                 'circle[[00:45:58.006248, -73.15.45.06040], 22.45arcsec]',
+                 'circle[[00:45:55.708764, -73.15.08.03543], 22.45arcsec]',
+                 'circle[[00:45:59.330540, -73.15.23.68133], 22.45arcsec]']),
+            'mask':dict(image=self.img+'.mask'),
+            'pb':dict(image=self.img+'.pb', fit_region = \
+                'ellipse[[11.47666677deg, -73.25825652deg], [52.6715arcsec, 52.2589arcsec], 0.00000000deg]'),
+            'psf':dict(image=self.img+'.psf', fit_region = \
+                'ellipse[[11.47632032deg, -73.25823681deg], [8.7257arcsec, 8.0720arcsec], 90.00000000deg]'),
+            'residual':dict(image=self.img+'.residual', fit_region = \
+                'ellipse [[11.48661818deg, -73.26292371deg], [8.2211arcsec, 7.4698arcsec], 90.00000000deg]'),
+            'model':dict(image=self.img+'.model', fit_region = \
+                'ellipse[[11.48109199deg, -73.25974151deg], [18.9246arcsec, 17.1916arcsec], 0.00000000deg]', masks=('mask', 'mask')),
+            'sumwt':dict(image=self.img+'.sumwt'),
+            'weight':dict(image=self.img+'.weight', masks=('pb', ['pb_mask_0.2', 'pb_mask_0.5']))})
+
         report0 = th.checkall(imgexist = self.image_list(self.img, 'mosaic'))
 
         # .image report (test_mosaic_cube_briggsbwtaper)
-        im_stats_dict = self.image_stats(self.img+'.image', fit_region = \
-            'ellipse[[11.48661818deg, -73.26292371deg], [8.2211arcsec, 7.4698arcsec], 90.00000000deg]', field_regions = \
-            ['circle[[00:45:54.383559, -73.15.29.41306], 22.45arcsec]',
-             'circle[[00:45:49.435664, -73.15.35.13742], 22.45arcsec]',
-             'circle[[00:45:53.057440, -73.15.50.79016], 22.45arcsec]',
-             'circle[[00:45:50.762696, -73.15.13.76177], 22.45arcsec]',
-             'circle[[00:45:58.006248, -73.15.45.06040], 22.45arcsec]',
-             'circle[[00:45:55.708764, -73.15.08.03543], 22.45arcsec]',
-             'circle[[00:45:59.330540, -73.15.23.68133], 22.45arcsec]'])
+        im_stats_dict = stats['image']
 
         # test_standard_cube.exp_im_stats
         exp_im_stats = self._exp_dicts['exp_im_stats']
@@ -250,75 +281,72 @@ class Test_standard(test_stakeholder_base):
                       (self.img+'.image', False, [8, 56, 0, 0])])
 
         # .image report
-        report2 = th.check_dict_vals(exp_im_stats, im_stats_dict, '.image', epsilon=self.epsilon)
+        report2 = self.check_dict_vals(exp_im_stats, im_stats_dict, '.image', epsilon=self.epsilon)
 
         # .mask report (test_mosaic_cube_briggsbwtaper)
-        mask_stats_dict = self.image_stats(self.img+'.mask')
+        mask_stats_dict = stats['mask']
 
         # test_mosaic_cube_briggsbwtaper.exp_mask_stats
         exp_mask_stats = self._exp_dicts['exp_mask_stats']
 
-        report3 = th.check_dict_vals(exp_mask_stats, mask_stats_dict, '.mask', epsilon=self.epsilon)
+        report3 = self.check_dict_vals(exp_mask_stats, mask_stats_dict, '.mask', epsilon=self.epsilon)
 
         # .pb report (test_mosaic_cube_briggsbwtaper)
-        pb_stats_dict = self.image_stats(self.img+'.pb', fit_region = \
-            'ellipse[[11.47666677deg, -73.25825652deg], [52.6715arcsec, 52.2589arcsec], 0.00000000deg]')
+        pb_stats_dict = stats['pb']
 
         # test_mosaic_cube_briggsbwtaper.exp_pb_stats
         exp_pb_stats = self._exp_dicts['exp_pb_stats']
 
-        report4 = th.check_dict_vals(exp_pb_stats, pb_stats_dict, '.pb', epsilon=self.epsilon)
+        report4 = self.check_dict_vals(exp_pb_stats, pb_stats_dict, '.pb', epsilon=self.epsilon)
 
         # .psf report (test_mosaic_cube_briggsbwtaper)
-        psf_stats_dict = self.image_stats(self.img+'.psf', fit_region = \
-            'ellipse[[11.47632032deg, -73.25823681deg], [8.7257arcsec, 8.0720arcsec], 90.00000000deg]')
+        psf_stats_dict = stats['psf']
 
         # test_mosaic_cube_briggsbwtaper.exp_psf_stats
         exp_psf_stats = self._exp_dicts['exp_psf_stats']
 
-        report5 = th.check_dict_vals(exp_psf_stats, psf_stats_dict, '.psf', epsilon=self.epsilon)
+        report5 = self.check_dict_vals(exp_psf_stats, psf_stats_dict, '.psf', epsilon=self.epsilon)
 
         # .residual report (test_mosaic_cube_briggsbwtaper)
-        resid_stats_dict = self.image_stats(self.img+'.residual', fit_region = \
-            'ellipse [[11.48661818deg, -73.26292371deg], [8.2211arcsec, 7.4698arcsec], 90.00000000deg]')
+        resid_stats_dict = stats['residual']
 
         # test_mosaic_cube_briggsbwtaper.exp_resid_stats
         exp_resid_stats = self._exp_dicts['exp_resid_stats']
 
-        report6 = th.check_dict_vals(exp_resid_stats, resid_stats_dict, \
+        report6 = self.check_dict_vals(exp_resid_stats, resid_stats_dict, \
             '.residual', epsilon=self.epsilon)
 
         # .model report (test_mosaic_cube_briggsbwtaper)
-        model_stats_dict = self.image_stats(self.img+'.model', fit_region = \
-            'ellipse[[11.48109199deg, -73.25974151deg], [18.9246arcsec, 17.1916arcsec], 0.00000000deg]', masks=mask_stats_dict['mask'])
+        model_stats_dict = stats['model']
 
         # test_mosaic_cube_briggsbwtaper.exp_model_stats
         exp_model_stats = self._exp_dicts['exp_model_stats']
 
-        report7 = th.check_dict_vals(exp_model_stats, model_stats_dict, \
+        report7 = self.check_dict_vals(exp_model_stats, model_stats_dict, \
             '.model', epsilon=self.epsilon)
 
         # .sumwt report (test_mosaic_cube)
-        sumwt_stats_dict = self.image_stats(self.img+'.sumwt')
+        sumwt_stats_dict = stats['sumwt']
 
         # test_mosaic_cube_briggsbwtaper.exp_sumwt_stats
         exp_sumwt_stats = self._exp_dicts['exp_sumwt_stats']
 
-        report8 = th.check_dict_vals(exp_sumwt_stats, sumwt_stats_dict, \
+        report8 = self.check_dict_vals(exp_sumwt_stats, sumwt_stats_dict, \
             '.sumwt', epsilon=self.epsilon)
 
         # .weight report
-        wt_stats_dict = self.image_stats(self.img+'.weight', masks=[ \
-            pb_stats_dict['pb_mask_0.2'], pb_stats_dict['pb_mask_0.5']])
+        wt_stats_dict = stats['weight']
 
         #test_mosaic_cube_briggsbwtaper.exp_wt_stats
         exp_wt_stats = self._exp_dicts['exp_wt_stats']
 
-        report9 = th.check_dict_vals(exp_wt_stats, wt_stats_dict, '.weight', epsilon=self.epsilon)
+        report9 = self.check_dict_vals(exp_wt_stats, wt_stats_dict, '.weight', epsilon=self.epsilon)
 
-        # report combination
-        report = report0 + report1 + report2 + report3 + report4 + report5 + \
-            report6 + report7 + report8 + report9
+        # report combination: text of the th.checkall() checks, then the fiducial check records
+        report = FiducialReport()
+        report.add_text(report0 + report1)
+        report.add(report2 + report3 + report4 + report5 + \
+            report6 + report7 + report8 + report9)
 
         if self.parallel:
             # test_mosaic_cube_briggsbwtaper.exp_bmin_dict
@@ -330,9 +358,9 @@ class Test_standard(test_stakeholder_base):
             # test_mosaic_cube_briggsbwtaper.exp_pa_dict
             exp_pa_dict = self._exp_dicts['exp_pa_dict']
 
-            report += self.check_dict_vals_beam(exp_bmin_dict, bmin_dict, '.image bmin', epsilon=self.epsilon)
-            report += self.check_dict_vals_beam(exp_bmaj_dict, bmaj_dict, '.image bmaj', epsilon=self.epsilon)
-            report += self.check_dict_vals_beam(exp_pa_dict, pa_dict, '.image pa', epsilon=self.epsilon)
+            report.add(self.check_dict_vals_beam(exp_bmin_dict, bmin_dict, '.image bmin', epsilon=self.epsilon))
+            report.add(self.check_dict_vals_beam(exp_bmaj_dict, bmaj_dict, '.image bmaj', epsilon=self.epsilon))
+            report.add(self.check_dict_vals_beam(exp_pa_dict, pa_dict, '.image pa', epsilon=self.epsilon))
 
         failed = self.filter_report(report)
 
@@ -343,27 +371,33 @@ class Test_standard(test_stakeholder_base):
 
         self.modify_dict(test_dict, self.test_name, self.parallel)
 
-        test_dict['test_mosaic_cube_briggsbwtaper']['report'] = report
+        test_dict['test_mosaic_cube_briggsbwtaper']['report'] = report.render()
         test_dict['test_mosaic_cube_briggsbwtaper']['images'] = []
 
-        if os.path.isdir(os.getcwd() + '/' + self.img + '.image.moment8'):
-            try:
-                print('Removing moment8 file.')
-                shutil.rmtree(os.getcwd() + '/' + self.img + '.image.moment8')
-            except FileNotFoundError:
-                print('Failure to remove file: ' + os.getcwd() + '/' + self.img + '.image.moment8')
-
-        if os.path.isdir(os.getcwd() + '/' + self.img + '.residual.moment8'):
-            try:
-                shutil.rmtree(os.getcwd() + '/' + self.img + '.residual.moment8')
-            except FileNotFoundError:
-                print('Failure to remove file: ' + os.getcwd() + '/' + self.img + '.residual.moment8')
-
-        immoments(imagename=self.img+'.image', moments = 8, outfile = self.img +'.image.moment8')
-        plt_utils.plot_image(imname=self.img+'.image', type='.moment8', chan=0, trim=True)
+        if self.checkpoints.skip('moment8', [self.img+'.image.moment8*', self.img+'.residual.moment8*'], inputs=[self.img+'.image', self.img+'.residual'], code=inspect.getsource(self.standard_cube_report) + inspect.getsource(plt_utils.plot_image)) is False:
+            if os.path.isdir(os.getcwd() + '/' + self.img + '.image.moment8'):
+                try:
+                    print('Removing moment8 file.')
+                    shutil.rmtree(os.getcwd() + '/' + self.img + '.image.moment8')
+                except FileNotFoundError:
+                    print('Failure to remove file: ' + os.getcwd() + '/' + self.img + '.image.moment8')
+
+            if os.path.isdir(os.getcwd() + '/' + self.img + '.residual.moment8'):
+                try:
+                    shutil.rmtree(os.getcwd() + '/' + self.img + '.residual.moment8')
+                except FileNotFoundError:
+                    print('Failure to remove file: ' + os.getcwd() + '/' + self.img + '.residual.moment8')
+
+            with self.tracer.span('immoments', image=self.img+'.image'):
+                immoments(imagename=self.img+'.image', moments = 8, outfile = self.img +'.image.moment8')
+            with self.tracer.span('plot_image', image=self.img+'.image.moment8'):
+                plt_utils.plot_image(imname=self.img+'.image', type='.moment8', chan=0, trim=True)
         
-        immoments(imagename=self.img+'.residual', moments = 8, outfile = self.img +'.residual.moment8')
-        plt_utils.plot_image(imname=self.img+'.residual', type='.moment8', chan=0, trim=True)
+            with self.tracer.span('immoments', image=self.img+'.residual'):
+                immoments(imagename=self.img+'.residual', moments = 8, outfile = self.img +'.residual.moment8')
+            with self.tracer.span('plot_image', image=self.img+'.residual.moment8'):
+                plt_utils.plot_image(imname=self.img+'.residual', type='.moment8', chan=0, trim=True)
+            self.checkpoints.done('moment8')
 
         test_dict[self.test_name]['images'].extend( \
             (self.img+'.image.moment8.png',self.img+'.residual.moment8.png'))
@@ -372,12 +406,7 @@ class Test_standard(test_stakeholder_base):
 
         if savemetricdict:
 
-            ### serialize ndarray in mask_stats_dcit
-            mask_stats_mod_dict = copy.deepcopy(mask_stats_dict)
-            mask_stats_mod_dict['mask'] = mask_stats_dict['mask'].tolist()
-            pb_stats_mod_dict = copy.deepcopy(pb_stats_dict)
-            pb_stats_mod_dict['pb_mask_0.2'] = pb_stats_dict['pb_mask_0.2'].tolist()
-            pb_stats_mod_dict['pb_mask_0.5'] = pb_stats_dict['pb_mask_0.5'].tolist()
+            # masks (ndarray) are bit-packed by save_dict_to_file
             
             #create a nested dictionary containing exp dictionaries to save
             savedict = {}
@@ -386,8 +415,8 @@ class Test_standard(test_stakeholder_base):
             # im_stats, mask_stats, pb_stats, psf_stats,\
             # model_stats, resid_stats, sumwt_stats, + wt_stats (mosaic)
             savedict['im_stats_dict']=im_stats_dict
-            savedict['mask_stats_dict']=mask_stats_mod_dict
-            savedict['pb_stats_dict']=pb_stats_mod_dict
+            savedict['mask_stats_dict']=mask_stats_dict
+            savedict['pb_stats_dict']=pb_stats_dict
             savedict['psf_stats_dict']=psf_stats_dict
             savedict['model_stats_dict']=model_stats_dict
             savedict['resid_stats_dict']=resid_stats_dict
@@ -401,7 +430,7 @@ class Test_standard(test_stakeholder_base):
 
             self.save_dict_to_file(self.test_name, savedict, self.test_name+'_cur_stats')
 
-        self.assertTrue(th.check_final(pstr = report), msg = failed)
+        self.assertTrue(th.check_final(pstr = report.render()), msg = failed)
         self.test_dict = test_dict
 
         if self._testMethodName is "runTest":
@@ -1,27 +1,738 @@
 import os
 import sys
+import glob
+import json
+import time
 import yaml
+import runpy
+import pickle
+import hashlib
+import shlex
+import threading
 import argparse
+import ast
+import importlib
+import shutil
+import traceback
 import subprocess
+import multiprocessing
 
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-def spawn_test(test:str)->'None':
-    cmd = 'python3 -m scripts.{}'.format(test)
+
+def read_proc_io(pid:int)->dict:
+    """ Return the read/write byte counters of a process from /proc/<pid>/io, or {} if they
+        are not available.
+    """
+
+    counters = {}
+    try:
+        with open('/proc/{}/io'.format(pid)) as file:
+            for line in file:
+                name, value = line.split(':')
+                counters[name.strip()] = int(value)
+    except (OSError, ValueError):
+        return {}
+
+    return {'read_bytes':counters.get('read_bytes'), 'write_bytes':counters.get('write_bytes'),
+        'rchar':counters.get('rchar'), 'wchar':counters.get('wchar')}
+
+def wait_with_usage(pid:int, start:float)->tuple:
+    """ Wait for a child process and account for its resource usage.
+
+        Where supported, the child is first waited for without being reaped, so that its
+        /proc I/O counters can still be read, then reaped with wait4() to obtain its rusage.
+
+    Args:
+        pid (int): Child process id.
+        start (float): Start time of the child (time.monotonic()).
+
+    Returns:
+        tuple: Exit status (negative if killed by a signal) and resource usage dictionary.
+    """
+
+    io = {}
+    if hasattr(os, 'waitid') and hasattr(os, 'WNOWAIT'):
+        try:
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+            io = read_proc_io(pid)
+        except ChildProcessError:
+            pass
+
+    _, status, rusage = os.wait4(pid, 0)
+    wall = time.monotonic() - start
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss*1024
+
+    usage = {'wall':wall, 'user':rusage.ru_utime, 'sys':rusage.ru_stime, 'peak_rss_bytes':maxrss}
+    usage.update(io)
+
+    returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+    return returncode, usage
+
+def test_environment(test:str)->dict:
+    """ Return the environment of a test process, which names the files it leaves for the
+        runner (e.g. <test>.test_dict.pickle) after STK_TEST_ID. """
+
+    return dict(os.environ, STK_TEST_ID=test)
+
+def spawn_test(test:str, ncores=1, mpi_command=None, logfile=None)->tuple:
+    """ Run a single stakeholder test in a child process.
+
+    Args:
+        test (str): Name of the test script in scripts/.
+        ncores (int, optional): Number of cores reserved for the test. Tests using more than
+            one core are launched through mpi_command. Defaults to 1.
+        mpi_command (str, optional): Launcher prefix for MPI tests, formatted with ncores.
+            Defaults to None.
+        logfile (str, optional): File receiving the test stdout/stderr. Defaults to None,
+            in which case the output goes to the terminal.
+
+    Returns:
+        tuple: Exit status and resource usage of the spawned process.
+    """
+
+    cmd = ['python3', '-m', 'scripts.{}'.format(test)]
+    if ncores > 1 and mpi_command != None:
+        cmd = shlex.split(mpi_command.format(ncores=ncores)) + cmd[1:]
+
+    start = time.monotonic()
+    if logfile != None:
+        with open(logfile, 'w') as log:
+            p = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=test_environment(test))
+    else:
+        p = subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stderr, env=test_environment(test))
+
+    # The child is reaped here, not by Popen.wait(), to collect its rusage.
+    returncode, usage = wait_with_usage(p.pid, start)
+    p.returncode = returncode
+
+    if returncode != 0:
+        print('{}: Error in completion of spawned process ({}).'.format(' '.join(cmd), returncode))
+
+    return returncode, usage
+
+def warm_imports(modules:list)->None:
+    """ Import the heavy modules shared by all tests once, in the fork server, so that
+        forked tests inherit them copy-on-write instead of importing them again.
+
+    Args:
+        modules (list): Names of the modules to import.
+    """
+
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except Exception as error:
+            print('Unable to preload {}: {}'.format(module, error))
+
+    # Initialise the measures data (IERS, observatories) used by the frame conversions.
+    if 'casatools' in sys.modules:
+        try:
+            me = sys.modules['casatools'].measures()
+            me.doframe(me.observatory('ALMA'))
+            me.doframe(me.epoch('utc', 'today'))
+            me.measure(me.direction('J2000', '0deg', '0deg'), 'AZEL')
+            me.done()
+        except Exception as error:
+            print('Unable to initialise measures data: {}'.format(error))
+
+def _run_forked_test(test:str, logfile=None)->None:
+    """ Run a test module in a forked child and exit with its status, never returns. """
+
+    status = 1
     try:
-        p = subprocess.check_call(cmd, stdout=sys.stdout, stderr=sys.stderr, shell=True)
+        if logfile != None:
+            fd = os.open(logfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(fd, sys.stdout.fileno())
+            os.dup2(fd, sys.stderr.fileno())
+            os.close(fd)
+
+        os.environ.update(test_environment(test))
+        sys.argv = [test]
+        runpy.run_module('scripts.{}'.format(test), run_name='__main__', alter_sys=True)
+        status = 0
+
+    except SystemExit as exit:
+        if exit.code is None:
+            status = 0
+        elif isinstance(exit.code, int):
+            status = exit.code
+        else:
+            print(exit.code)
+
+    except BaseException:
+        traceback.print_exc()
+
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+def _serve_forks(conn, modules:list)->None:
+    """ Main loop of the fork server: fork a child per test request and send back the
+        exit status and resource usage of each child as it finishes. """
+
+    warm_imports(modules)
+
+    children = {}
+    accepting = True
+    while accepting or len(children) > 0:
+        if accepting and conn.poll(0.1 if len(children) > 0 else None):
+            try:
+                request = conn.recv()
+            except EOFError:
+                request = ('exit',)
+
+            if request[0] == 'exit':
+                accepting = False
+            else:
+                _, request_id, test, logfile = request
+                sys.stdout.flush()
+                sys.stderr.flush()
+                start = time.monotonic()
+                pid = os.fork()
+                if pid == 0:
+                    conn.close()
+                    _run_forked_test(test, logfile)
+                children[pid] = (request_id, start)
+        elif accepting is False:
+            time.sleep(0.1)
+
+        for pid in list(children):
+            # Check without reaping, wait_with_usage() then reads the I/O counters
+            if os.waitid(os.P_PID, pid, os.WEXITED | os.WNOHANG | os.WNOWAIT) == None:
+                continue
+            request_id, start = children.pop(pid)
+            returncode, usage = wait_with_usage(pid, start)
+            conn.send((request_id, returncode, usage))
+
+class ForkServer():
+    """ Single-threaded process that imports the preload modules once and forks the tests.
+
+        The runner schedules tests from a pool of threads, and forking a multi-threaded
+        process that has imported casatools risks deadlocks on locks held by other threads
+        at the time of the fork. The server is forked from the runner before any thread is
+        started, and only ever forks from its single thread.
+    """
+
+    def __init__(self, modules:list):
+        """
+        Args:
+            modules (list): Names of the modules imported by the server.
+        """
+
+        self._conn, child_conn = multiprocessing.Pipe()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._conn.close()
+            status = 0
+            try:
+                _serve_forks(child_conn, modules)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+
+        child_conn.close()
+        self._lock = threading.Lock()
+        self._results = {}
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self)->None:
+        while True:
+            try:
+                request_id, returncode, usage = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            self._results[request_id].set_result((returncode, usage))
+
+        # The server is gone, fail the tests still waiting for it
+        for future in self._results.values():
+            if future.done() is False:
+                future.set_result((1, {}))
+
+    def run(self, test:str, logfile=None)->tuple:
+        """ Fork a test in the server and wait for it.
+
+        Returns:
+            tuple: Exit status and resource usage of the test process.
+        """
+
+        future = Future()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._results[request_id] = future
+            self._conn.send(('run', request_id, test, logfile))
+
+        return future.result()
+
+    def close(self)->None:
+        """ Stop the server once its running tests have finished. """
+
+        with self._lock:
+            self._conn.send(('exit',))
+        self._reader.join()
+        os.waitpid(self.pid, 0)
+
+_fork_server = None
+
+def fork_test(test:str, logfile=None)->int:
+    """ Run a single stakeholder test in a process forked by the fork server.
+
+        The test module is only imported in the child, so module level state such as
+        test_dict and the image tools is created fresh for every test, and a crash of the
+        child does not affect the runner.
+
+    Args:
+        test (str): Name of the test script in scripts/.
+        logfile (str, optional): File receiving the test stdout/stderr. Defaults to None.
+
+    Returns:
+        tuple: Exit status of the child process (negative if killed by a signal) and its
+            resource usage.
+    """
+
+    returncode, usage = _fork_server.run(test, logfile)
+    if returncode != 0:
+        print('{}: Error in completion of forked process ({}).'.format(test, returncode))
+
+    return returncode, usage
+
+_casaversion = None
+
+def casa_version()->str:
+    """ Return the casatasks version string, or '' when casatasks is not available. """
+
+    global _casaversion
+    if _casaversion != None:
+        return _casaversion
+
+    try:
+        import casatasks as __casatasks
+        casaversion = __casatasks.version_string()
+        del __casatasks
+    except:
+        casaversion = ''
+
+    _casaversion = casaversion
+
+    return casaversion
+
+def save_usage(test:str, usage:dict)->None:
+    """ Save the resource usage of a test next to its _cur_stats metric files, with the
+        casa version appended to the file name in the same way.
+    """
+
+    casaversion = casa_version()
+    suffix = '_' + casaversion if casaversion != '' else ''
+
+    with open(test + '_cur_resources' + suffix + '.json', 'w') as outf:
+        json.dump({test:dict(usage, casaversion=casaversion)}, outf, indent=2)
+
+class ResultCache():
+    """ Content addressed cache of passing test results.
+
+    The key of a test combines the test script (and the shared base class), the contents of
+    the measurement sets it reads under data_path, the fiducial JSON file and refversion,
+    and the casatasks version. File digests are memoised by (size, mtime) in an index kept
+    in the cache directory so that unchanged measurement sets are only hashed once.
+    """
+
+    def __init__(self, cache_dir:str, data_path:str, datasets:dict, fiducials:dict):
+        self.cache_dir = cache_dir
+        self.data_path = data_path
+        self.datasets = datasets
+        self.fiducials = fiducials
+        self.casaversion = casa_version()
+
+        self._lock = threading.Lock()
+        self._index_file = os.path.join(cache_dir, 'digests.json')
+        self._index = {}
+
+        if os.path.isdir(cache_dir) is False:
+            os.makedirs(cache_dir)
+
+        if os.path.exists(self._index_file):
+            with open(self._index_file) as file:
+                self._index = json.load(file)
+
+    def file_digest(self, path:str)->str:
+        """ Return the sha256 digest of a file, reusing the memoised value if the file size
+            and modification time are unchanged.
+        """
+
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._index.get(path)
+        if entry != None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['digest']
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+
+        with self._lock:
+            self._index[path] = {'size':stat.st_size, 'mtime':stat.st_mtime_ns, 'digest':sha.hexdigest()}
+
+        return sha.hexdigest()
+
+    def tree_digest(self, path:str)->str:
+        """ Return a digest over the relative names and contents of all files below path. """
+
+        if os.path.isfile(path):
+            return self.file_digest(path)
+
+        sha = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                sha.update(os.path.relpath(filename, path).encode())
+                sha.update(self.file_digest(filename).encode())
+
+        return sha.hexdigest()
+
+    def key(self, test:str)->str:
+        """ Compute the cache key of a test, or None if its inputs are unknown. """
+
+        if test not in self.datasets:
+            return None
+
+        sha = hashlib.sha256()
+        scripts = [os.path.join('scripts', test + '.py')] + sorted(glob.glob('scripts/baseclass/*.py'))
+        for script in scripts:
+            sha.update(self.file_digest(script).encode())
+
+        for msname in self.datasets[test]:
+            sha.update(msname.encode())
+            sha.update(self.tree_digest(os.path.join(self.data_path, msname)).encode())
+
+        jsonfile = os.path.join(self.data_path, self.fiducials.get('expdict_jsonfile', ''))
+        if os.path.isfile(jsonfile):
+            sha.update(self.file_digest(jsonfile).encode())
+        sha.update(str(self.fiducials.get('refversion')).encode())
+        sha.update(self.casaversion.encode())
+
+        return sha.hexdigest()
+
+    def lookup(self, test:str, key:str):
+        """ Return the cached result of a test for key, restoring its metric files, or None. """
+
+        if key == None or os.path.exists(os.path.join(self.cache_dir, key + '.json')) is False:
+            return None
 
-    except subprocess.CalledProcessError as cpe:
-        print('{}: Error in completion of spawned process.'.format(cpe))
-#    p = subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stderr, shell=False)
+        entry_file = os.path.join(self.cache_dir, key + '.json')
 
+        with open(entry_file) as file:
+            entry = json.load(file)
+
+        for filename, metrics in entry['metrics'].items():
+            with open(filename, 'w') as outf:
+                json.dump(metrics, outf)
+
+        # The weblog dictionary of the run that produced the entry
+        test_dict_file = os.path.join(self.cache_dir, key + '.test_dict.pickle')
+        if os.path.exists(test_dict_file):
+            shutil.copyfile(test_dict_file, test + '.test_dict.pickle')
+
+        return entry
+
+    def store(self, test:str, key:str, returncode:int, start:float)->None:
+        """ Record a passing result together with the metric files written since start. """
+
+        if key == None or returncode != 0:
+            return
+
+        metrics = {}
+        for filename in glob.glob(test + '_cur_stats*.json'):
+            if os.path.getmtime(filename) >= start:
+                with open(filename) as file:
+                    metrics[filename] = json.load(file)
+
+        test_dict_file = test + '.test_dict.pickle'
+        if os.path.exists(test_dict_file) and os.path.getmtime(test_dict_file) >= start:
+            shutil.copyfile(test_dict_file, os.path.join(self.cache_dir, key + '.test_dict.pickle'))
+
+        entry = {'test':test, 'returncode':returncode, 'casaversion':self.casaversion, 'metrics':metrics}
+        with open(os.path.join(self.cache_dir, key + '.json'), 'w') as outf:
+            json.dump(entry, outf)
+
+    def save(self)->None:
+        """ Persist the file digest index. """
+
+        with self._lock:
+            with open(self._index_file, 'w') as outf:
+                json.dump(self._index, outf)
+
+def execute_test(test:str, ncores=1, mpi_command=None, logfile=None, mode='spawn', cache=None)->dict:
+    """ Run a test through the result cache (if any) and the requested execution mode.
+
+    Returns:
+        dict: Result record with the exit status, the wall-clock duration, whether the
+            result came from the cache and the resource usage of the test process.
+    """
+
+    # The weblog dictionary of a previous run mustn't be taken for the one of this run
+    start = time.time()
+    if os.path.exists(test + '.test_dict.pickle'):
+        os.remove(test + '.test_dict.pickle')
+
+    key = None
+    if cache != None:
+        key = cache.key(test)
+        entry = cache.lookup(test, key)
+        if entry != None:
+            print('{}: cached result for unchanged inputs ({})'.format(test, key[:12]))
+            return {'returncode':entry['returncode'], 'duration':0.0, 'cached':True, 'start':start}
+    if mode == 'fork' and ncores == 1:
+        returncode, usage = fork_test(test, logfile)
+    else:
+        returncode, usage = spawn_test(test, ncores, mpi_command, logfile)
+
+    save_usage(test, usage)
+
+    if cache != None:
+        cache.store(test, key, returncode, start)
+
+    return {'returncode':returncode, 'duration':usage['wall'], 'cached':False, 'usage':usage, 'start':start}
+
+def load_durations(filename:str)->dict:
+    """ Load the historical wall-clock duration (s) of each test. """
+
+    if filename == None or os.path.exists(filename) is False:
+        return {}
+
+    with open(filename) as file:
+        return json.load(file)
+
+def update_durations(filename:str, results:dict)->None:
+    """ Record the wall-clock durations of the tests that were actually run. """
+
+    if filename == None:
+        return
+
+    durations = load_durations(filename)
+    for test, record in results.items():
+        if record['cached'] == False and record['returncode'] == 0:
+            durations[test] = record['duration']
+
+    with open(filename, 'w') as outf:
+        json.dump(durations, outf, indent=2, sort_keys=True)
+
+def shard_tests(tests:list, index:int, nshards:int, durations:dict)->list:
+    """ Select the tests of one shard, balancing the historical durations between shards.
+
+        Tests are assigned longest first to the least loaded shard. Tests without a recorded
+        duration are counted with the mean of the known durations. The assignment only
+        depends on the test list and the durations, so every host computes the same split.
+
+    Args:
+        tests (list): Full list of tests.
+        index (int): Shard number, from 1 to nshards.
+        nshards (int): Number of shards.
+        durations (dict): Historical duration per test.
+
+    Returns:
+        list: Tests of the shard, longest first.
+    """
+
+    known = [durations[test] for test in tests if test in durations]
+    default = sum(known)/len(known) if len(known) > 0 else 1.0
+
+    loads = [0.0]*nshards
+    shards = [[] for i in range(nshards)]
+    for test in sorted(tests, key=lambda test: (-durations.get(test, default), test)):
+        shard = loads.index(min(loads))
+        shards[shard].append(test)
+        loads[shard] += durations.get(test, default)
+
+    return shards[index-1]
+
+def collect_test_dict(test:str, start=None)->dict:
+    """ Return the weblog dictionary saved by a test in its tearDown, if any.
+
+    Args:
+        test (str): Name of the test script, the STK_TEST_ID of the test process.
+        start (float, optional): Start time (time.time()) of the test, older files are
+            left over by a previous run and ignored. Defaults to None.
+    """
+
+    filename = test + '.test_dict.pickle'
+    if os.path.exists(filename) is False:
+        return {}
+
+    if start != None and os.path.getmtime(filename) < start:
+        print('Ignoring {}, older than the test run'.format(filename))
+        return {}
+
+    with open(filename, 'rb') as file:
+        return pickle.load(file) or {}
+
+def _to_json(obj):
+    # numpy values in the weblog dictionaries
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return str(obj)
+
+def write_results(filename:str, results:dict, test_dict:dict, shard=None)->None:
+    """ Write a (partial) result file with the result records and weblog dictionaries. """
+
+    with open(filename, 'w') as outf:
+        json.dump({'shard':shard, 'results':results, 'test_dict':test_dict}, outf, indent=2, default=_to_json)
+
+def merge_results(filenames:list)->tuple:
+    """ Combine partial result files.
+
+    Returns:
+        tuple: Merged result records and weblog dictionaries.
+    """
+
+    results = {}
+    test_dict = {}
+    for filename in filenames:
+        with open(filename) as file:
+            partial = json.load(file)
+        results.update(partial['results'])
+        test_dict.update(partial['test_dict'])
+
+    return results, test_dict
+
+def tclean_calls(test:str)->list:
+    """ Return the parameters of the run_tclean()/cached_tclean() calls of a test script
+        (scripts/<test>.py) given as literals; other arguments are left out. """
+
+    script = os.path.join('scripts', test + '.py')
+    if os.path.isfile(script) is False:
+        return []
+
+    with open(script) as file:
+        tree = ast.parse(file.read(), filename=script)
+
+    calls = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) is False:
+            continue
+        name = node.func.attr if isinstance(node.func, ast.Attribute) else getattr(node.func, 'id', None)
+        if name not in ('run_tclean', 'cached_tclean'):
+            continue
+
+        params = {}
+        for keyword in node.keywords:
+            try:
+                params[keyword.arg] = ast.literal_eval(keyword.value)
+            except (ValueError, TypeError, SyntaxError):
+                pass
+        calls.append(params)
+
+    return calls
+
+def chunked_test(test:str)->bool:
+    """ Whether a test images a cube in local_cube channel chunks (see stk_chunked.chunkable). """
+
+    try:
+        from scripts.baseclass.stk_chunked import chunkable
+    except ImportError:
+        return False
+
+    return any(chunkable(params) for params in tclean_calls(test))
+
+def run_tests(tests:list, runner_config:dict, jobs=1, mode='spawn', cache=None, stager=None, datasets=None, test_cores=None)->dict:
+    """ Schedule tests on a pool of workers sharing jobs cores.
+
+        Serial tests take a single core, or their test_cores. Tests listed in the runner 'mpi' section reserve
+        their cores exclusively and are only started once enough cores are free; the queue
+        is not reordered around them so they cannot be starved by serial tests. A test
+        needing more than jobs cores still runs with its MPI size (or tclean processes),
+        once all the cores are free. Results are collected as soon as each test finishes.
+
+    Args:
+        tests (list): Test names, in submission order.
+        runner_config (dict): 'runner' section of the configuration file.
+        jobs (int, optional): Number of cores available to the scheduler. Defaults to 1.
+        mode (str, optional): 'spawn' starts a new interpreter per test, 'fork' forks the
+            warm runner process. MPI tests are always spawned. Defaults to 'spawn'.
+        cache (ResultCache, optional): Cache of passing results. Defaults to None.
+        stager (DataStager, optional): Stages the measurement sets of the next test to local
+            scratch while the current ones run. Defaults to None.
+        datasets (dict, optional): Paths of the measurement sets of each test, for the
+            stager. Defaults to None.
+        test_cores (dict, optional): Cores reserved by the tests not run under MPI that
+            need more than one, e.g. the local_cube workers of the tests imaging their cubes
+            in channel chunks. Defaults to None.
+
+    Returns:
+        dict: Result record per test name.
+    """
+
+    mpi_tests = runner_config.get('mpi') or {}
+    mpi_command = runner_config.get('mpi_command')
+    logdir = runner_config.get('logdir', 'logs')
+
+    if jobs > 1 and os.path.isdir(logdir) is False:
+        os.mkdir(logdir)
+
+    pending = list(tests)
+    running = {}
+    results = {}
+    free = jobs
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0:
+                # A test larger than the scheduler keeps its MPI size (or number of tclean
+                # processes), it waits for all the cores and runs alone
+                ncores = int(mpi_tests.get(pending[0], 1))
+                cores = ncores if pending[0] in mpi_tests else int((test_cores or {}).get(pending[0], 1))
+                reserved = min(cores, jobs)
+                if reserved > free:
+                    break
+
+                test = pending.pop(0)
+                if cores > jobs:
+                    print('Warning: {} needs {} cores, more than the {} of -j/--jobs; running it alone'.format(test, cores, jobs))
+
+                logfile = os.path.join(logdir, test + '.log') if jobs > 1 else None
+                print('Starting {} ({} core(s))'.format(test, cores))
+
+                future = executor.submit(execute_test, test, ncores, mpi_command, logfile, mode, cache)
+                running[future] = (test, reserved)
+                free -= reserved
+
+                # The test stages its own measurement sets (waiting for a prefetch in
+                # progress), those of the next test are copied meanwhile
+                if stager != None and len(pending) > 0:
+                    stager.prefetch((datasets or {}).get(pending[0], []))
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                test, ncores = running.pop(future)
+                free += ncores
+                results[test] = future.result()
+                print('Finished {}: {}'.format(test, 'Pass' if results[test]['returncode'] == 0 else 'Fail'))
+
+    return results
 
 
 if __name__ == '__main__':
-    
+
     # Load configuration file containing test dictionary
     with open(os.getcwd() + '/config/config.yaml') as file:
         config_file = yaml.safe_load(file)
 
+    runner_config = config_file.get('runner') or {}
+
     # Create the command-line parser and make it mutually exclusinve
     parser = argparse.ArgumentParser(description="Parse input to determine stakeholder test.")
     group  = parser.add_mutually_exclusive_group()
@@ -29,17 +740,130 @@ if __name__ == '__main__':
     # Parse command-line options
     group.add_argument('--stakeholder-test', nargs='+',  dest='test_name', action='store')
     group.add_argument('--all', dest='full_test', action='store_true')
-    
+    group.add_argument('--merge', nargs='+', dest='merge', action='store',
+        help='Merge partial result files into one result file and weblog.')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=runner_config.get('jobs', 1),
+        help='Number of cores shared by concurrently running tests.')
+    parser.add_argument('--mode', dest='mode', choices=['spawn', 'fork'], default=runner_config.get('mode', 'spawn'),
+        help='Start each test in a new interpreter (spawn) or fork it from a warm runner (fork).')
+    parser.add_argument('--cache', dest='cache', action='store_true',
+        default=(runner_config.get('cache') or {}).get('enabled', False),
+        help='Reuse the result of a previous passing run with identical inputs.')
+    parser.add_argument('--no-cache', dest='cache', action='store_false')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        default=(config_file.get('checkpoints') or {}).get('resume', False),
+        help='Skip the stages of a test (tclean, copy_products, moments) completed by a previous run.')
+    parser.add_argument('--no-resume', dest='resume', action='store_false')
+    parser.add_argument('--shard', dest='shard', action='store', default=None,
+        help='Run only shard i of N (i/N, 1 <= i <= N), balanced on historical durations.')
+    parser.add_argument('--result-file', dest='result_file', action='store', default=None,
+        help='Result file name. Defaults to results.json, or results_<i>of<N>.json for a shard.')
+
     args = parser.parse_args()
 
+    durations_file = runner_config.get('durations', 'durations.json')
+
+    if args.merge != None:
+        results, test_dict = merge_results(args.merge)
+        write_results(args.result_file or 'results.json', results, test_dict)
+        update_durations(durations_file, results)
+
+        if len(test_dict) > 0:
+            from casatestutils import generate_weblog
+            generate_weblog("tclean_ALMA_pipeline", test_dict)
+
+        nfail = len([test for test in results if results[test]['returncode'] != 0])
+        print('{} of {} test(s) failed'.format(nfail, len(results)))
+        sys.exit(1 if nfail > 0 else 0)
+
+    tests = []
     if args.full_test == True:
-        for entry in config_file['tests']['all']:
-            spawn_test(entry)
-        
+        tests = config_file['tests']['all']
+
     else:
         for entry in args.test_name:
             if entry in config_file['tests'].keys():
-                spawn_test(config_file['tests'][entry])
+                tests.append(config_file['tests'][entry])
 
             else:
                 print('Unknown test:  '  + str(entry))
+
+    result_file = args.result_file or 'results.json'
+    if args.shard != None:
+        index, nshards = [int(value) for value in args.shard.split('/')]
+        if nshards < 1 or index < 1 or index > nshards:
+            parser.error('--shard expects i/N with 1 <= i <= N')
+
+        tests = shard_tests(tests, index, nshards, load_durations(durations_file))
+        result_file = args.result_file or 'results_{}of{}.json'.format(index, nshards)
+        print('Shard {}: {}'.format(args.shard, ', '.join(tests)))
+
+    # The test processes (spawned or forked) read the resume flag from the environment
+    os.environ['STK_RESUME'] = '1' if args.resume else '0'
+
+    if args.mode == 'fork':
+        # Make the scripts package importable from the forked children. The server is
+        # started before the runner starts any thread.
+        sys.path.insert(0, os.getcwd())
+        _fork_server = ForkServer(runner_config.get('preload') or [])
+
+    cache = None
+    if args.cache:
+        cache_config = runner_config.get('cache') or {}
+        cache_data_path = cache_config.get('data_path')
+        if cache_data_path == None:
+            from casatools import ctsys
+            cache_data_path = ctsys.resolve('stakeholder/alma/')
+
+        cache = ResultCache(cache_config.get('dir', '.stkcache'), cache_data_path,
+            config_file.get('datasets') or {}, config_file.get('fiducials') or {})
+
+    stager = None
+    staging_config = config_file.get('staging') or {}
+    if staging_config.get('enabled', False):
+        from scripts.baseclass.stk_staging import DataStager
+
+        staging_data_path = staging_config.get('data_path')
+        if staging_data_path == None:
+            from casatools import ctsys
+            staging_data_path = ctsys.resolve('stakeholder/alma/')
+
+        stager = DataStager(staging_config.get('scratch_dir', '/tmp/stk_scratch'),
+            max_gbytes=staging_config.get('max_gbytes', 100))
+        datasets = {test:[os.path.join(staging_data_path, msname) for msname in msnames]
+            for test, msnames in (config_file.get('datasets') or {}).items()}
+        if len(tests) > 0:
+            stager.prefetch(datasets.get(tests[0], []))
+
+    # Serial tests imaging their cubes in channel chunks run local_cube.workers tclean processes
+    local_cube = config_file.get('local_cube') or {}
+    test_cores = {}
+    if local_cube.get('enabled', False):
+        workers = max(int(local_cube.get('workers', 4)), 1)
+        test_cores = {test:workers for test in tests if test not in (runner_config.get('mpi') or {}) and chunked_test(test)}
+
+    results = run_tests(tests, runner_config, jobs=max(args.jobs, 1), mode=args.mode, cache=cache,
+        stager=stager, datasets=datasets if stager != None else None, test_cores=test_cores)
+
+    if stager != None:
+        stager.close()
+
+    if _fork_server != None:
+        _fork_server.close()
+
+    if cache != None:
+        cache.save()
+
+    test_dict = {}
+    for test in results:
+        test_dict.update(collect_test_dict(test, results[test].get('start')))
+
+    write_results(result_file, results, test_dict, shard=args.shard)
+
+    # Shards keep the durations they were split with; the merge step records the new ones.
+    if args.shard == None:
+        update_durations(durations_file, results)
+
+    nfail = len([test for test in results if results[test]['returncode'] != 0])
+    print('{} of {} test(s) failed'.format(nfail, len(results)))
+    sys.exit(1 if nfail > 0 else 0)
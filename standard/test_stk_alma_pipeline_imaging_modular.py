@@ -60,7 +60,7 @@
 
     * NOTE for updating the tests and fiducial values in json file *
     When the json file is updated and its 'casa_version'
-    could also be updated then self.refversion in the setUp() needs to be updated to
+    could also be updated then fiducials: refversion in config/config.yaml needs to be updated to
     match with the 'casa_version' as defined in the json file otherwise 
     almastkteestutils.read_testcase_expdicts() print an error message.
 
@@ -84,7 +84,6 @@
 import os
 import unittest
 import shutil
-import copy
 
 from casatestutils.imagerhelpers import TestHelpers
 
@@ -94,7 +93,7 @@ from casatestutils import add_to_dict
 from casatestutils import stats_dict
 
 from casatools import ctsys, image
-from casatasks import tclean, immoments
+from casatasks import immoments
 from casatasks.private.parallel.parallel_task_helper import ParallelTaskHelper
 from casatasks.private.imagerhelpers.parallel_imager_helper import PyParallelImagerHelper
 
@@ -154,24 +153,25 @@ class Test_standard(test_stakeholder_base):
     def standard_cube_clean(self):
         print("\nSTARTING: iter0 routine")
 
-        # iter0 routine
-        tclean(vis=self.msfile, imagename=self.file_name+'0', field='1', \
-            spw=['0'], imsize=[80, 80], antenna=['0,1,2,3,4,5,6,7,8'], \
-            scan=['8,12,16'], intent='OBSERVE_TARGET#ON_SOURCE', \
-            datacolumn='data', cell=['1.1arcsec'], phasecenter='ICRS'
-            ' 00:45:54.3836 -073.15.29.413', stokes='I', specmode='cube', \
-            nchan=508, start='220.2526743594GHz', width='0.2441741MHz', \
-            outframe='LSRK', pblimit=0.2, perchanweightdensity=False, \
-            gridder='standard',  mosweight=False, \
-            deconvolver='hogbom', usepointing=False, restoration=False, \
-            pbcor=False, weighting='briggs', restoringbeam='common', \
-            robust=0.5, npixels=0, niter=0, threshold='0.0mJy', nsigma=0.0, \
-            interactive=0, usemask='auto-multithresh', \
-            sidelobethreshold=1.25, noisethreshold=5.0, \
-            lownoisethreshold=2.0, negativethreshold=0.0, minbeamfrac=0.1, \
-            growiterations=75, dogrowprune=True, minpercentchange=1.0, \
-            fastnoise=False, savemodel='none', parallel=self.parallel,
-            verbose=True)
+        with self.tracer.span('tclean iter0'):
+            # iter0 routine
+            self.cached_tclean(vis=self.msfile, imagename=self.file_name+'0', field='1', \
+                spw=['0'], imsize=[80, 80], antenna=['0,1,2,3,4,5,6,7,8'], \
+                scan=['8,12,16'], intent='OBSERVE_TARGET#ON_SOURCE', \
+                datacolumn='data', cell=['1.1arcsec'], phasecenter='ICRS'
+                ' 00:45:54.3836 -073.15.29.413', stokes='I', specmode='cube', \
+                nchan=508, start='220.2526743594GHz', width='0.2441741MHz', \
+                outframe='LSRK', pblimit=0.2, perchanweightdensity=False, \
+                gridder='standard',  mosweight=False, \
+                deconvolver='hogbom', usepointing=False, restoration=False, \
+                pbcor=False, weighting='briggs', restoringbeam='common', \
+                robust=0.5, npixels=0, niter=0, threshold='0.0mJy', nsigma=0.0, \
+                interactive=0, usemask='auto-multithresh', \
+                sidelobethreshold=1.25, noisethreshold=5.0, \
+                lownoisethreshold=2.0, negativethreshold=0.0, minbeamfrac=0.1, \
+                growiterations=75, dogrowprune=True, minpercentchange=1.0, \
+                fastnoise=False, savemodel='none', parallel=self.parallel,
+                verbose=True)
 
         # move files to iter1
         print('Copying iter0 files to iter1')
@@ -179,23 +179,24 @@ class Test_standard(test_stakeholder_base):
 
         print("STARTING: iter1 routine")
 
-        # iter1 (restart)
-        tclean(vis=self.msfile, imagename=self.file_name+'1', field='1', \
-            spw=['0'], imsize=[80, 80], antenna=['0,1,2,3,4,5,6,7,8'], 
-            scan=['8,12,16'], intent='OBSERVE_TARGET#ON_SOURCE', datacolumn='data', 
-            cell=['1.1arcsec'], phasecenter='ICRS 00:45:54.3836 -073.15.29.413', 
-            stokes='I', specmode='cube', nchan=508, start='220.2526743594GHz', 
-            width='0.2441741MHz', outframe='LSRK', perchanweightdensity=False, 
-            usepointing=False, pblimit=0.2, nsigma=0.0, gridder='standard',  mosweight=False, \
-            deconvolver='hogbom', restoringbeam='common', restoration=True, pbcor=True, \
-            weighting='briggs', robust=0.5, npixels=0, niter=20000, \
-            threshold='0.354Jy', interactive=0, usemask='auto'
-            '-multithresh', sidelobethreshold=1.25, noisethreshold=5.0, \
-            lownoisethreshold=2.0, negativethreshold=0.0, \
-            minbeamfrac=0.1, growiterations=75, dogrowprune=True, \
-            minpercentchange=1.0, fastnoise=False, restart=True, \
-            calcres=False, calcpsf=False, savemodel='none', \
-            parallel=self.parallel, verbose=True)
+        with self.tracer.span('tclean iter1'):
+            # iter1 (restart)
+            self.run_tclean(vis=self.msfile, imagename=self.file_name+'1', field='1', \
+                spw=['0'], imsize=[80, 80], antenna=['0,1,2,3,4,5,6,7,8'], 
+                scan=['8,12,16'], intent='OBSERVE_TARGET#ON_SOURCE', datacolumn='data', 
+                cell=['1.1arcsec'], phasecenter='ICRS 00:45:54.3836 -073.15.29.413', 
+                stokes='I', specmode='cube', nchan=508, start='220.2526743594GHz', 
+                width='0.2441741MHz', outframe='LSRK', perchanweightdensity=False, 
+                usepointing=False, pblimit=0.2, nsigma=0.0, gridder='standard',  mosweight=False, \
+                deconvolver='hogbom', restoringbeam='common', restoration=True, pbcor=True, \
+                weighting='briggs', robust=0.5, npixels=0, niter=20000, \
+                threshold='0.354Jy', interactive=0, usemask='auto'
+                '-multithresh', sidelobethreshold=1.25, noisethreshold=5.0, \
+                lownoisethreshold=2.0, negativethreshold=0.0, \
+                minbeamfrac=0.1, growiterations=75, dogrowprune=True, \
+                minpercentchange=1.0, fastnoise=False, restart=True, \
+                calcres=False, calcpsf=False, savemodel='none', \
+                parallel=self.parallel, verbose=True)
 
 
     def standard_cube_report(self):
@@ -203,11 +204,26 @@ class Test_standard(test_stakeholder_base):
         bmin_dict, bmaj_dict, pa_dict = \
             self.cube_beam_stats(image=self.img+'.psf')
 
+        # statistics of the imaging products, computed side by side (.model needs the
+        # .mask statistics and .weight the .pb masks)
+        stats = self.products_stats({
+            'image':dict(image=self.img+'.image', fit_region = \
+                'ellipse[[11.47881897deg, -73.25881015deg], [9.0414arcsec, 8.4854arcsec], 90.00000000deg]'),
+            'mask':dict(image=self.img+'.mask'),
+            'pb':dict(image=self.img+'.pb', fit_region = \
+                'ellipse[[11.47659846deg, -73.25817055deg], [23.1086arcsec, 23.0957arcsec], 90.00000000deg]'),
+            'psf':dict(image=self.img+'.psf', fit_region = \
+                'ellipse[[11.47648725deg, -73.25812003deg], [8.0291arcsec, 6.8080arcsec], 90.00000000deg]'),
+            'residual':dict(image=self.img+'.residual', fit_region = \
+                'ellipse[[11.47881897deg, -73.25881015deg], [9.0414arcsec, 8.4854arcsec], 90.00000000deg]'),
+            'model':dict(image=self.img+'.model', fit_region = \
+                'ellipse[[11.47881897deg, -73.25881015deg], [9.0414arcsec, 8.4854arcsec], 90.00000000deg]', masks=('mask', 'mask')),
+            'sumwt':dict(image=self.img+'.sumwt')})
+
         report0 = th.checkall(imgexist = self.image_list(self.img, 'standard'))
 
         # .image report(test_standard_cube)
-        im_stats_dict = self.image_stats(image=self.img+'.image', fit_region = \
-            'ellipse[[11.47881897deg, -73.25881015deg], [9.0414arcsec, 8.4854arcsec], 90.00000000deg]')
+        im_stats_dict = stats['image']
 
         # test_standard_cube.exp_im_stats
         exp_im_stats = self._exp_dicts['exp_im_stats']
@@ -220,66 +236,64 @@ class Test_standard(test_stakeholder_base):
                 (self.img+'.image', False, [9, 40, 0, 0])])
 
         # .image report
-        report2 = th.check_dict_vals(exp_im_stats, im_stats_dict, '.image', epsilon=self.epsilon)
+        report2 = self.check_dict_vals(exp_im_stats, im_stats_dict, '.image', epsilon=self.epsilon)
 
         # .mask report
-        mask_stats_dict = self.image_stats(image=self.img+'.mask')
+        mask_stats_dict = stats['mask']
 
         # test_standard_cube.exp_mask_stats
         exp_mask_stats = self._exp_dicts['exp_mask_stats']
 
-        report3 = th.check_dict_vals(exp_mask_stats, mask_stats_dict, '.mask', epsilon=self.epsilon)
+        report3 = self.check_dict_vals(exp_mask_stats, mask_stats_dict, '.mask', epsilon=self.epsilon)
 
         # .pb report
-        pb_stats_dict = self.image_stats(image=self.img+'.pb', fit_region = \
-            'ellipse[[11.47659846deg, -73.25817055deg], [23.1086arcsec, 23.0957arcsec], 90.00000000deg]')
+        pb_stats_dict = stats['pb']
 
         # test_standard_cube.exp_mask_stats
         exp_pb_stats = self._exp_dicts['exp_pb_stats']
 
-        report4 = th.check_dict_vals(exp_pb_stats, pb_stats_dict, '.pb', epsilon=self.epsilon)
+        report4 = self.check_dict_vals(exp_pb_stats, pb_stats_dict, '.pb', epsilon=self.epsilon)
 
         # .psf report
-        psf_stats_dict = self.image_stats(image=self.img+'.psf', fit_region = \
-            'ellipse[[11.47648725deg, -73.25812003deg], [8.0291arcsec, 6.8080arcsec], 90.00000000deg]')
+        psf_stats_dict = stats['psf']
 
         # test_standard_cube.exp_psf_stats
         exp_psf_stats = self._exp_dicts['exp_psf_stats']
 
-        report5 = th.check_dict_vals(exp_psf_stats, psf_stats_dict, '.psf', epsilon=self.epsilon)
+        report5 = self.check_dict_vals(exp_psf_stats, psf_stats_dict, '.psf', epsilon=self.epsilon)
 
         # .residual report
-        resid_stats_dict = self.image_stats(image=self.img+'.residual', fit_region = \
-            'ellipse[[11.47881897deg, -73.25881015deg], [9.0414arcsec, 8.4854arcsec], 90.00000000deg]')
+        resid_stats_dict = stats['residual']
 
         # test_standard_cube.exp_resid_stats
         exp_resid_stats = self._exp_dicts['exp_resid_stats']
 
-        report6 = th.check_dict_vals(exp_resid_stats, resid_stats_dict, \
+        report6 = self.check_dict_vals(exp_resid_stats, resid_stats_dict, \
             '.residual', epsilon=self.epsilon)
 
         # .model report
-        model_stats_dict = self.image_stats(image=self.img+'.model', fit_region = \
-            'ellipse[[11.47881897deg, -73.25881015deg], [9.0414arcsec, 8.4854arcsec], 90.00000000deg]', masks=mask_stats_dict['mask'])
+        model_stats_dict = stats['model']
 
         # test_standard_cube.exp_model_stats
         exp_model_stats = self._exp_dicts['exp_model_stats']
 
-        report7 = th.check_dict_vals(exp_model_stats, model_stats_dict, \
+        report7 = self.check_dict_vals(exp_model_stats, model_stats_dict, \
             '.model', epsilon=self.epsilon)
 
         # .sumwt report
-        sumwt_stats_dict = self.image_stats(image=self.img+'.sumwt')
+        sumwt_stats_dict = stats['sumwt']
 
         # test_standard_cube.exp_sumwt_stats
         exp_sumwt_stats = self._exp_dicts['exp_sumwt_stats']
 
-        report8 = th.check_dict_vals(exp_sumwt_stats, sumwt_stats_dict, \
+        report8 = self.check_dict_vals(exp_sumwt_stats, sumwt_stats_dict, \
             '.sumwt', epsilon=self.epsilon)
 
-        # report combination
-        report = report0 + report1 + report2 + report3 + report4 + report5 + \
-            report6 + report7 + report8
+        # report combination: text of the th.checkall() checks, then the fiducial check records
+        report = FiducialReport()
+        report.add_text(report0 + report1)
+        report.add(report2 + report3 + report4 + report5 + \
+            report6 + report7 + report8)
 
         if self.parallel:
             # test_standard_cube.exp_bmin_dict
@@ -290,9 +304,9 @@ class Test_standard(test_stakeholder_base):
             exp_pa_dict = self._exp_dicts['exp_pa_dict']
 
 
-            report += self.check_dict_vals_beam(exp_bmin_dict, bmin_dict, '.image bmin', epsilon=self.epsilon)
-            report += self.check_dict_vals_beam(exp_bmaj_dict, bmaj_dict, '.image bmaj', epsilon=self.epsilon)
-            report += self.check_dict_vals_beam(exp_pa_dict, pa_dict, '.image pa', epsilon=self.epsilon)
+            report.add(self.check_dict_vals_beam(exp_bmin_dict, bmin_dict, '.image bmin', epsilon=self.epsilon))
+            report.add(self.check_dict_vals_beam(exp_bmaj_dict, bmaj_dict, '.image bmaj', epsilon=self.epsilon))
+            report.add(self.check_dict_vals_beam(exp_pa_dict, pa_dict, '.image pa', epsilon=self.epsilon))
 
         failed=self.filter_report(report)
         add_to_dict(self, output = test_dict, dataset = \
@@ -300,16 +314,20 @@ class Test_standard(test_stakeholder_base):
 
         self.modify_dict(test_dict, 'test_standard_cube', self.parallel)
 
-        test_dict[self.test_name]['report'] = report
+        test_dict[self.test_name]['report'] = report.render()
         test_dict[self.test_name]['images'] = []
 
         self.img = shutil._basename(self.img)
 
-        immoments(imagename=self.img+'.image', moments = 8, outfile = self.img +'.image.moment8')
-        plt_utils.plot_image(imname=self.img+'.image', type='.moment8', chan=0, trim=True)
+        with self.tracer.span('immoments', image=self.img+'.image'):
+            immoments(imagename=self.img+'.image', moments = 8, outfile = self.img +'.image.moment8')
+        with self.tracer.span('plot_image', image=self.img+'.image.moment8'):
+            plt_utils.plot_image(imname=self.img+'.image', type='.moment8', chan=0, trim=True)
         
-        immoments(imagename=self.img+'.residual', moments = 8, outfile = self.img +'.residual.moment8')
-        plt_utils.plot_image(imname=self.img+'.residual', type='.moment8', chan=0, trim=True)
+        with self.tracer.span('immoments', image=self.img+'.residual'):
+            immoments(imagename=self.img+'.residual', moments = 8, outfile = self.img +'.residual.moment8')
+        with self.tracer.span('plot_image', image=self.img+'.residual.moment8'):
+            plt_utils.plot_image(imname=self.img+'.residual', type='.moment8', chan=0, trim=True)
 
         test_dict[self.test_name]['images'].extend( \
             (self.img+'.image.moment8.png',self.img+'.residual.moment8.png'))
@@ -317,16 +335,14 @@ class Test_standard(test_stakeholder_base):
         test_dict[self.test_name]['images'].append(self.img+'.image.profile.png')
 
         if savemetricdict:
-            ### serialize ndarray in mask_stats_dcit
-            mask_stats_mod_dict = copy.deepcopy(mask_stats_dict)
-            mask_stats_mod_dict['mask'] = mask_stats_dict['mask'].tolist()
+            # masks (ndarray) are bit-packed by save_dict_to_file
             #create a nested dictionary containing exp dictionaries to save
             savedict = {}
             #list of stats to save
             # im_stats, mask_stats, pb_stats, psf_stats,\
             # model_stats, resid_stats, sumwt_stats]
             savedict['im_stats_dict']=im_stats_dict
-            savedict['mask_stats_dict']=mask_stats_mod_dict
+            savedict['mask_stats_dict']=mask_stats_dict
             savedict['pb_stats_dict']=pb_stats_dict
             savedict['psf_stats_dict']=psf_stats_dict
             savedict['model_stats_dict']=model_stats_dict
@@ -339,7 +355,7 @@ class Test_standard(test_stakeholder_base):
 
             self.save_dict_to_file(self.test_name,savedict, self.test_name+'_cur_stats')
 
-        self.assertTrue(th.check_final(pstr = report), msg = failed)
+        self.assertTrue(th.check_final(pstr = report.render()), msg = failed)
         self.test_dict = test_dict
 
 # End of test_standard_cube
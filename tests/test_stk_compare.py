@@ -0,0 +1,201 @@
+##########################################################################
+##########################################################################
+# test_stk_compare.py
+#
+# Copyright (C) 2018
+# Associated Universities, Inc. Washington DC, USA.
+#
+# This script is free software; you can redistribute it and/or modify it
+# under the terms of the GNU Library General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Library General Public
+# License for more details.
+#
+# [https://open-jira.nrao.edu/browse/CAS-12428]
+#
+#
+##########################################################################
+import unittest
+
+import numpy
+
+from scripts.baseclass.stk_compare import compare_values, compare_dicts, compare_beams, FiducialReport
+from scripts.baseclass.stk_mask import pack_mask
+
+# Fixed inputs of the th.check_dict_vals() parity test, one case per key
+parity_exp_dict = {
+    'exact_int': [True, 100],
+    'exact_float': [True, 1.5],
+    'default_eps': [False, 2.0],
+    'default_eps_fail': [False, 2.0],
+    'key_eps': [0.1, 2.0],
+    'tiny_eps': [1e-10, 244174.08],
+    'tiny_eps_pass': [1e-10, 244174.08],
+    'zero': [False, 0.0],
+    'zero_fail': [False, 0.0],
+    'list_int_flag': [1, [0.1, 0.2, 0.3]],
+    'list_int_flag_fail': [1, [0.1, 0.2, 0.3]],
+    'list_default_eps': [False, [10.0, 20.0]],
+    'list_exact': [True, [1.0, 2.0]],
+    'list_exact_fail': [True, [1.0, 2.0]],
+    'list_nan': [False, [1.0, 2.0]],
+    'nan': [False, 1.0],
+}
+parity_act_dict = {
+    'exact_int': 100,
+    'exact_float': 1.5000001,
+    'default_eps': 2.019,
+    'default_eps_fail': 2.021,
+    'key_eps': 2.19,
+    'tiny_eps': 244174.0801,
+    'tiny_eps_pass': 244174.08,
+    'zero': 0.0,
+    'zero_fail': 1e-12,
+    'list_int_flag': [0.15, 0.35, 0.01],
+    'list_int_flag_fail': [0.15, 0.45, 0.3],
+    'list_default_eps': [10.05, 19.9],
+    'list_exact': [1.0, 2.0],
+    'list_exact_fail': [1.0, 2.0000001],
+    'list_nan': [1.0, numpy.nan],
+    'nan': numpy.nan,
+}
+# Verdicts of casatestutils 6.7.6.14 TestHelpers().check_dict_vals(parity_exp_dict,
+# parity_act_dict, '.image'): a key fails when one of its report lines reads '( Fail'
+parity_verdicts = {
+    'exact_int': True,
+    'exact_float': False,
+    'default_eps': True,
+    'default_eps_fail': False,
+    'key_eps': True,
+    'tiny_eps': False,
+    'tiny_eps_pass': True,
+    'zero': True,
+    'zero_fail': False,
+    'list_int_flag': True,
+    'list_int_flag_fail': False,
+    'list_default_eps': True,
+    'list_exact': True,
+    'list_exact_fail': False,
+    'list_nan': False,
+    'nan': False,
+}
+
+def report_verdicts(report:str, exp_dict:dict, suffix:str)->dict:
+    """ Pass/fail of every key of a th.check_dict_vals() report. """
+
+    verdicts = {}
+    for key in exp_dict:
+        lines = [line for line in report.splitlines()
+            if suffix + ' ' + key + ' is ' in line or suffix + ' ' + key + ' index ' in line]
+        verdicts[key] = all('( Fail' not in line for line in lines)
+
+    return verdicts
+
+def casatestutils_helpers():
+    """ Return casatestutils TestHelpers(), None if casatestutils can't be imported. """
+
+    try:
+        from casatestutils.imagerhelpers import TestHelpers
+    except ImportError:
+        return None
+
+    return TestHelpers()
+
+class test_compare_values(unittest.TestCase):
+
+    def test_scalar(self):
+        self.assertTrue(compare_values('x', 1.001, 1.0).passed)
+        self.assertFalse(compare_values('x', 1.1, 1.0).passed)
+        self.assertTrue(compare_values('x', 0.01, 0.0).passed)
+
+        result = compare_values('x', 1.1, 1.0, epsilon=0.05)
+        self.assertAlmostEqual(result.max_deviation, 0.1)
+
+    def test_list(self):
+        result = compare_values('x', [1.0, 2.5, 3.0, 0.0], [1.0, 2.0, 3.001, 0.0])
+
+        self.assertFalse(result.passed)
+        self.assertEqual(result.failures, [1])
+        self.assertEqual((result.value, result.expected), (2.5, 2.0))
+
+        self.assertTrue(compare_values('x', numpy.array([1.0, 2.0]), [1.0, 2.0]).passed)
+        self.assertFalse(compare_values('x', [1.0, 2.0], [1.0, 2.0, 3.0]).passed)
+
+    def test_nonfinite(self):
+        self.assertFalse(compare_values('x', numpy.nan, 1.0).passed)
+        self.assertFalse(compare_values('x', numpy.inf, numpy.inf, exact=True).passed)
+        self.assertEqual(compare_values('x', [1.0, numpy.nan], [1.0, 1.0]).failures, [1])
+
+    def test_exact(self):
+        self.assertTrue(compare_values('x', 3, 3, exact=True).passed)
+        self.assertFalse(compare_values('x', 1.001, 1.0, exact=True).passed)
+        self.assertTrue(compare_values('x', 'hogbom', 'hogbom', exact=True).passed)
+        self.assertFalse(compare_values('x', True, False).passed)
+
+    def test_mask(self):
+        mask = numpy.zeros((4, 4, 1, 2), dtype=bool)
+        mask[1:3, 1:3, 0, 0] = True
+        other = mask.copy()
+        other[0, 0, 0, 1] = True
+
+        self.assertTrue(compare_values('x', pack_mask(mask), pack_mask(mask)).passed)
+        result = compare_values('x', pack_mask(other), pack_mask(mask))
+        self.assertFalse(result.passed)
+        self.assertEqual(result.value, 1)
+
+    def test_beams(self):
+        result = compare_beams({'*0': 1.0, '*1': 2.0}, {'*0': 1.0}, '.image bmaj')
+
+        self.assertFalse(result.passed)
+        self.assertEqual(result.failures, [1])
+
+class test_compare_dicts(unittest.TestCase):
+
+    def test_flags(self):
+        exp_dict = {'npts': [True, 100], 'max_val': [False, 1.0], 'start': [1e-10, 244174.08],
+            'rms_per_chan': [1, [0.1, 0.2]], 'min_val': [False, 0.0]}
+        act_dict = {'npts': 100, 'max_val': 1.005, 'start': 244174.0801,
+            'rms_per_chan': [0.1001, 0.2], 'min_val': 0.0}
+
+        results = compare_dicts(exp_dict, act_dict, '.image')
+
+        self.assertEqual([result.passed for result in results], [True, True, False, True, True])
+
+    def test_missing(self):
+        results = compare_dicts({'npts': [True, 100]}, {}, '.image')
+
+        self.assertFalse(results[0].passed)
+        self.assertEqual(results[0].value, 'missing')
+
+    def test_check_dict_vals_parity(self):
+        results = compare_dicts(parity_exp_dict, parity_act_dict, '.image')
+
+        self.assertEqual({key: result.passed for key, result in zip(parity_exp_dict, results)}, parity_verdicts)
+
+    @unittest.skipIf(casatestutils_helpers() == None, 'casatestutils is not available')
+    def test_check_dict_vals_casatestutils(self):
+        report = casatestutils_helpers().check_dict_vals(parity_exp_dict, parity_act_dict, '.image')
+        results = compare_dicts(parity_exp_dict, parity_act_dict, '.image')
+
+        self.assertEqual(report_verdicts(report, parity_exp_dict, '.image'), parity_verdicts)
+        self.assertEqual({key: result.passed for key, result in zip(parity_exp_dict, results)},
+            report_verdicts(report, parity_exp_dict, '.image'))
+
+class test_fiducial_report(unittest.TestCase):
+
+    def test_counts(self):
+        report = FiducialReport()
+        report.add(compare_dicts({'a': [True, 1], 'b': [True, 2]}, {'a': 1, 'b': 3}, '.image'))
+        report.add_text('[ check_ims ] Image made : [] = [] ( Pass : should all be True )\n'
+            '[ check_ims ] Image made : [] = [] ( Fail : should all be True )\n')
+
+        self.assertEqual(report.nfail, 2)
+        self.assertEqual(len(report.failures()), 2)
+        self.assertIn('.image b : 3 ( Fail : should be 2)', report.render(showonlyfail=True))
+
+if __name__ == '__main__':
+    unittest.main()